@@ -0,0 +1,112 @@
+"""
+Conductor data layer benchmark: fetch, save, load, resolve, Group.all_hosts
+and Autocompleter over synthetic inventories.
+
+    python -m bench.conductor --hosts 1000,10000,100000 -o results.json
+    python -m bench.conductor --hosts 1000,10000,100000 --baseline results.json
+    python -m bench.conductor --hosts 10000 --projects 16 --latency 0.2 --concurrency 1
+"""
+from __future__ import print_function
+import random
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from bench.inventory import InventoryParams, generate
+from bench.measure import measure, report, print_results, load_baseline, save_report
+from bench.server import ConductorStandIn
+from xclib.conductor import Conductor
+from xclib.conductor.api import Autocompleter
+from xclib.conductor.models import Group
+
+DEFAULT_EXPRESSIONS = [
+    "*",
+    "*project0",
+    "%p0-1",
+    "*@dc0",
+    "*#tag1",
+    "*[key0=v1]",
+    "*project0@dc1-0#tag2,-*#tag3",
+]
+
+
+def bench_inventory(params, expressions, repeat, concurrency=Conductor.DEFAULT_FETCH_CONCURRENCY, latency=0.0):
+    data = generate(params)
+    names = [p["name"] for p in data["projects"]]
+    results = []
+    cache_dir = tempfile.mkdtemp(prefix="xcute_bench_")
+
+    def add(op, result, **kwargs):
+        result.update(op=op, hosts=params.hosts)
+        result.update(kwargs)
+        results.append(result)
+
+    try:
+        with ConductorStandIn(data, latency=latency) as stand_in:
+            def new_conductor(drop_cache):
+                return Conductor(names, host=stand_in.host, port=stand_in.port,
+                                 cache_dir=cache_dir, drop_cache=drop_cache, fetch_concurrency=concurrency)
+
+            add("fetch", measure(lambda: new_conductor(True) and None, repeat), concurrency=concurrency)
+            conductor = new_conductor(True)
+
+            add("save", measure(conductor.save, repeat))
+            add("load", measure(conductor.load, repeat))
+
+            for expr in expressions:
+                add("resolve", measure(lambda: {"found": len(conductor.resolve(expr))}, repeat), expr=expr)
+
+            roots = [g for g in conductor.groups.get_cache(Group.KEY).values() if not g.parent_ids]
+            add("all_hosts", measure(lambda: {"found": sum(len(g.all_hosts) for g in roots)}, repeat))
+
+            fqdns = [h["fqdn"] for h in data["hosts"]]
+
+            def build():
+                ac = Autocompleter()
+                for fqdn in fqdns:
+                    ac.add(fqdn)
+
+            add("autocompleter.build", measure(build, repeat))
+
+            ac = Autocompleter()
+            for fqdn in fqdns:
+                ac.add(fqdn)
+            rnd = random.Random(params.seed)
+            prefixes = [f[:rnd.randrange(1, len(f))] for f in rnd.sample(fqdns, min(len(fqdns), 1000))]
+            add("autocompleter.complete", measure(lambda: [ac.complete(p) for p in prefixes] and None, repeat))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="xcute conductor data layer benchmark")
+    parser.add_argument("--hosts", default="1000,10000", help="comma-separated host counts")
+    for key, value in sorted(InventoryParams.DEFAULTS.items()):
+        if key == "hosts":
+            continue
+        parser.add_argument("--" + key.replace("_", "-"), dest=key, type=type(value), default=value)
+    parser.add_argument("-e", "--expr", dest="expressions", action="append", help="resolve expression")
+    parser.add_argument("-c", "--concurrency", type=int, default=Conductor.DEFAULT_FETCH_CONCURRENCY,
+                        help="parallel per-project fetches")
+    parser.add_argument("-l", "--latency", type=float, default=0.0, help="stand-in response delay, seconds")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="best of N runs")
+    parser.add_argument("-o", "--output", help="save JSON results to file")
+    parser.add_argument("-b", "--baseline", help="compare to JSON results from a previous run")
+    args = parser.parse_args()
+
+    expressions = args.expressions or DEFAULT_EXPRESSIONS
+    results = []
+    base_params = None
+    for count in [int(x) for x in args.hosts.split(",")]:
+        kwargs = dict((key, getattr(args, key)) for key in InventoryParams.DEFAULTS if key != "hosts")
+        params = InventoryParams(hosts=count, **kwargs)
+        base_params = params.as_dict()
+        results.extend(bench_inventory(params, expressions, args.repeat, args.concurrency, args.latency))
+
+    print_results(results, load_baseline(args.baseline))
+    save_report(args.output, report("conductor", base_params, results))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Execution engine benchmark: run_parallel, run_collapse, ping_parallel and
+distribute against fake ssh/scp/ping executables (see bench/fakessh.py).
+
+    python -m bench.execution --hosts 1000,5000 --latency 0.2 -o results.json
+    python -m bench.execution --backend gevent --backend poll -m parallel -m collapse
+"""
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from bench import fakessh
+from bench.inventory import generate
+from bench.measure import measure, report, print_results, load_baseline, save_report
+from bench.server import ConductorStandIn
+from xclib.backends import BACKENDS, DEFAULT_BACKEND
+
+MODES = ("parallel", "collapse", "ping", "distribute")
+NO_BACKEND_MODES = ("ping", "distribute")
+
+
+def silenced(func):
+    def wrapper():
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        return func()
+    return wrapper
+
+
+def make_cli(stand_in, data, cache_dir, threads, collapse_mode="exact", backend="gevent", workers=1):
+    from xclib.cli import Cli
+    return Cli({
+        "projects": [p["name"] for p in data["projects"]],
+        "conductor_host": stand_in.host,
+        "conductor_port": stand_in.port,
+        "cache_dir": cache_dir,
+        "ssh_threads": threads,
+        "user": "bench",
+        "progressbar": False,
+        "ping_count": 2,
+        "mode": "collapse",
+        "collapse_mode": collapse_mode,
+        "exec_backend": backend,
+        "exec_workers": workers,
+    })
+
+
+def bench_hosts(count, modes, fake, threads, command, repeat, collapse_mode="exact", backends=("gevent",),
+                workers=(1,)):
+    data = generate(hosts=count, projects=1)
+    workdir = tempfile.mkdtemp(prefix="xcute_bench_")
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir)
+    fakessh.install(bindir)
+
+    payload = os.path.join(workdir, "payload")
+    with open(payload, "w") as f:
+        f.write("x" * 4096)
+
+    old_environ = dict(os.environ)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ.get("PATH", "")
+    os.environ.update(fake.as_env())
+
+    results = []
+    try:
+        with ConductorStandIn(data) as stand_in:
+            cli = make_cli(stand_in, data, os.path.join(workdir, "cache"), threads, collapse_mode)
+            cli.set_one_command_mode(True)
+            hosts = cli.conductor.resolve("*")
+
+            runners = {
+                "parallel": lambda: cli.run_parallel(hosts, command),
+                "collapse": lambda: cli.run_collapse(hosts, command),
+                "ping": lambda: cli.ping_parallel(hosts, cli.ping_count),
+                "distribute": lambda: cli.do_distribute("* %s" % payload),
+            }
+            for backend in backends:
+                for count in workers:
+                    cli.backend = backend
+                    cli.workers = count
+                    for mode in modes:
+                        if mode in NO_BACKEND_MODES and (backend, count) != (backends[0], workers[0]):
+                            # ping and distribute don't go through execution backends
+                            continue
+                        result = measure(silenced(runners[mode]), repeat)
+                        op = mode
+                        if mode not in NO_BACKEND_MODES:
+                            if len(backends) > 1:
+                                op += "/" + backend
+                            if len(workers) > 1:
+                                op += "/w%d" % count
+                        result.update(op=op, hosts=len(hosts), threads=threads)
+                        if result.get("wall"):
+                            result["hosts_per_sec"] = len(hosts) / result["wall"]
+                        results.append(result)
+    finally:
+        os.environ.clear()
+        os.environ.update(old_environ)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+def main():
+    parser = ArgumentParser(description="xcute execution engine benchmark")
+    parser.add_argument("--hosts", default="1000", help="comma-separated host counts")
+    parser.add_argument("-m", "--mode", dest="modes", action="append", choices=MODES,
+                        help="run mode to benchmark (default: all)")
+    parser.add_argument("--backend", dest="backends", action="append", choices=sorted(BACKENDS),
+                        help="execution backend to benchmark (default: %s)" % DEFAULT_BACKEND)
+    parser.add_argument("-w", "--workers", default="1", help="comma-separated exec_workers counts")
+    parser.add_argument("-t", "--threads", type=int, default=50, help="ssh_threads pool size")
+    parser.add_argument("-c", "--command", default="uptime", help="remote command")
+    parser.add_argument("--collapse-mode", default="exact", choices=("exact", "normalized"),
+                        help="collapse mode output grouping")
+    for key, value in sorted(fakessh.FakeParams.DEFAULTS.items()):
+        parser.add_argument("--" + key.replace("_", "-"), dest=key, type=type(value), default=value,
+                            help="fake %s (default %s)" % (key.replace("_", " "), value))
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="best of N runs")
+    parser.add_argument("-o", "--output", help="save JSON results to file")
+    parser.add_argument("-b", "--baseline", help="compare to JSON results from a previous run")
+    args = parser.parse_args()
+
+    fake = fakessh.FakeParams(**dict((key, getattr(args, key)) for key in fakessh.FakeParams.DEFAULTS))
+    modes = args.modes or MODES
+    results = []
+    for count in [int(x) for x in args.hosts.split(",")]:
+        results.extend(bench_hosts(count, modes, fake, args.threads, args.command, args.repeat,
+                                   args.collapse_mode, args.backends or [DEFAULT_BACKEND],
+                                   [int(x) for x in args.workers.split(",")]))
+
+    print_results(results, load_baseline(args.baseline))
+    params = fake.as_dict()
+    params.update(threads=args.threads, command=args.command, collapse_mode=args.collapse_mode,
+                  backends=args.backends or [DEFAULT_BACKEND], workers=args.workers)
+    save_report(args.output, report("execution", params, results))
+
+
+if __name__ == '__main__':
+    main()
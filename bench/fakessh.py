@@ -0,0 +1,185 @@
+"""
+Fake ssh/scp/ping executables for benchmarking the execution engines
+without a real fleet. install() puts wrappers named ssh, scp and ping into
+a directory which should be prepended to PATH; their behaviour is driven
+by FAKE_* environment variables (see FakeParams.DEFAULTS).
+"""
+from __future__ import print_function
+import os
+import random
+import stat
+import sys
+import time
+
+
+class FakeParams(object):
+
+    DEFAULTS = {
+        "latency": 0.05,        # mean connect + execution time, seconds
+        "jitter": 0.5,          # latency is spread uniformly by +/- jitter * latency
+        "lines": 5,             # stdout lines per host
+        "line_size": 60,        # bytes per line
+        "diversity": 1,         # number of distinct outputs, 0 means unique per host
+        "fail_rate": 0.0,       # share of hosts where the command exits 1
+        "connect_fail_rate": 0.0,  # share of hosts where "ssh" exits 255
+        "hang_rate": 0.0,       # share of hosts which hang for hang_time seconds
+        "hang_time": 30.0,
+        "read_stdin": 0,        # drain stdin before producing output
+        "seed": 42,
+    }
+
+    def __init__(self, **kwargs):
+        for key, value in self.DEFAULTS.items():
+            setattr(self, key, kwargs.get(key, value))
+
+    @classmethod
+    def from_env(cls, env=None):
+        env = env or os.environ
+        kwargs = {}
+        for key, value in cls.DEFAULTS.items():
+            env_key = "FAKE_" + key.upper()
+            if env_key in env:
+                kwargs[key] = type(value)(env[env_key])
+        return cls(**kwargs)
+
+    def as_env(self):
+        return dict(("FAKE_" + key.upper(), str(getattr(self, key))) for key in self.DEFAULTS)
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.DEFAULTS)
+
+
+WRAPPER = """#!/bin/sh
+exec "%(python)s" -S "%(script)s" %(name)s "$@"
+"""
+
+
+def install(directory):
+    script = os.path.abspath(__file__)
+    if script.endswith(".pyc"):
+        script = script[:-1]
+    for name in ("ssh", "scp", "ping"):
+        filename = os.path.join(directory, name)
+        with open(filename, "w") as f:
+            f.write(WRAPPER % {"python": sys.executable, "script": script, "name": name})
+        os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return directory
+
+
+SSH_OPTS_WITH_ARG = set("bcDEeFIiJLlmOopQRSWw")
+
+
+def parse_ssh_args(args):
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith("-") and len(arg) > 1:
+            if arg[-1] in SSH_OPTS_WITH_ARG and len(arg) == 2:
+                i += 1
+            i += 1
+            continue
+        return arg, " ".join(args[i + 1:])
+    return None, ""
+
+
+def host_random(params, host):
+    return random.Random("%s:%s" % (params.seed, host))
+
+
+def delay(params, rnd):
+    spread = params.latency * params.jitter
+    time.sleep(max(0.0, params.latency + rnd.uniform(-spread, spread)))
+
+
+def output_line(params, host, variant, num):
+    if params.diversity == 0:
+        prefix = "%s line %d " % (host, num)
+    else:
+        prefix = "variant %d line %d " % (variant, num)
+    return (prefix + "x" * params.line_size)[:params.line_size]
+
+
+def fake_ssh(params, args):
+    host, cmd = parse_ssh_args(args)
+    if host is None:
+        sys.stderr.write("usage: ssh host command\n")
+        return 255
+    rnd = host_random(params, host)
+    roll = rnd.random()
+
+    if roll < params.hang_rate:
+        time.sleep(params.hang_time)
+    delay(params, rnd)
+
+    roll = rnd.random()
+    if roll < params.connect_fail_rate:
+        sys.stderr.write("ssh: connect to host %s port 22: Connection timed out\n" % host)
+        return 255
+
+    if params.read_stdin:
+        while sys.stdin.read(65536):
+            pass
+
+    variant = rnd.randrange(params.diversity) if params.diversity > 0 else 0
+    out = sys.stdout
+    for num in xrange(params.lines):
+        out.write(output_line(params, host, variant, num) + "\n")
+    out.flush()
+
+    if rnd.random() < params.fail_rate:
+        sys.stderr.write("%s: command failed\n" % cmd.split()[0] if cmd else "command failed\n")
+        return 1
+    return 0
+
+
+def fake_scp(params, args):
+    target = args[-1] if args else ""
+    host = target.split(":")[0].split("@")[-1]
+    rnd = host_random(params, host)
+    if rnd.random() < params.hang_rate:
+        time.sleep(params.hang_time)
+    delay(params, rnd)
+    if rnd.random() < params.connect_fail_rate:
+        sys.stderr.write("ssh: connect to host %s port 22: Connection timed out\r\nlost connection\n" % host)
+        return 1
+    return 0
+
+
+def fake_ping(params, args):
+    count = 0
+    host = args[-1] if args else ""
+    if "-c" in args:
+        count = int(args[args.index("-c") + 1])
+    rnd = host_random(params, host)
+    dead = rnd.random() < params.connect_fail_rate
+    print("PING %s (127.0.0.1) 56(84) bytes of data." % host)
+    sys.stdout.flush()
+    seq = 0
+    while count == 0 or seq < count:
+        seq += 1
+        rtt = max(0.0001, params.latency * (1 + rnd.uniform(-params.jitter, params.jitter)))
+        time.sleep(rtt)
+        if not dead:
+            print("64 bytes from %s (127.0.0.1): icmp_seq=%d ttl=64 time=%.3f ms" % (host, seq, rtt * 1000))
+            sys.stdout.flush()
+    received = 0 if dead else seq
+    print("--- %s ping statistics ---" % host)
+    print("%d packets transmitted, %d received, %d%% packet loss" % (seq, received, 100 * (seq - received) / seq))
+    return 1 if dead else 0
+
+
+COMMANDS = {
+    "ssh": fake_ssh,
+    "scp": fake_scp,
+    "ping": fake_ping,
+}
+
+
+def main():
+    name = sys.argv[1]
+    params = FakeParams.from_env()
+    sys.exit(COMMANDS[name](params, sys.argv[2:]))
+
+
+if __name__ == '__main__':
+    main()
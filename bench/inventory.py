@@ -0,0 +1,172 @@
+"""
+Synthetic executer_data generator. Produces payloads shaped exactly like
+conductor's /api/v1/open/executer_data response so the conductor layer can
+be benchmarked without a real conductor installation.
+"""
+import random
+
+
+class InventoryParams(object):
+
+    DEFAULTS = {
+        "hosts": 1000,
+        "projects": 4,
+        "group_depth": 3,
+        "group_fanout": 4,
+        "group_extra_parents": 0.1,
+        "tags": 50,
+        "tags_per_host": 3,
+        "field_keys": 5,
+        "field_values": 20,
+        "dc_roots": 2,
+        "dc_depth": 3,
+        "dc_fanout": 3,
+        "seed": 42,
+    }
+
+    def __init__(self, **kwargs):
+        for key, value in self.DEFAULTS.items():
+            setattr(self, key, kwargs.get(key, value))
+
+    def as_dict(self):
+        return dict((key, getattr(self, key)) for key in self.DEFAULTS)
+
+
+def _oid(prefix, num):
+    return "%s%023x" % (prefix, num)
+
+
+def generate_datacenters(params):
+    datacenters = []
+    leaves = []
+
+    def make(name, parent, root, depth):
+        dc = {
+            "_id": _oid("d", len(datacenters)),
+            "name": name,
+            "human_readable": name.upper(),
+            "parent_id": parent["_id"] if parent else None,
+            "root_id": root["_id"] if root else None,
+            "child_ids": [],
+        }
+        datacenters.append(dc)
+        if parent:
+            parent["child_ids"].append(dc["_id"])
+        if depth + 1 >= params.dc_depth:
+            leaves.append(dc)
+            return
+        for i in xrange(params.dc_fanout):
+            make("%s-%d" % (name, i), dc, root or dc, depth + 1)
+
+    for i in xrange(params.dc_roots):
+        make("dc%d" % i, None, None, 0)
+
+    return datacenters, leaves
+
+
+def generate_groups(params, rnd):
+    projects = []
+    groups = []
+    leaves = []
+
+    for p in xrange(params.projects):
+        project = {
+            "_id": _oid("p", p),
+            "name": "project%d" % p,
+            "description": "synthetic project %d" % p,
+            "email": "project%d@example.com" % p,
+            "root_email": "root@example.com",
+            "owner_id": None,
+        }
+        projects.append(project)
+
+        level = []
+        root = {
+            "_id": _oid("g", len(groups)),
+            "name": "p%d" % p,
+            "description": "",
+            "project_id": project["_id"],
+            "parent_ids": [],
+            "child_ids": [],
+        }
+        groups.append(root)
+        level.append(root)
+
+        for depth in xrange(1, params.group_depth):
+            next_level = []
+            for parent in level:
+                for i in xrange(params.group_fanout):
+                    group = {
+                        "_id": _oid("g", len(groups)),
+                        "name": "%s-%d" % (parent["name"], i),
+                        "description": "",
+                        "project_id": project["_id"],
+                        "parent_ids": [parent["_id"]],
+                        "child_ids": [],
+                    }
+                    parent["child_ids"].append(group["_id"])
+                    # occasional second parent turns the tree into a DAG
+                    if len(level) > 1 and rnd.random() < params.group_extra_parents:
+                        other = rnd.choice(level)
+                        if other is not parent:
+                            group["parent_ids"].append(other["_id"])
+                            other["child_ids"].append(group["_id"])
+                    groups.append(group)
+                    next_level.append(group)
+            level = next_level
+        leaves.extend(level)
+
+    return projects, groups, leaves
+
+
+def generate(params=None, **kwargs):
+    if params is None:
+        params = InventoryParams(**kwargs)
+    rnd = random.Random(params.seed)
+
+    datacenters, dc_leaves = generate_datacenters(params)
+    projects, groups, group_leaves = generate_groups(params, rnd)
+
+    tags = ["tag%d" % i for i in xrange(params.tags)]
+    field_keys = ["key%d" % i for i in xrange(params.field_keys)]
+    tags_per_host = min(params.tags_per_host, params.tags)
+
+    hosts = []
+    for i in xrange(params.hosts):
+        group = group_leaves[i % len(group_leaves)]
+        dc = dc_leaves[rnd.randrange(len(dc_leaves))]
+        hosts.append({
+            "_id": _oid("h", i),
+            "fqdn": "host%06d.%s.%s.example.com" % (i, group["name"], dc["name"]),
+            "short_name": "host%06d" % i,
+            "group_id": group["_id"],
+            "datacenter_id": dc["_id"],
+            "description": "",
+            "all_tags": rnd.sample(tags, tags_per_host),
+            "all_custom_fields": [{"key": key, "value": "v%d" % rnd.randrange(params.field_values)}
+                                  for key in field_keys],
+        })
+
+    return {
+        "datacenters": datacenters,
+        "projects": projects,
+        "groups": groups,
+        "hosts": hosts,
+    }
+
+
+def filter_projects(data, names):
+    """
+    Returns the part of the payload conductor would send for ?projects=names
+    """
+    projects = [p for p in data["projects"] if p["name"] in names]
+    project_ids = set([p["_id"] for p in projects])
+    groups = [g for g in data["groups"] if g["project_id"] in project_ids]
+    group_ids = set([g["_id"] for g in groups])
+    hosts = [h for h in data["hosts"] if h["group_id"] in group_ids]
+    return {
+        "datacenters": data["datacenters"],
+        "projects": projects,
+        "groups": groups,
+        "hosts": hosts,
+    }
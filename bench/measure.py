@@ -0,0 +1,137 @@
+"""
+Wall time / peak memory measurement helpers shared by the benchmarks.
+Every measured operation runs in a forked child so peak RSS is attributed
+to that operation only and the parent state stays untouched.
+"""
+from __future__ import print_function
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def memory_kb():
+    """
+    Returns (current RSS, peak RSS) in kilobytes
+    """
+    rss = hwm = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+                elif line.startswith("VmHWM:"):
+                    hwm = int(line.split()[1])
+    except IOError:
+        pass
+    if rss is None or hwm is None:
+        # no procfs: ru_maxrss is the best approximation available
+        rss = hwm = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss, hwm
+
+
+def measure(func, repeat=1):
+    best = None
+    for _ in xrange(repeat):
+        result = _measure_once(func)
+        if best is None or result["wall"] < best["wall"]:
+            best = result
+    return best
+
+
+def _measure_once(func):
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        code = 0
+        try:
+            gc.collect()
+            rss, _ = memory_kb()
+            started = time.time()
+            extra = func()
+            wall = time.time() - started
+            _, hwm = memory_kb()
+            result = {
+                "wall": wall,
+                "peak_rss_kb": hwm - rss,
+            }
+            if isinstance(extra, dict):
+                result.update(extra)
+        except Exception as e:
+            result = {"error": "%s: %s" % (e.__class__.__name__, e)}
+            code = 1
+        with os.fdopen(wfd, "w") as wf:
+            wf.write(json.dumps(result))
+        os._exit(code)
+
+    os.close(wfd)
+    with os.fdopen(rfd) as rf:
+        data = rf.read()
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def commit_id():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def report(name, params, results):
+    return {
+        "benchmark": name,
+        "commit": commit_id(),
+        "python": sys.version.split()[0],
+        "ts": time.time(),
+        "params": params,
+        "results": results,
+    }
+
+
+METRICS = ("wall", "peak_rss_kb", "error", "found")
+
+
+def result_key(result):
+    return tuple(sorted((k, v) for k, v in result.items() if k not in METRICS
+                        and not isinstance(v, (float, dict, list))))
+
+
+def print_results(results, baseline=None):
+    base = {}
+    if baseline:
+        for item in baseline["results"]:
+            base[result_key(item)] = item
+
+    for item in results:
+        name = " ".join("%s=%s" % (k, v) for k, v in result_key(item))
+        if "error" in item:
+            print("%-60s ERROR %s" % (name, item["error"]))
+            continue
+        line = "%-60s %10.4fs %10d KB" % (name, item["wall"], item["peak_rss_kb"])
+        for key in sorted(item):
+            if key not in METRICS and isinstance(item[key], float):
+                line += " %s=%.1f" % (key, item[key])
+        prev = base.get(result_key(item))
+        if prev and "wall" in prev and prev["wall"] > 0:
+            line += "  %+7.1f%% time" % ((item["wall"] - prev["wall"]) * 100.0 / prev["wall"])
+        print(line)
+
+
+def load_baseline(filename):
+    if not filename:
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_report(filename, data):
+    if not filename:
+        return
+    with open(filename, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
@@ -0,0 +1,115 @@
+"""
+Local HTTP stand-in for conductor serving synthetic executer_data
+"""
+import gzip
+import json
+import time
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+from urlparse import urlparse, parse_qs
+from bench.inventory import filter_projects
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ExecuterDataHandler(BaseHTTPRequestHandler):
+
+    PATH = "/api/v1/open/executer_data"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != self.PATH:
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        names = ",".join(query.get("projects", [""])).split(",")
+        stand_in = self.server.stand_in
+        if stand_in.latency:
+            time.sleep(stand_in.latency)
+        if stand_in.take_error():
+            self.send_error(503)
+            return
+        body = stand_in.payload(names)
+        stand_in.count_request()
+
+        headers = {"Content-Type": "application/json"}
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=1) as gz:
+                gz.write(body)
+            body = buf.getvalue()
+            headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = str(len(body))
+
+        self.send_response(200)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ConductorStandIn(object):
+
+    def __init__(self, data, host="127.0.0.1", port=0, latency=0.0, errors=0):
+        self.data = data
+        self.requests = 0
+        self.latency = latency
+        self.errors = errors
+        self.__payloads = {}
+        self.__lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), ExecuterDataHandler)
+        self.server.stand_in = self
+        self.thread = None
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def count_request(self):
+        with self.__lock:
+            self.requests += 1
+
+    def take_error(self):
+        """
+        True for the first `errors` requests, which get 503 to exercise retries
+        """
+        with self.__lock:
+            if self.errors <= 0:
+                return False
+            self.errors -= 1
+            return True
+
+    def payload(self, names):
+        key = tuple(sorted(names))
+        with self.__lock:
+            if key not in self.__payloads:
+                data = filter_projects(self.data, set(names))
+                self.__payloads[key] = json.dumps({"data": data})
+            return self.__payloads[key]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,153 @@
+"""
+Cold start benchmark for one-shot x invocations. Fails (exit code 1) when
+the median start time exceeds the budget or when heavy modules get
+imported by a command which doesn't need them.
+
+    python -m bench.startup --budget 0.1
+
+With --daemon the commands are also timed against a running `x --daemon`.
+"""
+from __future__ import print_function
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from bench.inventory import generate
+from bench.measure import report, print_results, load_baseline, save_report
+from bench.server import ConductorStandIn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+X = os.path.join(ROOT, "x")
+
+HEAVY_MODULES = ("gevent", "pyparsing", "requests", "readline", "gnureadline", "progressbar")
+
+CONFIG = """[main]
+conductor_host = {host}
+conductor_port = {port}
+projects = {projects}
+user = bench
+"""
+
+IMPORTS_PROBE = """
+import sys
+sys.argv = [%(x)r] + %(args)r
+sys.path.insert(0, %(root)r)
+try:
+    execfile(%(x)r, {"__name__": "__main__"})
+finally:
+    heavy = [m for m in %(heavy)r if m in sys.modules]
+    sys.stderr.write("HEAVY:" + ",".join(heavy) + "\\n")
+"""
+
+COMMANDS = [
+    ["hostlist", "%p0-1"],
+    ["hostlist", "*project0@dc0#tag1"],
+]
+
+
+def run_once(env, args):
+    started = time.time()
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call([sys.executable, X] + args, env=env, stdout=devnull, cwd=ROOT)
+    return time.time() - started
+
+
+def heavy_imports(env, args):
+    script = IMPORTS_PROBE % {"x": X, "args": args, "root": ROOT, "heavy": HEAVY_MODULES}
+    p = subprocess.Popen([sys.executable, "-c", script], env=env, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE, cwd=ROOT)
+    _, err = p.communicate()
+    for line in err.splitlines():
+        if line.startswith("HEAVY:"):
+            return [x for x in line[6:].split(",") if x]
+    return None
+
+
+def start_daemon(env, home):
+    with open(os.devnull, "w") as devnull:
+        daemon = subprocess.Popen([sys.executable, X, "--daemon"], env=env, stdout=devnull, cwd=ROOT)
+    socket_path = os.path.join(home, ".xcute_cache", "xcute.sock")
+    deadline = time.time() + 60
+    while not os.path.exists(socket_path):
+        if daemon.poll() is not None or time.time() > deadline:
+            raise RuntimeError("daemon didn't start")
+        time.sleep(0.05)
+    return daemon
+
+
+def main():
+    parser = ArgumentParser(description="xcute one-shot startup benchmark")
+    parser.add_argument("--hosts", type=int, default=1000, help="inventory size")
+    parser.add_argument("-n", "--runs", type=int, default=10, help="runs per command")
+    parser.add_argument("--budget", type=float, default=0.1,
+                        help="median start time budget over the bare interpreter start, seconds")
+    parser.add_argument("--daemon", action="store_true", help="also time commands served by a running daemon")
+    parser.add_argument("-o", "--output", help="save JSON results to file")
+    parser.add_argument("-b", "--baseline", help="compare to JSON results from a previous run")
+    args = parser.parse_args()
+
+    data = generate(hosts=args.hosts)
+    home = tempfile.mkdtemp(prefix="xcute_bench_")
+    results = []
+    failed = False
+    daemon = None
+    try:
+        with ConductorStandIn(data) as stand_in:
+            with open(os.path.join(home, ".xcute.conf"), "w") as f:
+                f.write(CONFIG.format(host=stand_in.host, port=stand_in.port,
+                                      projects=",".join(p["name"] for p in data["projects"])))
+            env = dict(os.environ)
+            env["HOME"] = home
+            env["PYTHONPATH"] = ROOT
+
+            # warm up the inventory cache: cold start means a cold interpreter, not an empty cache
+            run_once(env, COMMANDS[0])
+
+            interpreter = []
+            for _ in xrange(args.runs):
+                started = time.time()
+                subprocess.check_call([sys.executable, "-c", "pass"], env=env)
+                interpreter.append(time.time() - started)
+            base = sorted(interpreter)[len(interpreter) / 2]
+
+            runs = [(command, "") for command in COMMANDS]
+            if args.daemon:
+                daemon = start_daemon(env, home)
+                runs += [(command, " (daemon)") for command in COMMANDS]
+            for command, suffix in runs:
+                x_args = ["--local"] + command if args.daemon and not suffix else command
+                times = sorted(run_once(env, x_args) for _ in xrange(args.runs))
+                median = times[len(times) / 2]
+                heavy = heavy_imports(env, x_args)
+                result = {
+                    "op": " ".join(command) + suffix,
+                    "hosts": args.hosts,
+                    "wall": median,
+                    "peak_rss_kb": 0,
+                    "overhead": (median - base) * 1000,
+                    "heavy_imports": heavy,
+                }
+                results.append(result)
+                if median - base > args.budget:
+                    print("FAIL: '%s' takes %.3fs over interpreter start, budget is %.3fs" %
+                          (" ".join(command), median - base, args.budget))
+                    failed = True
+                if heavy:
+                    print("FAIL: '%s' imports %s" % (" ".join(command), ", ".join(heavy)))
+                    failed = True
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        shutil.rmtree(home, ignore_errors=True)
+
+    print_results(results, load_baseline(args.baseline))
+    save_report(args.output, report("startup", {"hosts": args.hosts, "budget": args.budget}, results))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
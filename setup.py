@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name="Xcute",
     version="0.9.1",
-    packages=find_packages(),
+    packages=find_packages(exclude=["bench", "bench.*"]),
     scripts=["x"],
     install_requires=["gevent", "requests", "termcolor", "progressbar", "gnureadline", "pyparsing"],
     author="Pavel Vorobyov",
@@ -0,0 +1,26 @@
+import os
+import cPickle as pickle
+
+
+def atomic_pickle(path, data, prefix, persistent_id=None):
+    """
+    Pickles data to a temporary file next to path and renames it over
+    path, so concurrent readers never see a partially written file.
+    `persistent_id` is set as the pickler's inst_persistent_id if given.
+    """
+    # only needed when a cache gets written, one-shot commands skip it
+    import tempfile
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path), prefix=prefix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+            if persistent_id is not None:
+                pickler.inst_persistent_id = persistent_id
+            pickler.dump(data)
+        os.rename(tmpname, path)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+        raise
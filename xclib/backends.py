@@ -0,0 +1,836 @@
+import os
+import sys
+import time
+import errno
+import fcntl
+import heapq
+import random
+import select
+import signal
+import struct
+import traceback
+import cPickle as pickle
+from collections import deque, defaultdict
+from xclib.timing import timing
+from xclib.health import is_transport_error
+
+
+class RetryPolicy(object):
+    """
+    Decides which failed processes run again: only transport failures,
+    i.e. ssh exited with 255 and its stderr says the host wasn't reached.
+    A command failing on the host, even with 255, is never retried.
+    Delays grow exponentially with full jitter, so hosts dropped by the
+    same network hiccup don't come back at once, and retries are limited
+    both per host and per run.
+    """
+
+    def __init__(self, per_host, budget, delay=1.0, max_delay=30.0):
+        self.per_host = per_host
+        self.budget = budget
+        self.delay = delay
+        self.max_delay = max_delay
+        self.retries = {}
+        self.used = 0
+
+    def backoff(self, host, code, errors):
+        """
+        Returns seconds to wait before retrying the host or None
+        """
+        if code != 255 or not is_transport_error(errors):
+            return None
+        retries = self.retries.get(host, 0)
+        if retries >= self.per_host or self.used >= self.budget:
+            return None
+        self.retries[host] = retries + 1
+        self.used += 1
+        return random.uniform(0, min(self.max_delay, self.delay * 2 ** retries))
+
+    def attempts(self, host):
+        return self.retries.get(host, 0) + 1
+
+    def split(self, parts):
+        """
+        A policy for one of `parts` shards of the run
+        """
+        return RetryPolicy(self.per_host, -(-self.budget // parts), self.delay, self.max_delay)
+
+
+class Caps(object):
+    """
+    Concurrency caps of buckets of hosts (a datacenter, a group): buckets
+    maps a host to the keys of its buckets, limits maps a key to the
+    number of the bucket's hosts allowed to run at once. Buckets without
+    a limit aren't capped.
+    """
+
+    def __init__(self, buckets, limits):
+        self.buckets = buckets
+        self.limits = limits
+
+    def capped(self, host):
+        return tuple(key for key in self.buckets.get(host, ()) if key in self.limits)
+
+    def split(self, parts):
+        """
+        Caps for one of `parts` shards of the run. A bucket keeps at least
+        one host running in every shard, so caps below the number of
+        shards are exceeded.
+        """
+        return Caps(self.buckets, dict((key, max(limit // parts, 1)) for key, limit in self.limits.items()))
+
+
+class JobQueue(object):
+    """
+    Jobs waiting to be started. Without caps it's a plain FIFO. With caps
+    a job whose bucket is full waits, and the next job with room in all
+    its buckets is started instead, so the pool stays as full as the
+    caps allow. Jobs sharing the same buckets are queued together and
+    only the queues with room are looked at, keeping pop() cheap when
+    most of the hosts are held back.
+    """
+
+    def __init__(self, jobs, caps=None):
+        self.caps = caps
+        self.size = 0
+        self.running = defaultdict(int)
+        self.queues = defaultdict(deque)
+        # (seq of the head job, buckets) of the queues which may have room
+        self.ready = []
+        # full bucket -> queues waiting for it
+        self.blocked = defaultdict(set)
+        self.first = 0
+        if caps is None:
+            self.queues[()] = deque(jobs)
+            self.size = len(self.queues[()])
+            return
+        for seq, (host, argv) in enumerate(jobs):
+            self.queues[caps.capped(host)].append((seq, host, argv))
+            self.size += 1
+        for buckets, queue in self.queues.items():
+            heapq.heappush(self.ready, (queue[0][0], buckets))
+
+    def __len__(self):
+        return self.size
+
+    def push_front(self, jobs):
+        """
+        Queues jobs to be started before anything else, retries have
+        waited already
+        """
+        if self.caps is None:
+            self.queues[()].extendleft(reversed(jobs))
+            self.size += len(jobs)
+            return
+        for host, argv in reversed(jobs):
+            self.first -= 1
+            buckets = self.caps.capped(host)
+            self.queues[buckets].appendleft((self.first, host, argv))
+            heapq.heappush(self.ready, (self.first, buckets))
+            self.size += 1
+
+    def pop(self):
+        """
+        Returns the next job to start or None if there is none or all of
+        them wait for their buckets
+        """
+        if self.caps is None:
+            if not self.size:
+                return None
+            self.size -= 1
+            return self.queues[()].popleft()
+        while self.ready:
+            seq, buckets = heapq.heappop(self.ready)
+            queue = self.queues[buckets]
+            if not queue or queue[0][0] != seq:
+                # stale, the queue has got another head meanwhile
+                continue
+            full = [key for key in buckets if self.running[key] >= self.caps.limits[key]]
+            if full:
+                self.blocked[full[0]].add(buckets)
+                continue
+            _, host, argv = queue.popleft()
+            for key in buckets:
+                self.running[key] += 1
+            if queue:
+                heapq.heappush(self.ready, (queue[0][0], buckets))
+            self.size -= 1
+            return host, argv
+        return None
+
+    def done(self, host):
+        """
+        Frees the host's slots in its buckets
+        """
+        if self.caps is None:
+            return
+        for key in self.caps.capped(host):
+            self.running[key] -= 1
+            for buckets in self.blocked.pop(key, ()):
+                queue = self.queues[buckets]
+                if queue:
+                    heapq.heappush(self.ready, (queue[0][0], buckets))
+
+
+class Backend(object):
+    """
+    Runs one process per host, at most `concurrency` at a time, and
+    reports what they do through callbacks:
+
+        on_output(host, stream, data)  a chunk of "out" or "err"
+        on_retry(host, code, delay)    the attempt failed and will be retried,
+                                       its output is to be discarded
+        on_exit(host, code)            after all the host's output
+
+    The payload, if any, is fed to the stdin of every process. On
+    KeyboardInterrupt the running processes are killed and the
+    interrupt is re-raised, hosts not started yet are never started.
+
+    With a RetryPolicy, hosts failing at the transport level are put back
+    into the same pool after a backoff delay, on_exit is only called for
+    the final attempt. With Caps, hosts of a full bucket wait while
+    others are started (see JobQueue).
+
+    A callback may call stop() to end the run early: hosts not started
+    yet are never started and the running ones are killed, neither are
+    reported. Hosts which have exited or closed their output are given
+    FINISH_GRACE seconds to finish and be reported. stop() takes effect
+    in the process calling it, so it's not available with ShardedBackend.
+
+    cancel() may be called from another thread (or a signal handler) to
+    abandon the run: hosts not started yet are never started and the
+    running processes are killed at once, without FINISH_GRACE.
+
+    When the jobs are sharded across worker processes (see
+    ShardedBackend) on_output, on_retry and on_exit run in the workers,
+    so the callers split their bookkeeping: on_done(host, code, attempts)
+    always runs in the calling process, and the state collect() returns
+    in every worker is passed to merge() in the caller at the end.
+    """
+
+    name = None
+    CHUNK_SIZE = 65536
+    # stderr kept per process to tell transport failures
+    ERRORS_TAIL = 4096
+    # how long stop() waits for processes which have exited or closed their output
+    FINISH_GRACE = 1.0
+
+    def __init__(self, concurrency, retry=None, caps=None):
+        self.concurrency = max(int(concurrency), 1)
+        self.retry = retry
+        self.caps = caps
+        self.stopped = False
+        self.cancelled = False
+        # host -> running process and a thread-safe way to wake the
+        # event loop, for cancel()
+        self.processes = {}
+        self.wakeup = None
+
+    def run(self, jobs, on_output, on_exit, payload=None, on_done=None, collect=None, merge=None,
+            on_retry=None):
+        """
+        jobs is an iterable of (host, argv)
+        """
+        def exited(host, code):
+            on_exit(host, code)
+            if on_done is not None:
+                on_done(host, code, self.attempts(host))
+        self.stopped = False
+        self.cancelled = False
+        self.execute(jobs, on_output, exited, payload, on_retry)
+
+    def stop(self):
+        self.stopped = True
+        # e.g. called from on_output while the loop waits for an exit
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def cancel(self):
+        self.stopped = True
+        self.cancelled = True
+        # no waiting here, the process is reaped by the thread running it
+        for p in self.processes.values():
+            try:
+                os.kill(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        # children of a killed process may keep its pipes open
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def execute(self, jobs, on_output, on_exit, payload, on_retry):
+        raise NotImplementedError()
+
+    def attempts(self, host):
+        return self.retry.attempts(host) if self.retry is not None else 1
+
+    def backoff(self, host, code, errors, on_retry):
+        """
+        Seconds to wait before the host is retried or None
+        """
+        if self.retry is None or self.stopped:
+            return None
+        delay = self.retry.backoff(host, code, errors)
+        if delay is not None and on_retry is not None:
+            on_retry(host, code, delay)
+        return delay
+
+    @staticmethod
+    def due(retries):
+        """
+        Pops the delayed jobs whose time has come
+        """
+        now = time.time()
+        jobs = []
+        while retries and retries[0][0] <= now:
+            _, host, argv = heapq.heappop(retries)
+            jobs.append((host, argv))
+        return jobs
+
+
+class GeventBackend(Backend):
+    """
+    A greenlet per process (and per stdin feeder) over gevent.subprocess
+    """
+
+    name = "gevent"
+
+    def execute(self, jobs, on_output, on_exit, payload, on_retry):
+        from gevent import Greenlet, spawn, get_hub
+        from gevent.event import Event
+        from gevent.pool import Pool
+        from gevent.select import select
+        from gevent.subprocess import Popen, PIPE
+
+        processes = self.processes
+        # processes which have closed their output
+        finishing = {}
+        killed = set()
+        retries = []
+        queue = JobQueue(jobs, self.caps)
+        # set whenever a worker is done, having freed its slots or delayed a retry
+        changed = Event()
+        wakeup = get_hub().loop.async_()
+        wakeup.start(changed.set)
+        self.wakeup = wakeup.send
+
+        def worker(host, argv):
+            if self.stopped:
+                return
+            with timing.timer("exec.spawn"):
+                p = Popen(argv, stdout=PIPE, stderr=PIPE, stdin=PIPE if payload is not None else None,
+                          close_fds=True)
+            processes[host] = p
+            feeder = spawn(payload.feed, p.stdin) if payload is not None else None
+            streams = {p.stdout.fileno(): "out", p.stderr.fileno(): "err"}
+            errors = ""
+            while streams:
+                ready, _, _ = select(list(streams), [], [])
+                for fd in ready:
+                    try:
+                        data = os.read(fd, self.CHUNK_SIZE)
+                    except OSError as e:
+                        if e.errno == errno.EAGAIN:
+                            continue
+                        raise
+                    if data:
+                        if streams[fd] == "err":
+                            errors = (errors + data)[-self.ERRORS_TAIL:]
+                        if host not in killed:
+                            on_output(host, streams[fd], data)
+                    else:
+                        del(streams[fd])
+            # the output is complete, stop() lets it finish
+            finishing[host] = processes.pop(host)
+            if feeder is not None:
+                feeder.join()
+            p.wait()
+            del(finishing[host])
+            queue.done(host)
+            if host in killed:
+                return
+            delay = self.backoff(host, p.returncode, errors, on_retry)
+            if delay is not None:
+                heapq.heappush(retries, (time.time() + delay, host, argv))
+                return
+            on_exit(host, p.returncode)
+
+        def abort(stopped):
+            for host, p in stopped:
+                killed.add(host)
+                kill(p)
+            # children of a killed process may keep its pipes open, don't wait for EOF
+            for greenlet in list(pool):
+                # finished greenlets have their args cleared
+                if greenlet.args and greenlet.args[0] in killed:
+                    greenlet.kill()
+            for host, p in stopped:
+                p.stdout.close()
+                p.stderr.close()
+
+        pool = Pool(self.concurrency)
+        try:
+            while True:
+                changed.clear()
+                if self.stopped:
+                    if not self.cancelled:
+                        abort([(host, p) for host, p in processes.items() if p.poll() is None])
+                        # the others have exited or closed their output
+                        pool.join(timeout=self.FINISH_GRACE)
+                    abort(processes.items() + finishing.items())
+                    break
+                queue.push_front(self.due(retries))
+                while pool.free_count() > 0:
+                    job = queue.pop()
+                    if job is None:
+                        break
+                    greenlet = Greenlet(worker, *job)
+                    pool.start(greenlet)
+                    # linked after the pool, which has discarded it by then
+                    greenlet.rawlink(lambda g: changed.set())
+                if not queue and not retries and not len(pool):
+                    break
+                changed.wait(max(retries[0][0] - time.time(), 0) if retries else None)
+        except KeyboardInterrupt:
+            pool.kill(block=False)
+            for p in processes.values():
+                kill(p)
+            raise
+        finally:
+            self.wakeup = None
+            wakeup.close()
+
+
+class PollProcess(object):
+
+    __slots__ = ("host", "argv", "p", "outputs", "offset", "errors")
+
+    def __init__(self, host, argv, p):
+        self.host = host
+        self.argv = argv
+        self.p = p
+        self.outputs = 0
+        self.offset = 0
+        self.errors = ""
+
+
+class PollBackend(Backend):
+    """
+    A single-threaded event loop: plain subprocesses with non-blocking
+    pipes multiplexed by poll(2), no greenlets and no monkey patching.
+    This is what an asyncio subprocess engine does, in the terms
+    available to Python 2.
+    """
+
+    name = "poll"
+    # while finished processes haven't been reaped yet
+    REAP_INTERVAL = 10
+
+    def execute(self, jobs, on_output, on_exit, payload, on_retry):
+        import subprocess
+
+        pending = JobQueue(jobs, self.caps)
+        running = set()
+        retries = []
+        fds = {}
+        poller = select.poll()
+        # stop() and cancel() write here to get the loop out of poll()
+        wakeup_r, wakeup_w = os.pipe()
+        poller.register(wakeup_r, select.POLLIN)
+        self.wakeup = lambda: os.write(wakeup_w, "x")
+
+        def register(fd, process, stream, events):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            fds[fd] = (process, stream)
+            poller.register(fd, events)
+            if stream != "in":
+                process.outputs += 1
+
+        def close(fd):
+            process, stream = fds.pop(fd)
+            poller.unregister(fd)
+            if stream != "in":
+                process.outputs -= 1
+            getattr(process.p, {"out": "stdout", "err": "stderr", "in": "stdin"}[stream]).close()
+
+        def start(host, argv):
+            with timing.timer("exec.spawn"):
+                p = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     stdin=subprocess.PIPE if payload is not None else None,
+                                     close_fds=True)
+            process = PollProcess(host, argv, p)
+            running.add(process)
+            self.processes[host] = p
+            register(p.stdout.fileno(), process, "out", select.POLLIN)
+            register(p.stderr.fileno(), process, "err", select.POLLIN)
+            if payload is not None:
+                fd = p.stdin.fileno()
+                register(fd, process, "in", select.POLLOUT)
+                if len(payload) == 0:
+                    close(fd)
+
+        def write(fd):
+            process = fds[fd][0]
+            try:
+                process.offset += os.write(fd, payload.chunk(process.offset))
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                if e.errno not in (errno.EPIPE, errno.EINVAL):
+                    raise
+                # the command doesn't want (the rest of) its input
+                process.offset = len(payload)
+            if process.offset >= len(payload):
+                close(fd)
+
+        def read(fd):
+            process, stream = fds[fd]
+            try:
+                data = os.read(fd, self.CHUNK_SIZE)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            if data:
+                if stream == "err":
+                    process.errors = (process.errors + data)[-self.ERRORS_TAIL:]
+                on_output(process.host, stream, data)
+            else:
+                close(fd)
+
+        def reap():
+            for process in list(running):
+                if process.outputs or process.p.poll() is None:
+                    continue
+                # stdin is still open if the command exited without reading all of it
+                stdin = process.p.stdin
+                if stdin is not None and not stdin.closed:
+                    close(stdin.fileno())
+                running.remove(process)
+                del(self.processes[process.host])
+                pending.done(process.host)
+                delay = self.backoff(process.host, process.p.returncode, process.errors, on_retry)
+                if delay is not None:
+                    heapq.heappush(retries, (time.time() + delay, process.host, process.argv))
+                    continue
+                on_exit(process.host, process.p.returncode)
+
+        def dispatch(timeout):
+            try:
+                events = poller.poll(timeout)
+            except select.error as e:
+                # SIGCHLD, e.g. with gevent's child watcher installed by an earlier run
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for fd, event in events:
+                if fd == wakeup_r:
+                    os.read(wakeup_r, 4096)
+                    continue
+                if fd not in fds:
+                    continue
+                if fds[fd][1] == "in":
+                    write(fd)
+                else:
+                    read(fd)
+
+        def abort(stopped):
+            for process in stopped:
+                kill(process.p)
+                running.remove(process)
+                del(self.processes[process.host])
+                for fd, (owner, _) in fds.items():
+                    if owner is process:
+                        close(fd)
+
+        def timeout():
+            waiting = any(not p.outputs for p in running)
+            wait = self.REAP_INTERVAL if waiting else -1
+            if retries:
+                delay = int(max(retries[0][0] - time.time(), 0) * 1000) + 1
+                wait = delay if wait < 0 else min(wait, delay)
+            return wait
+
+        try:
+            while pending or running or retries:
+                if self.stopped:
+                    abort([process for process in running if process.outputs and process.p.poll() is None])
+                    # the others have exited or closed their output
+                    deadline = time.time() + (0 if self.cancelled else self.FINISH_GRACE)
+                    while running and time.time() < deadline:
+                        dispatch(10)
+                        reap()
+                    abort(list(running))
+                    break
+                pending.push_front(self.due(retries))
+                while len(running) < self.concurrency:
+                    job = pending.pop()
+                    if job is None:
+                        break
+                    start(*job)
+                dispatch(timeout())
+                reap()
+        except KeyboardInterrupt:
+            for process in running:
+                kill(process.p)
+            raise
+        finally:
+            self.wakeup = None
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+            for fd in list(fds):
+                close(fd)
+
+
+def kill(p):
+    try:
+        p.kill()
+        p.wait()
+    except OSError:
+        pass
+
+
+class LineSplitter(object):
+    """
+    Reassembles complete lines from the output chunks of every
+    (host, stream), keeping the line ends
+    """
+
+    def __init__(self):
+        self.tails = {}
+
+    def feed(self, key, data):
+        if "\n" not in data:
+            # parts are joined once, long lines don't cost quadratic time
+            self.tails.setdefault(key, []).append(data)
+            return []
+        lines = data.split("\n")
+        tail = self.tails.pop(key, None)
+        if tail:
+            lines[0] = "".join(tail) + lines[0]
+        last = lines.pop()
+        if last:
+            self.tails[key] = [last]
+        return [line + "\n" for line in lines]
+
+    def flush(self, key):
+        tail = "".join(self.tails.pop(key, ()))
+        return [tail] if tail else []
+
+class ShardedBackend(Backend):
+    """
+    Splits the jobs across forked worker processes, each running its own
+    backend with its share of the concurrency, so pipe reads, output
+    formatting and collapse bookkeeping use all cores. Workers report
+    exits as they happen and their collected state when they're done.
+    """
+
+    # sharding a few hosts costs more than it saves
+    MIN_JOBS_PER_WORKER = 200
+
+    def __init__(self, backend, workers):
+        Backend.__init__(self, backend.concurrency, backend.retry, backend.caps)
+        self.backend = backend
+        self.workers = workers
+        self.name = backend.name
+        self.pids = []
+
+    def cancel(self):
+        Backend.cancel(self)
+        self.backend.cancel()
+        # workers cancel their backends on SIGTERM, see worker()
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self, jobs, on_output, on_exit, payload=None, on_done=None, collect=None, merge=None,
+            on_retry=None):
+        jobs = list(jobs)
+        workers = min(self.workers, len(jobs) // self.MIN_JOBS_PER_WORKER)
+        if workers < 2:
+            return self.backend.run(jobs, on_output, on_exit, payload, on_done, on_retry=on_retry)
+
+        concurrency = max(self.concurrency // workers, 1)
+        # buffered output would be written by every worker again
+        sys.stdout.flush()
+        sys.stderr.flush()
+        children = {}
+        for num in xrange(workers):
+            rfd, wfd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(rfd)
+                for fd in children:
+                    os.close(fd)
+                self.worker(wfd, jobs[num::workers], concurrency, on_output, on_exit, payload, collect,
+                            on_retry, workers)
+            os.close(wfd)
+            children[rfd] = (pid, FrameReader())
+            self.pids.append(pid)
+
+        results = []
+        interrupted = False
+        while children:
+            try:
+                ready, _, _ = select.select(list(children), [], [])
+                for fd in ready:
+                    pid, reader = children[fd]
+                    data = os.read(fd, self.CHUNK_SIZE)
+                    if not data:
+                        os.close(fd)
+                        os.waitpid(pid, 0)
+                        del(children[fd])
+                        continue
+                    for message in reader.feed(data):
+                        if message[0] == "exit":
+                            if on_done is not None:
+                                on_done(*message[1:])
+                        else:
+                            results.append(message[1])
+            except KeyboardInterrupt:
+                # workers interrupted too report what they've done so far
+                interrupted = True
+                for pid, _ in children.values():
+                    try:
+                        os.kill(pid, signal.SIGINT)
+                    except OSError:
+                        pass
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+        if merge is not None:
+            for result in results:
+                merge(result)
+        if interrupted:
+            raise KeyboardInterrupt()
+
+    def worker(self, fd, jobs, concurrency, on_output, on_exit, payload, collect, on_retry, workers):
+        code = 0
+        try:
+            if "gevent" in sys.modules:
+                import gevent
+                gevent.reinit()
+            sys.stdout = LineWriter(1)
+            sys.stderr = LineWriter(2)
+
+            def done(host, code, attempts):
+                send_frame(fd, ("exit", host, code, attempts))
+
+            # the run's retry budget and caps are shared out between the workers
+            retry = self.retry.split(workers) if self.retry is not None else None
+            caps = self.caps.split(workers) if self.caps is not None else None
+            backend = self.backend.__class__(concurrency, retry, caps)
+            signal.signal(signal.SIGTERM, lambda signum, frame: backend.cancel())
+            try:
+                backend.run(jobs, on_output, on_exit, payload, done, on_retry=on_retry)
+            except KeyboardInterrupt:
+                pass
+            send_frame(fd, ("result", collect() if collect is not None else None))
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except BaseException:
+            code = 1
+            try:
+                os.write(2, traceback.format_exc())
+            except OSError:
+                pass
+        finally:
+            os._exit(code)
+
+
+def send_frame(fd, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    data = struct.pack("!I", len(data)) + data
+    while data:
+        data = data[os.write(fd, data):]
+
+
+class FrameReader(object):
+    """
+    Splits a worker's pipe stream back into messages. Parts are joined
+    only once a whole message has arrived, big results don't cost
+    quadratic time.
+    """
+
+    HEADER = struct.calcsize("!I")
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+        self.needed = None
+
+    def feed(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        messages = []
+        while True:
+            if self.needed is None:
+                if self.size < self.HEADER:
+                    break
+                buf = "".join(self.parts)
+                self.parts = [buf]
+                self.needed = self.HEADER + struct.unpack_from("!I", buf)[0]
+            if self.size < self.needed:
+                break
+            buf = "".join(self.parts)
+            messages.append(pickle.loads(buf[self.HEADER:self.needed]))
+            rest = buf[self.needed:]
+            self.parts = [rest] if rest else []
+            self.size = len(rest)
+            self.needed = None
+        return messages
+
+
+class LineWriter(object):
+    """
+    stdout/stderr of a worker: complete lines are written with a single
+    write(2), so lines of concurrent workers don't get mixed up
+    """
+
+    softspace = 0
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.parts = []
+
+    def write(self, data):
+        if "\n" not in data:
+            self.parts.append(data)
+            return
+        head, _, tail = data.rpartition("\n")
+        self.parts.append(head + "\n")
+        out = "".join(self.parts)
+        self.parts = [tail] if tail else []
+        self.write_all(out)
+
+    def flush(self):
+        out = "".join(self.parts)
+        self.parts = []
+        self.write_all(out)
+
+    def write_all(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        while data:
+            data = data[os.write(self.fd, data):]
+
+    def fileno(self):
+        return self.fd
+
+    def isatty(self):
+        return os.isatty(self.fd)
+
+
+BACKENDS = dict((cls.name, cls) for cls in (GeventBackend, PollBackend))
+DEFAULT_BACKEND = GeventBackend.name
+
+
+def get_backend(name, concurrency, workers=1, retry=None, caps=None):
+    backend = BACKENDS[name](concurrency, retry, caps)
+    if workers > 1:
+        return ShardedBackend(backend, workers)
+    return backend
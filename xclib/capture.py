@@ -0,0 +1,199 @@
+import os
+import errno
+import re
+import shutil
+import json
+import mmap
+import time
+import difflib
+
+
+class CaptureError(Exception):
+    pass
+
+
+class CaptureRun(object):
+    """
+    A run directory holding <host>.out and <host>.err for every host plus
+    run.json with the command, exit codes and output sizes
+    """
+
+    META = "run.json"
+    BUFFER_SIZE = 65536
+
+    def __init__(self, path):
+        self.path = path
+        self.__meta = None
+
+    @classmethod
+    def create(cls, base_dir, cmd, expr=None):
+        name = time.strftime("%Y%m%d-%H%M%S") + "-%d" % os.getpid()
+        path = os.path.join(base_dir, name)
+        if not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+        num = 1
+        while True:
+            try:
+                os.mkdir(path)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                num += 1
+                path = os.path.join(base_dir, "%s-%d" % (name, num))
+        run = cls(path)
+        run.__meta = {
+            "cmd": cmd,
+            "expr": expr,
+            "started": time.time(),
+            "finished": None,
+            "hosts": {},
+        }
+        run.save_meta()
+        return run
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+    @property
+    def meta(self):
+        if self.__meta is None:
+            try:
+                with open(os.path.join(self.path, self.META)) as f:
+                    self.__meta = json.load(f)
+            except (IOError, ValueError) as e:
+                raise CaptureError("can't read run %s: %s" % (self.name, e))
+        return self.__meta
+
+    @property
+    def hosts(self):
+        return sorted(self.meta["hosts"])
+
+    def filename(self, host, stream="out"):
+        return os.path.join(self.path, "%s.%s" % (host, stream))
+
+    def open_files(self, host):
+        return (open(self.filename(host, "out"), "wb", self.BUFFER_SIZE),
+                open(self.filename(host, "err"), "wb", self.BUFFER_SIZE))
+
+    def record(self, host, code, out_size, err_size):
+        self.meta["hosts"][host] = {"code": code, "out": out_size, "err": err_size}
+
+    def finish(self):
+        self.meta["finished"] = time.time()
+        self.save_meta()
+
+    def save_meta(self):
+        tmpname = os.path.join(self.path, "." + self.META)
+        with open(tmpname, "w") as f:
+            json.dump(self.__meta, f)
+        os.rename(tmpname, os.path.join(self.path, self.META))
+
+    def mapped(self, host, stream="out"):
+        """
+        Returns a read-only mmap of the host's output or an empty string
+        for empty/missing outputs (zero-length files can't be mapped)
+        """
+        try:
+            f = open(self.filename(host, stream), "rb")
+        except IOError:
+            return ""
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, host, stream="out"):
+        data = self.mapped(host, stream)
+        if isinstance(data, mmap.mmap):
+            try:
+                return data[:]
+            finally:
+                data.close()
+        return data
+
+    def chunks(self, host, stream="out", size=1 << 20):
+        data = self.mapped(host, stream)
+        try:
+            for offset in xrange(0, len(data), size):
+                yield data[offset:offset + size]
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def grep(self, pattern, hosts=None, streams=("out", "err")):
+        """
+        Yields (host, stream, line) for every line matching pattern
+        """
+        regex = re.compile(pattern, re.MULTILINE)
+        for host in hosts or self.hosts:
+            for stream in streams:
+                data = self.mapped(host, stream)
+                if not data:
+                    continue
+                try:
+                    pos = 0
+                    while True:
+                        match = regex.search(data, pos)
+                        if match is None:
+                            break
+                        start = data.rfind("\n", 0, match.start()) + 1
+                        end = data.find("\n", match.end())
+                        if end < 0:
+                            end = len(data)
+                        yield host, stream, data[start:end]
+                        pos = end + 1
+                        if pos > len(data):
+                            break
+                finally:
+                    if isinstance(data, mmap.mmap):
+                        data.close()
+
+    def diff(self, host1, host2, stream="out"):
+        lines1 = self.read(host1, stream).splitlines(True)
+        lines2 = self.read(host2, stream).splitlines(True)
+        return difflib.unified_diff(lines1, lines2, fromfile=host1, tofile=host2)
+
+
+class CaptureStore(object):
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def runs(self):
+        if not os.path.isdir(self.base_dir):
+            return []
+        names = [x for x in os.listdir(self.base_dir)
+                 if os.path.isfile(os.path.join(self.base_dir, x, CaptureRun.META))]
+        names.sort(reverse=True)
+        return [CaptureRun(os.path.join(self.base_dir, x)) for x in names]
+
+    def create(self, cmd, expr=None):
+        return CaptureRun.create(self.base_dir, cmd, expr)
+
+    def prune(self, keep):
+        """
+        Removes all but the `keep` latest runs
+        """
+        for run in self.runs()[keep:]:
+            shutil.rmtree(run.path, ignore_errors=True)
+
+    def get(self, ref=None):
+        """
+        Finds a run by name, name prefix or number in 'runs' listing
+        (1 is the latest one); the latest run if ref is None
+        """
+        runs = self.runs()
+        if not runs:
+            raise CaptureError("no captured runs in %s" % self.base_dir)
+        if ref is None:
+            return runs[0]
+        if ref.isdigit() and int(ref) <= len(runs):
+            if int(ref) < 1:
+                raise CaptureError("run numbers start from 1")
+            return runs[int(ref) - 1]
+        found = [r for r in runs if r.name.startswith(ref)]
+        if len(found) != 1:
+            raise CaptureError("run %s not found" % ref if not found else "run %s is ambiguous" % ref)
+        return found[0]
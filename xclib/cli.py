@@ -1,30 +1,44 @@
 from __future__ import print_function
-from gevent import Greenlet
-from gevent.select import select
-from gevent.pool import Pool
-from gevent.subprocess import Popen, PIPE
-from pyparsing import ParseException
 from collections import defaultdict
 from termcolor import colored as term_colored
 from xclib.conductor import Conductor
 from xclib.conductor.models import Datacenter, Project, Host, Group
-import sys, fcntl, termios, struct, os, cmd, re
+from xclib.conductor.parser import ParseError
+from xclib.conductor import planner
+from xclib.timing import timing
+import sys, fcntl, termios, struct, os, cmd, re, time
 reload(sys)
 sys.setdefaultencoding("utf8")
 
-try:
-    import gnureadline as readline
-except ImportError:
-    import readline
+# gevent, readline, progressbar and the execution, caching and capture
+# modules are imported where they are used so one-shot commands don't
+# pay for them at startup
+readline = None
 
-sys.modules["readline"] = readline
-readline.parse_and_bind("tab: complete")
-readline.set_completer_delims(readline.get_completer_delims().replace(":", ""))
+
+def init_readline():
+    global readline
+    if readline is not None:
+        return readline
+    try:
+        import gnureadline as rl
+    except ImportError:
+        import readline as rl
+
+    sys.modules["readline"] = rl
+    rl.parse_and_bind("tab: complete")
+    rl.set_completer_delims(rl.get_completer_delims().replace(":", ""))
+    readline = rl
+    return readline
 
 def terminal_size():
-    h, w, hp, wp = struct.unpack('HHHH',
-        fcntl.ioctl(0, termios.TIOCGWINSZ,
-        struct.pack('HHHH', 0, 0, 0, 0)))
+    try:
+        h, w, hp, wp = struct.unpack('HHHH',
+            fcntl.ioctl(0, termios.TIOCGWINSZ,
+            struct.pack('HHHH', 0, 0, 0, 0)))
+    except IOError:
+        # not a terminal (scripts, cron, benchmarks)
+        return 80, 24
     return w, h
 
 
@@ -56,6 +70,24 @@ def export_print(msg):
     cprint(msg, "yellow")
 
 
+def amount(value, total):
+    """
+    Converts "N" or "N%" (of total) to a number of items
+    """
+    value = str(value).strip()
+    if value.endswith("%"):
+        percent = float(value[:-1])
+        if percent < 0:
+            raise ValueError("negative amount")
+        if percent == 0:
+            return 0
+        return max(int(total * percent / 100), 1)
+    count = int(value)
+    if count < 0:
+        raise ValueError("negative amount")
+    return count
+
+
 def aligned(message, align_len):
     message = "=" * 6 + " " + message + " "
     return message + "=" * (align_len - len(message))
@@ -63,38 +95,165 @@ def aligned(message, align_len):
 
 class Cli(cmd.Cmd):
 
-    MODES = ("collapse", "parallel", "serial")
+    MODES = ("collapse", "parallel", "serial", "rolling", "capture")
+    COLLAPSE_MODES = ("exact", "normalized")
+    STRATA = ("dc", "group")
+    UNREACHABLE_POLICIES = ("skip", "last", "off")
     DEFAULT_MODE = "collapse"
     DEFAULT_OPTIONS = {
         "progressgbar": True,
         "ping_count": 5
     }
+    DEFAULT_ROLLING = {
+        "batch": "10%",
+        "canary": "1",
+        "pause": "0",
+        "max_failures": "0"
+    }
+    DEFAULT_RETRY = {
+        "per_host": "2",
+        "budget": "20%",
+        "delay": "1",
+        "max_delay": "30"
+    }
+    DEFAULT_TOPOLOGY = {
+        "dc_cap": "0",
+        "group_cap": "0",
+        "interleave": "on"
+    }
     HISTORY_FILE = os.path.join(os.getenv("HOME"), ".xcute_history")
 
     def __init__(self, options={}):
         cmd.Cmd.__init__(self)
+        self.timing_started = time.time()
         self.conductor = Conductor(options["projects"],
                                    host=options["conductor_host"],
                                    port=options["conductor_port"],
                                    cache_dir=options["cache_dir"],
-                                   print_func=export_print)
+                                   print_func=export_print,
+                                   fetch_concurrency=int(options.get("conductor_concurrency") or
+                                                         Conductor.DEFAULT_FETCH_CONCURRENCY),
+                                   fetch_timeout=float(options.get("conductor_timeout") or
+                                                       Conductor.DEFAULT_FETCH_TIMEOUT),
+                                   fetch_retries=int(options.get("conductor_retries",
+                                                                 Conductor.DEFAULT_FETCH_RETRIES)),
+                                   lock_wait=float(options.get("cache_lock_wait",
+                                                               Conductor.DEFAULT_LOCK_WAIT)))
         self.ssh_threads = options["ssh_threads"]
+        self.cache_dir = options["cache_dir"]
         self.user = options.get("user") or os.getlogin()
         self.progressbar = options.get("progressbar") or self.DEFAULT_OPTIONS["progressgbar"]
         self.ping_count = options.get("ping_count") or self.DEFAULT_OPTIONS["ping_count"]
         self.finished = False
         self.one_command_mode = False
-        self.alias_scripts = {}
+        self.script_ttl = int(options.get("script_ttl") or 0)
+        self.__scripts = None
+        self.script_dir = (options.get("script_dir") or "~/.xcute/scripts").rstrip("/")
         self.default_remote_dir = options.get("default_remote_dir") or "/tmp"
+        self.ssh_control_options = []
+        if options.get("ssh_persist"):
+            # ssh master connections shared by the commands of a long-lived session
+            control_dir = os.path.join(options["cache_dir"], "ssh")
+            if not os.path.isdir(control_dir):
+                os.makedirs(control_dir, 0o700)
+            self.ssh_control_options = ["-o", "ControlMaster=auto",
+                                        "-o", "ControlPath=%s" % os.path.join(control_dir, "%C"),
+                                        "-o", "ControlPersist=%d" % options["ssh_persist"]]
+        self.probe_options = {
+            "method": options.get("probe_method") or "auto",
+            "port": int(options.get("probe_port") or 22),
+            "timeout": float(options.get("probe_timeout") or 1.0),
+            "concurrency": int(options.get("probe_concurrency") or 1000),
+        }
+        self.unreachable_ttl = int(options.get("unreachable_ttl") or 0)
+        self.__health = None
+        self.unreachable_policy = options.get("unreachable_policy") or "skip"
+        if self.unreachable_policy not in self.UNREACHABLE_POLICIES:
+            error("invalid unreachable_policy '%s', use 'skip', 'last' or 'off'" % self.unreachable_policy)
+            self.unreachable_policy = "skip"
+        self.dns = options.get("dns_preresolve") or False
+        self.dns_ttl = int(options.get("dns_ttl") or 0)
+        self.dns_concurrency = int(options.get("dns_concurrency") or 0)
+        self.__address_cache = None
+        self.addresses = {}
+        self.collapse_mode = options.get("collapse_mode") or "exact"
+        if self.collapse_mode not in self.COLLAPSE_MODES:
+            error("invalid collapse_mode '%s', use 'exact' or 'normalized'" % self.collapse_mode)
+            self.collapse_mode = "exact"
+        # None runs the default backend, see backend_name()
+        self.backend = options.get("exec_backend") or None
+        self.workers = max(int(options.get("exec_workers") or 1), 1)
+        self.capture_dir = options.get("capture_dir") or os.path.join(options["cache_dir"], "runs")
+        self.__captures = None
+        self.capture_keep = int(options.get("capture_keep") or 20)
+        self.capture_run = None
+        self.input = options.get("input")
+        self.rolling = dict(self.DEFAULT_ROLLING)
+        for key in self.rolling:
+            if options.get("rolling_" + key):
+                self.rolling[key] = str(options["rolling_" + key])
+        self.retry = dict(self.DEFAULT_RETRY)
+        for key in self.retry:
+            if options.get("retry_" + key) not in (None, ""):
+                self.retry[key] = str(options["retry_" + key])
+        self.topology = dict(self.DEFAULT_TOPOLOGY)
+        for key in self.topology:
+            if options.get("topology_" + key) not in (None, ""):
+                self.topology[key] = str(options["topology_" + key])
+        self.placement = None
+        # hosts and skipped hosts prepared ahead of the next run
+        self.prepared = None
+        # the backend of the run in progress and whether it's been cancelled
+        self.running_backend = None
+        self.cancelled = False
+        self.sample = options.get("sample") or None
+        if self.sample is not None:
+            try:
+                self.parse_sample(self.sample)
+            except ValueError:
+                error("invalid sample '%s', use N, N%%, N/dc or N/group" % self.sample)
+                self.sample = None
+        self.first = int(options.get("first") or 0)
+        self.first_match = options.get("first_match") or None
         if "mode" in options:
             if not options["mode"] in self.MODES:
-                error("invalid mode '%s'. use 'parallel', 'collapse' or 'serial" % options["mode"])
+                error("invalid mode '%s'. use 'parallel', 'collapse', 'serial', 'rolling' or 'capture'" % options["mode"])
                 self.mode = self.DEFAULT_MODE
             else:
                 self.mode = options["mode"]
         else:
             self.mode = self.DEFAULT_MODE
 
+    @property
+    def health(self):
+        if self.__health is None:
+            from xclib.health import HealthCache
+            self.__health = HealthCache(self.cache_dir, ttl=self.unreachable_ttl or HealthCache.DEFAULT_TTL)
+        return self.__health
+
+    @property
+    def address_cache(self):
+        if self.__address_cache is None:
+            from xclib.dnscache import AddressCache
+            self.__address_cache = AddressCache(self.cache_dir,
+                                                ttl=self.dns_ttl or AddressCache.DEFAULT_TTL,
+                                                concurrency=self.dns_concurrency or AddressCache.DEFAULT_CONCURRENCY)
+        return self.__address_cache
+
+    @property
+    def scripts(self):
+        if self.__scripts is None:
+            from xclib.scripts import ScriptCache
+            self.__scripts = ScriptCache(self.cache_dir, ttl=self.script_ttl or ScriptCache.DEFAULT_TTL)
+        return self.__scripts
+
+    @property
+    def captures(self):
+        if self.__captures is None:
+            from xclib.capture import CaptureStore
+            self.__captures = CaptureStore(self.capture_dir)
+        return self.__captures
+
     def set_one_command_mode(self, value):
         self.one_command_mode = value
 
@@ -106,6 +265,10 @@ class Cli(cmd.Cmd):
             mode = colored("[Parallel]", "yellow", sym_ignore=True)
         elif self.mode == "serial":
             mode = colored("[Serial]", "cyan", sym_ignore=True)
+        elif self.mode == "rolling":
+            mode = colored("[Rolling]", "magenta", sym_ignore=True)
+        elif self.mode == "capture":
+            mode = colored("[Capture]", "white", sym_ignore=True)
 
         return "%s %s> " % (mode, colored(self.user, "blue", attrs=["bold"], sym_ignore=True))
 
@@ -115,6 +278,25 @@ class Cli(cmd.Cmd):
     def postcmd(self, stop, line):
         return self.finished
 
+    def onecmd(self, line):
+        if not timing.enabled:
+            return cmd.Cmd.onecmd(self, line)
+        # the first command also accounts for startup (config, conductor load)
+        started = self.timing_started or time.time()
+        try:
+            return cmd.Cmd.onecmd(self, line)
+        finally:
+            if not timing.empty:
+                self.print_timing(line, time.time() - started)
+            timing.reset()
+            self.timing_started = None
+
+    @staticmethod
+    def print_timing(line, total):
+        sys.stderr.write(colored("====== timing: %s" % line.strip(), "cyan") + "\n")
+        for item in timing.report(total):
+            sys.stderr.write(colored(item, "cyan") + "\n")
+
     def cmdloop(self, intro=None):
         try:
             cmd.Cmd.cmdloop(self)
@@ -123,6 +305,9 @@ class Cli(cmd.Cmd):
             self.cmdloop()
 
     def preloop(self):
+        init_readline()
+        # completion indexes are built while the user is typing
+        self.conductor.autocompleters.warm()
         delims = set(readline.get_completer_delims())
         for d in "%*-/":
             try:
@@ -171,6 +356,58 @@ class Cli(cmd.Cmd):
     def complete_progressbar(self, text, line, begidx, endidx):
         return self.__on_off_completion(text)
 
+    def do_dns(self, args):
+        """dns:\n switch bulk DNS pre-resolution before fan-out <on|off>"""
+        if args:
+            mode = args.split()[0].lower()
+            if mode not in ("on", "off"):
+                print("Usage: dns [on|off]")
+                return
+            self.dns = mode == "on"
+        self.print_option("dns")
+
+    def complete_dns(self, text, line, begidx, endidx):
+        return self.__on_off_completion(text)
+
+    @property
+    def timing(self):
+        return timing.enabled
+
+    def do_timing(self, args):
+        """timing:\n switch per-command timing breakdown <on|off>"""
+        if args:
+            mode = args.split()[0].lower()
+            if mode not in ("on", "off"):
+                print("Usage: timing [on|off]")
+                return
+            timing.enabled = mode == "on"
+            timing.reset()
+        self.print_option("timing")
+
+    def complete_timing(self, text, line, begidx, endidx):
+        return self.__on_off_completion(text)
+
+    def profile_command(self, line, filename):
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(self.onecmd, line)
+        finally:
+            profiler.dump_stats(filename)
+            export_print("Profile saved to %s (pstats format, use snakeviz/flameprof/gprof2dot to view)" % filename)
+
+    def do_profile(self, args):
+        """profile:\n  run a single command under cProfile and dump stats to a file"""
+        if not args.strip():
+            error("Usage: profile <command> [args]")
+            return
+        filename = os.path.join(self.cache_dir, "profile_%d.prof" % int(time.time()))
+        self.profile_command(args, filename)
+
+    def complete_profile(self, text, line, begidx, endidx):
+        names = [x[3:] for x in self.get_names() if x.startswith("do_")]
+        return [x for x in names if x.startswith(text)]
+
     def do_EOF(self, args):
         """exit:\n  exits program"""
         print()
@@ -190,7 +427,7 @@ class Cli(cmd.Cmd):
         expr = args[0]
         try:
             hosts = self.conductor.resolve(expr)
-        except ParseException as e:
+        except ParseError as e:
             error("Invalid conductor expression: %s" % str(e))
             return
 
@@ -234,13 +471,13 @@ class Cli(cmd.Cmd):
         print("")
 
     def do_mode(self, args):
-        """mode:\n  set exec output mode to collapse/serial/parallel"""
+        """mode:\n  set exec output mode to collapse/serial/parallel/rolling/capture"""
         if args:
             mode = args.split()[0]
         else:
             mode = Cli.DEFAULT_MODE
         if not mode in Cli.MODES:
-            error("Invalid mode: %s, use 'collapse', 'serial' or 'parallel'" % mode)
+            error("Invalid mode: %s, use 'collapse', 'serial', 'parallel', 'rolling' or 'capture'" % mode)
             return
         self.mode = mode
 
@@ -248,7 +485,8 @@ class Cli(cmd.Cmd):
         return [x for x in self.MODES if x.startswith(text)]
 
     def do_hostlist(self, args):
-        """hostlist:\n  resolve conductor expression to host list"""
+        """hostlist:\n  resolve conductor expression to host list
+  @file (or @- for stdin) in an expression reads hosts/expressions from the file, one per line"""
         args = args.split()
         if len(args) != 1:
             cprint("Usage: hostlist <conductor expression>", "red")
@@ -257,7 +495,7 @@ class Cli(cmd.Cmd):
         expr = args[0]
         try:
             hosts = list(self.conductor.resolve(expr))
-        except ParseException as e:
+        except ParseError as e:
             error("Invalid conductor expression: %s" % str(e))
             return
 
@@ -278,6 +516,27 @@ class Cli(cmd.Cmd):
         for host in hosts:
             print(host)
 
+    def do_explain(self, args):
+        """explain:\n  show how a conductor expression is evaluated: the steps of every token
+  in evaluation order (most selective first) with estimated and actual host counts"""
+        args = args.split()
+        if len(args) != 1:
+            cprint("Usage: explain <conductor expression>", "red")
+            return
+        try:
+            lines = self.conductor.explain(args[0])
+        except ParseError as e:
+            error("Invalid conductor expression: %s" % str(e))
+            return
+        for line in lines:
+            if line.startswith("  "):
+                print(line)
+            else:
+                cprint(line, "green")
+
+    def complete_explain(self, text, line, begidx, endidx):
+        return self.complete_exec(text, line, begidx, endidx)
+
     def __completion_argnum(self, line, endidx):
         argnum = len(line[:endidx].split(" ")) - 2
         return argnum
@@ -300,10 +559,23 @@ class Cli(cmd.Cmd):
     def complete_s_exec(self, text, line, begidx, endidx):
         return self.complete_exec(text, line, begidx, endidx)
 
+    def complete_cap_exec(self, text, line, begidx, endidx):
+        return self.complete_exec(text, line, begidx, endidx)
+
+    def complete_pipeline(self, text, line, begidx, endidx):
+        return self.complete_exec(text, line, begidx, endidx)
+
+    def complete_r_exec(self, text, line, begidx, endidx):
+        return self.complete_exec(text, line, begidx, endidx)
+
     def complete_exec(self, text, line, begidx, endidx):
         if self.__completion_argnum(line, endidx) != 0:
             return []
 
+        if line[begidx-1] == "@" and (begidx < 2 or line[begidx-2] in " ,-+"):
+            # @file host list
+            return self.__file_completion(text)
+
         if line[begidx-1] == "@":
             dcpref = text
             datacenters = self.conductor.autocompleters[Datacenter].complete(dcpref)
@@ -351,7 +623,7 @@ class Cli(cmd.Cmd):
             return
         try:
             hosts = self.conductor.resolve(args[0])
-        except ParseException as e:
+        except ParseError as e:
             error("Invalid conductor expression: %s" % str(e))
             return
 
@@ -363,6 +635,111 @@ class Cli(cmd.Cmd):
             command = "ssh -l %s %s" % (self.user, host)
             os.system(command)
 
+    def do_collapse_mode(self, args):
+        """collapse_mode:\n  group collapse mode outputs <exact|normalized>
+  normalized masks hostnames, numbers, timestamps, UUIDs, IPs and hex ids before grouping"""
+        if args:
+            mode = args.split()[0].lower()
+            if mode not in self.COLLAPSE_MODES:
+                print("Usage: collapse_mode [exact|normalized]")
+                return
+            self.collapse_mode = mode
+        cprint("Collapse mode: %s" % self.collapse_mode, "green")
+
+    def complete_collapse_mode(self, text, line, begidx, endidx):
+        return [x for x in self.COLLAPSE_MODES if x.startswith(text.lower())]
+
+    def do_backend(self, args):
+        """backend:\n  set the engine running parallel, collapse, rolling and capture modes
+  backend [gevent|poll]"""
+        from xclib.backends import BACKENDS
+        if args:
+            backend = args.split()[0].lower()
+            if backend not in BACKENDS:
+                print("Usage: backend [%s]" % "|".join(sorted(BACKENDS)))
+                return
+            self.backend = backend
+        cprint("Execution backend: %s" % self.backend_name(), "green")
+
+    def complete_backend(self, text, line, begidx, endidx):
+        from xclib.backends import BACKENDS
+        return [x for x in sorted(BACKENDS) if x.startswith(text.lower())]
+
+    def do_workers(self, args):
+        """workers:\n  set the number of processes parallel modes split large host sets across
+  workers [<count>]
+  1 runs everything in this process, hosts are sharded only when every worker gets 200+ of them"""
+        if args:
+            try:
+                workers = int(args.split()[0])
+                if workers < 1:
+                    raise ValueError()
+            except ValueError:
+                print("Usage: workers [<count>]")
+                return
+            self.workers = workers
+        cprint("Execution workers: %d" % self.workers, "green")
+
+    def backend_name(self):
+        """
+        The configured execution backend, checked when it's first needed
+        so one-shot commands don't load the backends at startup
+        """
+        from xclib.backends import BACKENDS, DEFAULT_BACKEND
+        if self.backend is not None and self.backend not in BACKENDS:
+            error("invalid exec_backend '%s', use one of %s" % (self.backend, ", ".join(sorted(BACKENDS))))
+            self.backend = None
+        return self.backend or DEFAULT_BACKEND
+
+    def new_backend(self, hosts, early=None):
+        if self.cancelled:
+            # e.g. the next batch of a rolling run
+            raise KeyboardInterrupt()
+        from xclib.backends import RetryPolicy, get_backend
+        retry = None
+        per_host = int(self.retry["per_host"])
+        budget = amount(self.retry["budget"], len(hosts))
+        if per_host > 0 and budget > 0:
+            retry = RetryPolicy(per_host, budget, float(self.retry["delay"]), float(self.retry["max_delay"]))
+        # stop() only reaches backends running in this process
+        workers = 1 if early is not None else self.workers
+        backend = get_backend(self.backend_name(), self.ssh_threads, workers, retry, self.topology_caps(hosts))
+        if early is not None:
+            early.backend = backend
+        self.running_backend = backend
+        return backend
+
+    def cancel(self):
+        """
+        Abandons the run in progress as Ctrl-C would, may be called from
+        another thread: the daemon does it when its client goes away
+        """
+        self.cancelled = True
+        backend = self.running_backend
+        if backend is not None:
+            backend.cancel()
+
+    def topology_capped(self):
+        return amount(self.topology["dc_cap"], 1) > 0 or amount(self.topology["group_cap"], 1) > 0
+
+    def topology_caps(self, hosts):
+        """
+        Concurrency caps of the datacenters and groups of hosts, None if
+        there are none
+        """
+        if self.placement is None or not self.topology_capped():
+            return None
+        buckets, counts = self.placement.buckets(hosts)
+        limits = {}
+        for key, count in counts.items():
+            limit = amount(self.topology[key[0] + "_cap"], count)
+            if 0 < limit < count:
+                limits[key] = limit
+        if not limits:
+            return None
+        from xclib.backends import Caps
+        return Caps(buckets, limits)
+
     def do_parallel(self, args):
         """parallel:\n  shortcut to 'mode parallel'"""
         return self.do_mode("parallel")
@@ -375,6 +752,105 @@ class Cli(cmd.Cmd):
         """serial:\n  shortcut to 'mode serial'"""
         return self.do_mode("serial")
 
+    def do_rolling(self, args):
+        """rolling:\n  shortcut to 'mode rolling'"""
+        return self.do_mode("rolling")
+
+    def do_capture(self, args):
+        """capture:\n  shortcut to 'mode capture'"""
+        return self.do_mode("capture")
+
+    def do_rolling_options(self, args):
+        """rolling_options:\n  show or set rolling mode options
+  rolling_options [batch=<N|N%>] [canary=<N|N%>] [pause=<seconds>] [max_failures=<N|N%>]
+  a failed canary batch always stops the run"""
+        for arg in args.split():
+            try:
+                key, value = arg.split("=", 1)
+            except ValueError:
+                error("Invalid option %s, use key=value" % arg)
+                return
+            if key not in self.rolling:
+                error("Unknown rolling option %s, use one of %s" % (key, ", ".join(sorted(self.rolling))))
+                return
+            try:
+                if key == "pause":
+                    float(value)
+                else:
+                    amount(value, 1)
+            except ValueError:
+                error("Invalid value for %s: %s" % (key, value))
+                return
+            self.rolling[key] = value
+        for key in ("canary", "batch", "pause", "max_failures"):
+            cprint("%s: %s" % (key, self.rolling[key]), "magenta")
+
+    def complete_rolling_options(self, text, line, begidx, endidx):
+        return [x + "=" for x in sorted(self.rolling) if x.startswith(text)]
+
+    def do_retry_options(self, args):
+        """retry_options:\n  show or set retries of hosts ssh failed to reach in parallel modes
+  retry_options [per_host=<N>] [budget=<N|N%>] [delay=<seconds>] [max_delay=<seconds>]
+  retries wait up to delay*2^n seconds (at most max_delay), budget limits retries per run, per_host=0 disables them
+  hosts where the command itself failed are never retried"""
+        for arg in args.split():
+            try:
+                key, value = arg.split("=", 1)
+            except ValueError:
+                error("Invalid option %s, use key=value" % arg)
+                return
+            if key not in self.retry:
+                error("Unknown retry option %s, use one of %s" % (key, ", ".join(sorted(self.retry))))
+                return
+            try:
+                if key in ("delay", "max_delay"):
+                    if float(value) < 0:
+                        raise ValueError()
+                elif key == "per_host":
+                    if int(value) < 0:
+                        raise ValueError()
+                else:
+                    amount(value, 1)
+            except ValueError:
+                error("Invalid value for %s: %s" % (key, value))
+                return
+            self.retry[key] = value
+        for key in ("per_host", "budget", "delay", "max_delay"):
+            cprint("%s: %s" % (key, self.retry[key]), "magenta")
+
+    def complete_retry_options(self, text, line, begidx, endidx):
+        return [x + "=" for x in sorted(self.retry) if x.startswith(text)]
+
+    def do_topology_options(self, args):
+        """topology_options:\n  show or set how parallel modes spread the load over datacenters and groups
+  topology_options [dc_cap=<N|N%>] [group_cap=<N|N%>] [interleave=on|off]
+  caps limit the hosts of a datacenter or a group running at once (N% of its hosts in the run), 0 is no cap
+  interleave starts hosts of different datacenters in turn"""
+        for arg in args.split():
+            try:
+                key, value = arg.split("=", 1)
+            except ValueError:
+                error("Invalid option %s, use key=value" % arg)
+                return
+            if key not in self.topology:
+                error("Unknown topology option %s, use one of %s" % (key, ", ".join(sorted(self.topology))))
+                return
+            try:
+                if key == "interleave":
+                    if value not in ("on", "off"):
+                        raise ValueError()
+                else:
+                    amount(value, 1)
+            except ValueError:
+                error("Invalid value for %s: %s" % (key, value))
+                return
+            self.topology[key] = value
+        for key in ("dc_cap", "group_cap", "interleave"):
+            cprint("%s: %s" % (key, self.topology[key]), "magenta")
+
+    def complete_topology_options(self, text, line, begidx, endidx):
+        return [x + "=" for x in sorted(self.topology) if x.startswith(text)]
+
     def __extract_exec_args(self, args):
         try:
             expr, cmd = args.split(None, 1)
@@ -383,62 +859,296 @@ class Cli(cmd.Cmd):
             return [], args
         try:
             hosts = self.conductor.resolve(expr)
-        except ParseException as e:
+        except ParseError as e:
             error("Invalid conductor expression: %s" % str(e))
-            return
+            return [], cmd
 
         if len(hosts) == 0:
             error("Empty hostlist")
         return hosts, cmd
 
-    def do_exec(self, args):
+    def __exec(self, args, mode):
         hosts, cmd = self.__extract_exec_args(args)
         if len(hosts) == 0:
             return
+        try:
+            payload = self.open_input()
+        except (IOError, OSError) as e:
+            error("Can't read input %s: %s" % (self.input, str(e)))
+            return
+        try:
+            getattr(self, "run_" + mode)(hosts, cmd, payload)
+        finally:
+            if payload is not None:
+                payload.close()
+
+    def open_input(self):
+        """
+        Payload for the stdin of remote commands or None if input is off
+        """
+        if self.input is None:
+            return None
+        if self.input == "-":
+            if planner.STDIN_DATA is not None:
+                warn("stdin has been read as a host list, remote commands get no input")
+                return None
+            from xclib.payload import Payload
+            return Payload.from_stdin()
+        from xclib.payload import Payload
+        return Payload.from_file(self.input)
+
+    def do_input(self, args):
+        """input:\n  feed a local file to stdin of the remote commands run by exec
+  input [<file>|-|off]
+  the file is read once and streamed to every host, - is stdin of 'x <command>'"""
+        args = args.split()
+        if args:
+            value = args[0]
+            if value == "off":
+                self.input = None
+            elif value == "-" and sys.stdin.isatty():
+                error("stdin is a terminal, use 'x -i - <command>' with a pipe or a file")
+                return
+            elif value != "-" and not os.path.isfile(os.path.expanduser(value)):
+                error("File %s not found" % value)
+                return
+            else:
+                self.input = value
+        cprint("Input: %s" % (self.input or "off"), "green")
 
-        if self.mode == "parallel":
-            self.run_parallel(hosts, cmd)
-        elif self.mode == "collapse":
-            self.run_collapse(hosts, cmd)
-        elif self.mode == "serial":
-            self.run_serial(hosts, cmd)
+    def complete_input(self, text, line, begidx, endidx):
+        return [x for x in ["off"] if x.startswith(text)] + self.__file_completion(text)
+
+    def do_exec(self, args):
+        self.__exec(args, self.mode)
 
     def do_p_exec(self, args):
         """p_exec:\n force exec in parallel mode"""
-        hosts, cmd = self.__extract_exec_args(args)
-        if len(hosts) == 0:
-            return
-        self.run_parallel(hosts, cmd)
+        self.__exec(args, "parallel")
 
     def do_s_exec(self, args):
         """s_exec:\n force exec in serial mode"""
-        hosts, cmd = self.__extract_exec_args(args)
-        if len(hosts) == 0:
-            return
-        self.run_serial(hosts, cmd)
+        self.__exec(args, "serial")
 
     def do_c_exec(self, args):
         """c_exec:\n force exec in collapse mode"""
+        self.__exec(args, "collapse")
+
+    def do_r_exec(self, args):
+        """r_exec:\n force exec in rolling mode"""
+        self.__exec(args, "rolling")
+
+    def do_cap_exec(self, args):
+        """cap_exec:\n force exec in capture mode"""
+        self.__exec(args, "capture")
+
+    def do_pipeline(self, args):
+        """pipeline:\n  run steps in order over a single ssh session per host
+  pipeline <conductor_expression> <step> [::: <step> ...]
+  a host stops at its first failing step, a step prefixed with - may fail;
+  every step's outputs are collapsed separately"""
         hosts, cmd = self.__extract_exec_args(args)
         if len(hosts) == 0:
             return
-        self.run_collapse(hosts, cmd)
+        from xclib.pipeline import Pipeline, parse_steps
+        try:
+            steps = parse_steps(cmd)
+        except ValueError as e:
+            error("Invalid pipeline: %s" % str(e))
+            return
+        if self.first:
+            warn("first is ignored by pipeline")
+        try:
+            payload = self.open_input()
+        except (IOError, OSError) as e:
+            error("Can't read input %s: %s" % (self.input, str(e)))
+            return
+        try:
+            self.run_pipeline(hosts, Pipeline(steps), payload)
+        finally:
+            if payload is not None:
+                payload.close()
 
-    def run_serial(self, hosts, cmd):
+    def run_serial(self, hosts, cmd, payload=None):
         codes = {"total": 0, "error": 0, "success": 0}
-        align_len = len(max(hosts, key=len)) + len(self.user) + len(cmd) + 24
+        hosts, skipped = self.prepare_hosts(hosts)
+        align_len = len(max(hosts or [""], key=len)) + len(self.user) + len(cmd) + 24
+        early = None
+        if self.first:
+            if self.first_match:
+                warn("output isn't captured in serial mode, stopping on exit codes only")
+            from xclib.sampling import EarlyExit
+            early = EarlyExit(self.first)
 
         for host in hosts:
             msg = "ssh %s@%s \"%s\"" % (self.user, host, cmd)
             cprint(aligned(msg, align_len), "blue", attrs=["bold"])
-            code = os.system("ssh -l %s %s \"%s\"" % (self.user, host, cmd))
+            options = " ".join(self.ssh_options(host))
+            command = "ssh -l %s %s %s \"%s\"" % (self.user, options, host, cmd)
+            if payload is None:
+                status = os.system(command)
+                code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            else:
+                import subprocess
+                p = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+                payload.feed(p.stdin)
+                code = p.wait()
             if code == 0:
                 codes["success"] += 1
             else:
                 codes["error"] += 1
             codes["total"] += 1
+            self.health.record(host, code != 255, "exec")
+            if early is not None:
+                early.exit(host, code)
+                if early.reached:
+                    break
 
         self.print_exec_results(codes)
+        self.print_early_exit(early, codes, hosts)
+        self.print_skipped(skipped)
+        self.save_health()
+
+    def prepare_hosts(self, hosts):
+        """
+        Everything done to a resolved host list before fan-out: datacenter
+        interleaving, unreachable policy, sampling and optional DNS
+        pre-resolution. Returns the hosts to run on and the skipped ones.
+        Hosts prepared ahead (see do_script) are returned as they are.
+        """
+        if self.prepared is not None:
+            prepared, self.prepared = self.prepared, None
+            return prepared
+        self.placement = None
+        interleave = self.topology["interleave"] == "on"
+        stratum = self.parse_sample(self.sample)[1] if self.sample else None
+        if interleave or stratum or self.topology_capped():
+            from xclib.topology import Topology
+            with timing.timer("exec.topology"):
+                self.placement = Topology.from_conductor(self.conductor, hosts)
+                if interleave:
+                    hosts = self.placement.interleave(hosts)
+        hosts, skipped = self.skip_unreachable(hosts)
+        if self.sample:
+            hosts = self.sample_hosts(hosts)
+        self.addresses = {}
+        if self.dns and hosts:
+            with timing.timer("dns.resolve"):
+                self.addresses, failures = self.address_cache.resolve_all(hosts)
+            timing.count("dns.failures", len(failures))
+            if failures:
+                self.print_dns_failures(failures)
+                hosts = [h for h in hosts if h not in failures]
+            try:
+                self.address_cache.save()
+            except (IOError, OSError) as e:
+                warn("Can't save address cache: %s" % str(e))
+        return hosts, skipped
+
+    @staticmethod
+    def parse_sample(spec):
+        """
+        "N", "N%", "N/dc" or "N/group" -> (size, stratum or None)
+        """
+        size, _, stratum = spec.partition("/")
+        amount(size, 1)
+        if stratum and stratum not in Cli.STRATA:
+            raise ValueError("invalid stratum %s" % stratum)
+        return size, stratum or None
+
+    def sample_hosts(self, hosts):
+        size, stratum = self.parse_sample(self.sample)
+        if stratum is None:
+            strata = [hosts]
+        else:
+            strata = self.placement.strata(hosts, stratum).values()
+        from xclib.sampling import sample_strata
+        sampled = sample_strata(strata, lambda count: amount(size, count))
+        per = " per %s" % stratum if stratum else ""
+        export_print("Sampled %d of %d host(s), %s%s" % (len(sampled), len(hosts), size, per))
+        return sampled
+
+    def new_early_exit(self):
+        if not self.first:
+            return None
+        from xclib.sampling import EarlyExit
+        return EarlyExit(self.first, self.first_match)
+
+    def print_early_exit(self, early, codes, hosts):
+        if early is None:
+            return
+        what = "matching" if early.pattern is not None else "successful"
+        if not early.reached:
+            cprint(" %d of %d %s host(s) wanted found: %s" %
+                   (len(early.hosts), early.count, what, ",".join(early.hosts)), "yellow")
+            return
+        cprint(" Stopped after %d %s host(s): %s" % (early.count, what, ",".join(early.hosts)), "yellow")
+        cancelled = len(hosts) - codes["total"] - len(early.stopped)
+        if cancelled > 0:
+            cprint(" %d host(s) cancelled or not started" % cancelled, "yellow")
+
+    @staticmethod
+    def print_dns_failures(failures):
+        reasons = defaultdict(list)
+        for host, reason in failures.items():
+            reasons[reason].append(host)
+        cprint("DNS resolution failed for %d host(s), they will be skipped:" % len(failures), "red")
+        for reason, hosts in reasons.items():
+            cprint(" %s: %s" % (reason, ",".join(sorted(hosts))), "red")
+
+    def ssh_options(self, host):
+        return self.ssh_address_options(host) + self.ssh_control_options
+
+    def ssh_address_options(self, host):
+        address = self.addresses.get(host)
+        if address is None:
+            return []
+        # connect to the pre-resolved address, check the host key by fqdn
+        return ["-o", "HostName=%s" % address, "-o", "HostKeyAlias=%s" % host]
+
+    def skip_unreachable(self, hosts):
+        """
+        Applies unreachable_policy to the host list, returns the list of hosts
+        to run on (in order) and the skipped hosts with their failure times
+        """
+        if self.unreachable_policy == "off":
+            return list(hosts), {}
+        dead = self.health.known_dead(hosts)
+        if not dead:
+            return list(hosts), {}
+        alive = [h for h in hosts if h not in dead]
+        if self.unreachable_policy == "last":
+            return alive + sorted(dead), {}
+        return alive, dead
+
+    @staticmethod
+    def print_skipped(skipped):
+        if not skipped:
+            return
+        now = time.time()
+        buckets = defaultdict(list)
+        for host, ts in skipped.items():
+            buckets[int(now - ts) / 60].append(host)
+        for minutes in sorted(buckets):
+            msg = " skipped (unreachable %d min ago): %s    " % (minutes, ",".join(sorted(buckets[minutes])))
+            cprint(msg, "yellow")
+        cprint(" %d host(s) skipped, use 'unreachable off' or 'x -U' to retry them" % len(skipped), "yellow")
+
+    def save_health(self):
+        try:
+            self.health.save()
+        except (IOError, OSError) as e:
+            warn("Can't save host health cache: %s" % str(e))
+
+    def record_exit(self, codes, host, code, attempts):
+        if code == 0:
+            codes["success"] += 1
+            if attempts > 1:
+                codes["retried"].append(host)
+        else:
+            codes["error"] += 1
+        codes["total"] += 1
+        self.health.record(host, code != 255, "exec")
 
     @staticmethod
     def print_exec_results(codes):
@@ -447,6 +1157,13 @@ class Cli(cmd.Cmd):
         cprint(hr, "green")
         cprint(msg, "green")
         cprint(hr, "green")
+        retried = codes.get("retried")
+        if retried:
+            cprint(" %d host(s) succeeded after retry: %s" % (len(retried), ",".join(sorted(retried))), "yellow")
+
+    @staticmethod
+    def print_retry(host, delay):
+        cprint("%s: ssh failed to connect, retrying in %.1fs" % (host, delay), "yellow")
 
     def get_parallel_ssh_options(self, host, cmd):
         return [
@@ -457,104 +1174,592 @@ class Cli(cmd.Cmd):
             "PubkeyAuthentication=yes",
             "-o",
             "PasswordAuthentication=no",
+        ] + self.ssh_options(host) + [
             host,
             cmd
         ]
 
-    def run_parallel(self, hosts, cmd):
-        codes = {"total": 0, "error": 0, "success": 0}
-
-        def worker(host, cmd):
-            p = Popen(self.get_parallel_ssh_options(host, cmd), stdout=PIPE, stderr=PIPE)
-            while True:
-                outs, _, _ = select([p.stdout, p.stderr], [], [])
-                if p.stdout in outs:
-                    outline = p.stdout.readline()
-                else:
-                    outline = ""
-                if p.stderr in outs:
-                    errline = p.stderr.readline()
-                else:
-                    errline = ""
+    @staticmethod
+    def feed_input(p, payload):
+        """
+        Streams the payload to the process stdin in a separate greenlet
+        so reading its output isn't blocked by a slow remote reader
+        """
+        if payload is None:
+            return None
+        from gevent import spawn
+        return spawn(payload.feed, p.stdin)
+
+    def run_parallel(self, hosts, cmd, payload=None):
+        codes = {"total": 0, "error": 0, "success": 0, "retried": []}
+        hosts, skipped = self.prepare_hosts(hosts)
+        early = self.new_early_exit()
+        self.parallel_batch(hosts, cmd, codes, payload, early)
+        self.print_exec_results(codes)
+        self.print_early_exit(early, codes, hosts)
+        self.print_skipped(skipped)
+        self.save_health()
 
-                if outline == "" and errline == "" and p.poll() is not None:
-                    break
+    def parallel_batch(self, hosts, cmd, codes, payload=None, early=None):
+        from xclib.backends import LineSplitter
+        lines = LineSplitter()
 
-                if outline != "":
-                    print("%s: %s" % (colored(host, "blue", attrs=["bold"]), outline.strip()))
-                if errline != "":
-                    print("%s: %s" % (colored(host, "blue", attrs=["bold"]), colored(errline.strip(), "red")))
-            if p.poll() == 0:
-                codes["success"] += 1
+        def print_line(host, stream, line):
+            if stream == "out":
+                print("%s: %s" % (colored(host, "blue", attrs=["bold"]), line.strip()))
             else:
-                codes["error"] += 1
-            codes["total"] += 1
+                print("%s: %s" % (colored(host, "blue", attrs=["bold"]), colored(line.strip(), "red")))
+
+        def on_output(host, stream, data):
+            with timing.timer("exec.output"):
+                for line in lines.feed((host, stream), data):
+                    print_line(host, stream, line)
+            if early is not None:
+                early.output(host, stream, data)
+
+        def flush(host):
+            for stream in ("out", "err"):
+                for line in lines.flush((host, stream)):
+                    print_line(host, stream, line)
+
+        def on_exit(host, code):
+            flush(host)
+            if early is not None:
+                early.exit(host, code)
+
+        def on_retry(host, code, delay):
+            flush(host)
+            if early is not None:
+                early.retry(host)
+            self.print_retry(host, delay)
+
+        def on_done(host, code, attempts):
+            self.record_exit(codes, host, code, attempts)
+
+        jobs = ((host, self.get_parallel_ssh_options(host, cmd)) for host in hosts)
+        with timing.timer("exec.run"):
+            self.new_backend(hosts, early).run(jobs, on_output, on_exit, payload, on_done, on_retry=on_retry)
+        timing.count("exec.hosts", len(hosts))
+
+    def rolling_batches(self, hosts):
+        canary = amount(self.rolling["canary"], len(hosts))
+        batch_size = max(amount(self.rolling["batch"], len(hosts)), 1)
+
+        batches = []
+        if canary > 0:
+            batches.append(hosts[:canary])
+            hosts = hosts[canary:]
+        for i in xrange(0, len(hosts), batch_size):
+            batches.append(hosts[i:i+batch_size])
+        return batches
+
+    def rolling_threshold_exceeded(self, codes):
+        value = self.rolling["max_failures"]
+        if value.endswith("%"):
+            return codes["error"] * 100.0 > float(value[:-1]) * codes["total"]
+        return codes["error"] > int(value)
+
+    def run_rolling(self, hosts, cmd, payload=None):
+        codes = {"total": 0, "error": 0, "success": 0, "retried": []}
+        hosts, skipped = self.prepare_hosts(sorted(hosts))
+        batches = self.rolling_batches(hosts)
+        early = self.new_early_exit()
+        has_canary = amount(self.rolling["canary"], len(hosts)) > 0
+        pause = float(self.rolling["pause"])
+
+        for num, batch in enumerate(batches):
+            title = "batch %d/%d" % (num + 1, len(batches))
+            if num == 0 and has_canary:
+                title += " (canary)"
+            cprint(aligned("%s: %d host(s)" % (title, len(batch)), 60), "magenta", attrs=["bold"])
+
+            batch_codes = {"total": 0, "error": 0, "success": 0, "retried": []}
+            try:
+                self.parallel_batch(batch, cmd, batch_codes, payload, early)
+            except KeyboardInterrupt:
+                error("Interrupted, %d batch(es) not started" % (len(batches) - num - 1))
+                break
+            finally:
+                for key in codes:
+                    codes[key] += batch_codes[key]
+
+            left = sum(len(b) for b in batches[num+1:])
+            if early is not None and early.reached:
+                break
+            if num == 0 and has_canary and batch_codes["error"] > 0:
+                error("Canary batch failed on %d host(s), %d host(s) skipped" % (batch_codes["error"], left))
+                break
+            if self.rolling_threshold_exceeded(codes):
+                error("Failure threshold %s exceeded (%d of %d failed), %d host(s) skipped" %
+                      (self.rolling["max_failures"], codes["error"], codes["total"], left))
+                break
+            if pause > 0 and left > 0:
+                export_print("Pausing for %s second(s)..." % self.rolling["pause"])
+                time.sleep(pause)
 
-        pool = Pool(self.ssh_threads)
-        for host in hosts:
-            pool.start(Greenlet(worker, host, cmd))
-        pool.join()
         self.print_exec_results(codes)
+        self.print_early_exit(early, codes, hosts)
+        self.print_skipped(skipped)
+        self.save_health()
 
-    def run_collapse(self, hosts, cmd):
+    def run_collapse(self, hosts, cmd, payload=None):
+        hosts, skipped = self.prepare_hosts(hosts)
         progress = None
         if self.progressbar:
             from progressbar import ProgressBar, Percentage, Bar, ETA, FileTransferSpeed
             progress = ProgressBar(
                 widgets=["Running: ", Percentage(), ' ', Bar(marker='.'), ' ', ETA(), ' ', FileTransferSpeed()],
-                maxval=len(hosts))
+                maxval=len(hosts) or 1)
 
-        codes = {"total": 0, "error": 0, "success": 0}
+        codes = {"total": 0, "error": 0, "success": 0, "retried": []}
         outputs = defaultdict(list)
-
-        def worker(host, cmd):
-            p = Popen(self.get_parallel_ssh_options(host, cmd), stdout=PIPE, stderr=PIPE)
-            o = ""
-            while True:
-                outs, _, _ = select([p.stdout, p.stderr], [], [])
-                outline = errline = ""
-                if p.stdout in outs:
-                    outline = p.stdout.readline()
-                if p.stderr in outs:
-                    errline = p.stderr.readline()
-                o += outline + errline
-
-                if outline == "" and errline == "" and p.poll() is not None:
-                    break
-
+        clusters = None
+        if self.collapse_mode == "normalized":
+            from xclib.collapse import Clusters
+            clusters = Clusters()
+
+        from xclib.backends import LineSplitter
+        lines = LineSplitter()
+        buffers = defaultdict(list)
+        early = self.new_early_exit()
+
+        def on_output(host, stream, data):
+            # stdout and stderr lines are interleaved in arrival order
+            buffers[host].extend(lines.feed((host, stream), data))
+            if early is not None:
+                early.output(host, stream, data)
+
+        def add_output(host):
+            for stream in ("out", "err"):
+                buffers[host].extend(lines.flush((host, stream)))
+            o = "".join(buffers.pop(host, ()))
             if o == "":
                 o = colored("[ No Output ]\n", "yellow")
-            outputs[o].append(host)
-            if p.poll() == 0:
-                codes["success"] += 1
+            if clusters is not None:
+                clusters.add(host, o)
             else:
-                codes["error"] += 1
-            codes["total"] += 1
+                outputs[o].append(host)
+
+        def on_exit(host, code):
+            if early is not None:
+                early.exit(host, code)
+            add_output(host)
+
+        def on_retry(host, code, delay):
+            # the failed attempt's output doesn't belong to any group
+            for stream in ("out", "err"):
+                lines.flush((host, stream))
+            buffers.pop(host, None)
+            if early is not None:
+                early.retry(host)
+
+        def on_done(host, code, attempts):
+            self.record_exit(codes, host, code, attempts)
             if self.progressbar:
                 progress.update(codes["total"])
 
-        pool = Pool(self.ssh_threads)
+        def collect():
+            return clusters if clusters is not None else outputs
+
+        def merge(result):
+            if clusters is not None:
+                clusters.merge(result)
+                return
+            for output, output_hosts in result.items():
+                outputs[output].extend(output_hosts)
+
         if self.progressbar:
             progress.start()
-        for host in hosts:
-            pool.start(Greenlet(worker, host, cmd))
+        jobs = ((host, self.get_parallel_ssh_options(host, cmd)) for host in hosts)
+        with timing.timer("exec.run"):
+            try:
+                self.new_backend(hosts, early).run(jobs, on_output, on_exit, payload, on_done, collect, merge,
+                                                   on_retry)
+            except KeyboardInterrupt:
+                pass
+        if early is not None:
+            # matching hosts stopped before they exited
+            for host in early.hosts:
+                if host in buffers:
+                    add_output(host)
+        timing.count("exec.hosts", codes["total"])
 
-        try:
-            pool.join()
-        except KeyboardInterrupt:
-            pass
+        if self.progressbar:
+            progress.finish()
+        with timing.timer("exec.output"):
+            self.print_exec_results(codes)
+            self.print_early_exit(early, codes, hosts)
+            print()
+            if clusters is not None:
+                self.print_clusters(clusters)
+            self.print_outputs(outputs)
+        self.print_skipped(skipped)
+        self.save_health()
+        timing.count("exec.collapse_groups", len(clusters if clusters is not None else outputs))
+
+    @staticmethod
+    def print_hosts_header(hosts):
+        msg = " %s    " % ','.join(hosts)
+        table_width = min([len(msg) + 2, terminal_size()[0]])
+        cprint("=" * table_width, "blue", attrs=["bold"])
+        cprint(msg, "blue", attrs=["bold"])
+        cprint("=" * table_width, "blue", attrs=["bold"])
+
+    @classmethod
+    def print_outputs(cls, outputs):
+        for output, hosts in outputs.items():
+            cls.print_hosts_header(hosts)
+            print(output)
+
+    @classmethod
+    def print_clusters(cls, clusters):
+        for cluster in clusters:
+            cls.print_hosts_header(cluster.hosts)
+            diff = cluster.masked_diff()
+            if diff:
+                cprint("[ output of %s, %d variants differing as: ]" % (cluster.sample_host, len(cluster.variants)),
+                       "yellow")
+                for line in diff:
+                    cprint("  " + line, "yellow")
+                print()
+            print(cluster.sample)
+
+    def run_pipeline(self, hosts, pipeline, payload=None):
+        hosts, skipped = self.prepare_hosts(hosts)
+        progress = None
+        if self.progressbar:
+            from progressbar import ProgressBar, Percentage, Bar, ETA
+            progress = ProgressBar(widgets=["Running: ", Percentage(), ' ', Bar(marker='.'), ' ', ETA()],
+                                   maxval=len(hosts) or 1)
+
+        codes = {"total": 0, "error": 0, "success": 0, "retried": []}
+        clusters = None
+        if self.collapse_mode == "normalized":
+            from xclib.collapse import Clusters
+            clusters = Clusters
+        results = pipeline.results(clusters, colored("[ No Output ]\n", "yellow"))
+
+        def on_retry(host, code, delay):
+            results.retry(host)
+
+        def on_done(host, code, attempts):
+            self.record_exit(codes, host, code, attempts)
+            if self.progressbar:
+                progress.update(codes["total"])
+
+        if self.progressbar:
+            progress.start()
+        cmd = pipeline.command()
+        jobs = ((host, self.get_parallel_ssh_options(host, cmd)) for host in hosts)
+        with timing.timer("exec.run"):
+            try:
+                self.new_backend(hosts).run(jobs, results.output, results.exit, payload, on_done, results.collect,
+                                            results.merge, on_retry)
+            except KeyboardInterrupt:
+                pass
+        timing.count("exec.hosts", codes["total"])
+        timing.count("exec.pipeline_steps", len(pipeline.steps))
 
         if self.progressbar:
             progress.finish()
-        self.print_exec_results(codes)
+        with timing.timer("exec.output"):
+            self.print_exec_results(codes)
+            print()
+            for num, (step, ignore) in enumerate(pipeline.steps, 1):
+                title = "step %d/%d: %s" % (num, len(pipeline.steps), step)
+                if ignore:
+                    title += " (may fail)"
+                self.print_pipeline_step(title, results, num, hosts)
+            if results.codes[0]:
+                self.print_pipeline_step("no step started", results, 0, hosts)
+        self.print_skipped(skipped)
+        self.save_health()
+
+    def print_pipeline_step(self, title, results, num, hosts):
+        cprint(aligned(title, 60), "magenta", attrs=["bold"])
+        step_codes = results.codes[num]
+        ran = sum(len(step_hosts) for step_hosts in step_codes.values())
+        failed = ran - len(step_codes.get(0, ()))
+        if num > 0:
+            cprint(" ran: %d, failed: %d, skipped: %d" % (ran, failed, len(results.skipped(num, hosts))),
+                   "red" if failed else "green")
+        for code in sorted(step_codes):
+            if code != 0:
+                cprint(" exit code %d: %s" % (code, ",".join(sorted(step_codes[code]))), "red")
         print()
-        for output, hosts in outputs.items():
-            msg = " %s    " % ','.join(hosts)
-            table_width = min([len(msg) + 2, terminal_size()[0]])
-            cprint("=" * table_width, "blue", attrs=["bold"])
+        if self.collapse_mode == "normalized":
+            self.print_clusters(results.outputs[num])
+        else:
+            self.print_outputs(results.outputs[num])
+
+    def run_capture(self, hosts, cmd, payload=None):
+        hosts, skipped = self.prepare_hosts(hosts)
+        try:
+            run = self.captures.create(cmd)
+        except (IOError, OSError) as e:
+            error("Can't create capture directory: %s" % str(e))
+            return
+        progress = None
+        if self.progressbar:
+            from progressbar import ProgressBar, Percentage, Bar, ETA
+            progress = ProgressBar(widgets=["Running: ", Percentage(), ' ', Bar(marker='.'), ' ', ETA()],
+                                   maxval=len(hosts) or 1)
+
+        codes = {"total": 0, "error": 0, "success": 0, "retried": []}
+
+        files = {}
+        sizes = defaultdict(int)
+        early = self.new_early_exit()
+
+        def host_files(host):
+            if host not in files:
+                out, err = run.open_files(host)
+                files[host] = {"out": out, "err": err}
+            return files[host]
+
+        def on_output(host, stream, data):
+            host_files(host)[stream].write(data)
+            sizes[(host, stream)] += len(data)
+            if early is not None:
+                early.output(host, stream, data)
+
+        def close_files(host):
+            for f in host_files(host).values():
+                f.close()
+            del(files[host])
+
+        def on_exit(host, code):
+            close_files(host)
+            run.record(host, code, sizes.pop((host, "out"), 0), sizes.pop((host, "err"), 0))
+            if early is not None:
+                early.exit(host, code)
+
+        def on_retry(host, code, delay):
+            # the next attempt truncates the files
+            close_files(host)
+            sizes.pop((host, "out"), None)
+            sizes.pop((host, "err"), None)
+            if early is not None:
+                early.retry(host)
+
+        def on_done(host, code, attempts):
+            self.record_exit(codes, host, code, attempts)
+            if progress is not None:
+                progress.update(codes["total"])
+
+        def collect():
+            return run.meta["hosts"]
+
+        def merge(result):
+            run.meta["hosts"].update(result)
+
+        if progress is not None:
+            progress.start()
+        jobs = ((host, self.get_parallel_ssh_options(host, cmd)) for host in hosts)
+        with timing.timer("exec.run"):
+            try:
+                self.new_backend(hosts, early).run(jobs, on_output, on_exit, payload, on_done, collect, merge,
+                                                   on_retry)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                # outputs of the interrupted hosts
+                for opened in files.values():
+                    for f in opened.values():
+                        f.close()
+        if early is not None:
+            # matching hosts stopped before they exited, no exit code
+            for host in early.hosts:
+                if host not in run.meta["hosts"]:
+                    run.record(host, None, sizes.pop((host, "out"), 0), sizes.pop((host, "err"), 0))
+        timing.count("exec.hosts", codes["total"])
+        if progress is not None:
+            progress.finish()
+
+        run.finish()
+        self.capture_run = None
+        self.print_exec_results(codes)
+        self.print_early_exit(early, codes, hosts)
+        self.print_run_summary(run)
+        self.print_skipped(skipped)
+        self.save_health()
+        if self.capture_keep > 0:
+            self.captures.prune(self.capture_keep)
+
+    @staticmethod
+    def print_run_summary(run):
+        results = run.meta["hosts"]
+        failed = defaultdict(list)
+        for host, result in results.items():
+            if result["code"] != 0:
+                failed[result["code"]].append(host)
+        # stopped by an early exit before they exited
+        stopped = failed.pop(None, None)
+        out_size = sum(r["out"] for r in results.values())
+        err_size = sum(r["err"] for r in results.values())
+        cprint("Captured %d host(s) to %s, stdout %d bytes, stderr %d bytes" %
+               (len(results), run.path, out_size, err_size), "green")
+        for code in sorted(failed):
+            cprint(" exit code %s: %s" % (code, ",".join(sorted(failed[code]))), "red")
+        if stopped:
+            cprint(" stopped before exiting: %s" % ",".join(sorted(stopped)), "yellow")
+
+    def get_capture_run(self):
+        from xclib.capture import CaptureError
+        try:
+            return self.captures.get(self.capture_run)
+        except CaptureError as e:
+            error(str(e))
+
+    def do_runs(self, args):
+        """runs:\n  list captured runs or select the run to inspect with show/grep/diff
+  runs [<number|name>]"""
+        from xclib.capture import CaptureError
+        if args.strip():
+            try:
+                run = self.captures.get(args.strip())
+            except CaptureError as e:
+                error(str(e))
+                return
+            self.capture_run = run.name
+            cprint("Selected run %s: %s" % (run.name, run.meta["cmd"]), "green")
+            return
+        runs = self.captures.runs()
+        if not runs:
+            warn("No captured runs, use capture mode or cap_exec to capture one")
+            return
+        current = self.get_capture_run()
+        current = current.path if current is not None else None
+        for num, run in enumerate(runs):
+            try:
+                results = run.meta["hosts"]
+            except CaptureError as e:
+                error(str(e))
+                continue
+            failed = len([r for r in results.values() if r["code"] not in (0, None)])
+            size = sum(r["out"] + r["err"] for r in results.values())
+            msg = "%s%3d %s  hosts: %d, failed: %d, %d bytes  %s" % (
+                "*" if run.path == current else " ", num + 1, run.name, len(results), failed, size,
+                run.meta["cmd"])
+            cprint(msg, "red" if failed else "green")
+
+    def complete_runs(self, text, line, begidx, endidx):
+        return [r.name for r in self.captures.runs() if r.name.startswith(text)]
+
+    def __complete_run_hosts(self, text):
+        from xclib.capture import CaptureError
+        try:
+            run = self.captures.get(self.capture_run)
+            return [h for h in run.hosts if h.startswith(text)]
+        except CaptureError:
+            return []
+
+    def do_show(self, args):
+        """show:\n  show captured output of hosts in the selected run (the latest one by default)
+  show [<host> ...]
+  without hosts prints the run summary"""
+        from xclib.capture import CaptureError
+        run = self.get_capture_run()
+        if run is None:
+            return
+        hosts = args.split()
+        try:
+            if not hosts:
+                cprint("Run %s: %s" % (run.name, run.meta["cmd"]), "green")
+                self.print_run_summary(run)
+                return
+            results = run.meta["hosts"]
+        except CaptureError as e:
+            error(str(e))
+            return
+        for host in hosts:
+            if host not in results:
+                error("Host %s is not in run %s" % (host, run.name))
+                continue
+            msg = " %s (exit code %s)    " % (host, results[host]["code"])
+            cprint("=" * len(msg), "blue", attrs=["bold"])
             cprint(msg, "blue", attrs=["bold"])
-            cprint("=" * table_width, "blue", attrs=["bold"])
-            print(output)
+            cprint("=" * len(msg), "blue", attrs=["bold"])
+            for chunk in run.chunks(host, "out"):
+                sys.stdout.write(chunk)
+            for chunk in run.chunks(host, "err"):
+                sys.stdout.write(colored(chunk, "red"))
+            sys.stdout.flush()
+
+    def complete_show(self, text, line, begidx, endidx):
+        return self.__complete_run_hosts(text)
+
+    def do_grep(self, args):
+        """grep:\n  search captured outputs of the selected run (the latest one by default)
+  grep [-l] <regex>
+  -l prints matching hosts only"""
+        hosts_only = False
+        if args.startswith("-l "):
+            hosts_only = True
+            args = args[3:]
+        pattern = args.strip()
+        if not pattern:
+            print("Usage: grep [-l] <regex>")
+            return
+        from xclib.capture import CaptureError
+        run = self.get_capture_run()
+        if run is None:
+            return
+        found = set()
+        try:
+            for host, stream, line in run.grep(pattern):
+                if hosts_only:
+                    if host not in found:
+                        print(host)
+                elif stream == "err":
+                    print("%s: %s" % (colored(host, "blue", attrs=["bold"]), colored(line, "red")))
+                else:
+                    print("%s: %s" % (colored(host, "blue", attrs=["bold"]), line))
+                found.add(host)
+        except re.error as e:
+            error("Invalid regex: %s" % str(e))
+            return
+        except CaptureError as e:
+            error(str(e))
+            return
+        cprint("%d of %d host(s) matched" % (len(found), len(run.hosts)), "green")
+
+    def do_diff(self, args):
+        """diff:\n  diff captured stdout of two hosts in the selected run (the latest one by default)
+  diff <host1> <host2>"""
+        hosts = args.split()
+        if len(hosts) != 2:
+            print("Usage: diff <host1> <host2>")
+            return
+        from xclib.capture import CaptureError
+        run = self.get_capture_run()
+        if run is None:
+            return
+        try:
+            for host in hosts:
+                if host not in run.meta["hosts"]:
+                    error("Host %s is not in run %s" % (host, run.name))
+                    return
+        except CaptureError as e:
+            error(str(e))
+            return
+        identical = True
+        for line in run.diff(hosts[0], hosts[1]):
+            identical = False
+            line = line.rstrip("\n")
+            if line.startswith("+") and not line.startswith("+++"):
+                cprint(line, "green")
+            elif line.startswith("-") and not line.startswith("---"):
+                cprint(line, "red")
+            elif line.startswith("@@"):
+                cprint(line, "cyan")
+            else:
+                print(line)
+        if identical:
+            cprint("Outputs of %s and %s are identical" % tuple(hosts), "green")
+
+    def complete_diff(self, text, line, begidx, endidx):
+        return self.__complete_run_hosts(text)
 
     def do_user(self, args):
         """user:\n  set user"""
@@ -567,13 +1772,21 @@ class Cli(cmd.Cmd):
 
     def ping_parallel(self, hosts, pc):
         """ping:\n pings host (using shell cmd)"""
+        from gevent import Greenlet
+        from gevent.pool import Pool
+        from gevent.select import select
+        from gevent.subprocess import Popen, PIPE
         codes = {"total": 0, "error": 0, "success": 0}
+        hosts, skipped = self.prepare_hosts(hosts)
+
         def worker(host):
+            target = self.addresses.get(host, host)
             if pc == 0:
-                args = ["ping", host]
+                args = ["ping", target]
             else:
-                args = ["ping", "-c", str(pc), host]
-            p = Popen(args, stdout=PIPE, stderr=PIPE)
+                args = ["ping", "-c", str(pc), target]
+            with timing.timer("ping.spawn"):
+                p = Popen(args, stdout=PIPE, stderr=PIPE)
             while True:
                 outs, _, _ = select([p.stdout, p.stderr], [], [])
                 if p.stdout in outs:
@@ -588,21 +1801,27 @@ class Cli(cmd.Cmd):
                 if outline == "" and errline == "" and p.poll() is not None:
                     break
 
-                if outline != "":
-                    print("%s: %s" % (colored(host, "blue", attrs=["bold"]), outline.strip()))
-                if errline != "":
-                    print("%s: %s" % (colored(host, "blue", attrs=["bold"]), colored(errline.strip(), "red")))
+                with timing.timer("ping.output"):
+                    if outline != "":
+                        print("%s: %s" % (colored(host, "blue", attrs=["bold"]), outline.strip()))
+                    if errline != "":
+                        print("%s: %s" % (colored(host, "blue", attrs=["bold"]), colored(errline.strip(), "red")))
             if p.poll() == 0:
                 codes["success"] += 1
             else:
                 codes["error"] += 1
             codes["total"] += 1
+            self.health.record(host, p.returncode == 0, "ping")
 
         pool = Pool(self.ssh_threads)
-        for host in hosts:
-            pool.start(Greenlet(worker, host))
-        pool.join()
+        with timing.timer("ping.run"):
+            for host in hosts:
+                pool.start(Greenlet(worker, host))
+            pool.join()
+        timing.count("ping.hosts", codes["total"])
         self.print_exec_results(codes)
+        self.print_skipped(skipped)
+        self.save_health()
 
     def do_ping(self, args):
         """ping:\n  pings hosts in parallel"""
@@ -622,7 +1841,7 @@ class Cli(cmd.Cmd):
 
         try:
             hosts = self.conductor.resolve(expr)
-        except ParseException as e:
+        except ParseError as e:
             error("Invalid conductor expression: %s" % str(e))
             return
 
@@ -631,6 +1850,187 @@ class Cli(cmd.Cmd):
             return
         self.ping_parallel(hosts, pc)
 
+    def do_probe(self, args):
+        """probe:\n  check hosts reachability in-process (ICMP if permitted, TCP connect otherwise)
+  probe <expression> [count]"""
+        args = args.split()
+        if len(args) == 0:
+            error("Usage: probe <expression> [count]")
+            return
+        expr = args[0]
+        count = self.ping_count
+        if len(args) > 1:
+            try:
+                count = int(args[1])
+            except ValueError:
+                error("Invalid probe count: should be integer")
+                return
+        if count <= 0:
+            count = 1
+
+        try:
+            hosts = self.conductor.resolve(expr)
+        except ParseError as e:
+            error("Invalid conductor expression: %s" % str(e))
+            return
+
+        if len(hosts) == 0:
+            error("Empty hostlist")
+            return
+
+        from xclib.probe import Prober
+        try:
+            prober = Prober(method=self.probe_options["method"],
+                            port=self.probe_options["port"],
+                            timeout=self.probe_options["timeout"],
+                            concurrency=self.probe_options["concurrency"],
+                            count=count)
+        except ValueError as e:
+            error(str(e))
+            return
+
+        with timing.timer("probe.run"):
+            results = prober.probe(hosts)
+        timing.count("probe.hosts", len(results))
+        for host, result in results.items():
+            self.health.record(host, result.alive, "probe")
+        self.print_probe_results(results, prober)
+        self.save_health()
+
+    def complete_probe(self, text, line, begidx, endidx):
+        return self.complete_exec(text, line, begidx, endidx)
+
+    @staticmethod
+    def print_probe_results(results, prober):
+        def fmt(value):
+            return "-" if value is None else "%.2f" % value
+
+        hostlen = max([len(x) for x in results] + [4])
+        header = "%-*s  %-15s  %9s  %6s  %23s  %s" % (hostlen, "host", "address", "sent/recv", "loss",
+                                                   "rtt min/avg/max, ms", "status")
+        cprint(header, "blue", attrs=["bold"])
+        alive = []
+        for host in sorted(results):
+            r = results[host]
+            if r.alive:
+                alive.append(r)
+                status = colored("refused", "yellow") if r.refused else colored("ok", "green")
+            else:
+                status = colored(r.error or "unreachable", "red")
+            print("%-*s  %-15s  %9s  %5.1f%%  %23s  %s" % (
+                hostlen, host, r.address or "-", "%d/%d" % (r.sent, r.received), r.loss,
+                "/".join([fmt(r.rtt_min), fmt(r.rtt_avg), fmt(r.rtt_max)]), status))
+
+        rtts = [x for result in alive for x in result.rtts]
+        msg = " Hosts probed (%s%s): %d, alive: %d, dead: %d, avg rtt: %s ms    " % (
+            prober.method, "" if prober.method == "icmp" else ":%d" % prober.port,
+            len(results), len(alive), len(results) - len(alive),
+            fmt(sum(rtts) / len(rtts) if rtts else None))
+        hr = "=" * len(msg)
+        cprint(hr, "green")
+        cprint(msg, "green")
+        cprint(hr, "green")
+
+    def do_unreachable(self, args):
+        """unreachable:\n  show or set policy for hosts which recently failed to connect <skip|last|off>
+  skip - don't run on them, last - run on them after all the others, off - treat them as usual"""
+        if args:
+            policy = args.split()[0].lower()
+            if policy not in self.UNREACHABLE_POLICIES:
+                print("Usage: unreachable [skip|last|off]")
+                return
+            self.unreachable_policy = policy
+        cprint("Unreachable: %s (ttl %d min)" % (self.unreachable_policy, self.health.ttl / 60), "green")
+
+    def complete_unreachable(self, text, line, begidx, endidx):
+        return [x for x in self.UNREACHABLE_POLICIES if x.startswith(text.lower())]
+
+    def do_sample(self, args):
+        """sample:\n  run exec commands on a random sample of the resolved hosts
+  sample [off|<N|N%>[/dc|/group]]
+  /dc and /group pick that many hosts of every datacenter or group"""
+        args = args.split()
+        if args:
+            if args[0] == "off":
+                self.sample = None
+            else:
+                try:
+                    self.parse_sample(args[0])
+                except ValueError:
+                    print("Usage: sample [off|<N|N%>[/dc|/group]]")
+                    return
+                self.sample = args[0]
+        cprint("Sample: %s" % (self.sample or "off"), "green")
+
+    def do_first(self, args):
+        """first:\n  stop exec commands once enough hosts succeeded, cancelling the rest
+  first [off|<count> [<regex>]]
+  a host succeeds by exiting with 0 or, with a regex, by printing a matching line"""
+        if args.strip():
+            parts = args.split(None, 1)
+            if parts[0] == "off":
+                self.first = 0
+                self.first_match = None
+            else:
+                try:
+                    count = int(parts[0])
+                    if count < 1:
+                        raise ValueError()
+                    pattern = parts[1].strip() if len(parts) > 1 else None
+                    if pattern:
+                        re.compile(pattern)
+                except (ValueError, re.error):
+                    print("Usage: first [off|<count> [<regex>]]")
+                    return
+                self.first = count
+                self.first_match = pattern
+        if not self.first:
+            cprint("First: off", "green")
+        elif self.first_match:
+            cprint("First: %d host(s) printing /%s/" % (self.first, self.first_match), "green")
+        else:
+            cprint("First: %d host(s) exiting with 0" % self.first, "green")
+
+    def do_health(self, args):
+        """health:\n  list hosts which recently failed to connect, or forget them
+  health [expression]
+  health clear [expression]"""
+        args = args.split()
+        clear = len(args) > 0 and args[0] == "clear"
+        if clear:
+            args = args[1:]
+
+        hosts = None
+        if args:
+            try:
+                hosts = self.conductor.resolve(args[0])
+            except ParseError as e:
+                error("Invalid conductor expression: %s" % str(e))
+                return
+
+        if clear:
+            self.health.clear(hosts)
+            self.save_health()
+            export_print("Host health cache cleared")
+            return
+
+        dead = self.health.known_dead(hosts if hosts is not None else list(self.health.data.keys()))
+        if not dead:
+            cprint("No recently unreachable hosts", "green")
+            return
+        now = time.time()
+        for host in sorted(dead):
+            reason = self.health.data[host].get("reason")
+            print("%s: unreachable %d min ago%s" % (colored(host, "blue", attrs=["bold"]),
+                                                   int(now - dead[host]) / 60,
+                                                   " (%s)" % reason if reason else ""))
+
+    def complete_health(self, text, line, begidx, endidx):
+        argnum = self.__completion_argnum(line, endidx)
+        if argnum == 0 and "clear".startswith(text):
+            return ["clear"] + self.complete_exec(text, line, begidx, endidx)
+        return self.complete_exec(text, line, begidx, endidx)
+
     def do_cd(self, args):
         """cd:\n  change working directory"""
         if not args:
@@ -665,7 +2065,7 @@ class Cli(cmd.Cmd):
         expr, filename = args[:2]
         try:
             hosts = self.conductor.resolve(expr)
-        except ParseException as e:
+        except ParseError as e:
             error("Invalid conductor expression: %s" % str(e))
             return
 
@@ -681,6 +2081,12 @@ class Cli(cmd.Cmd):
         else:
             remote_dir = self.default_remote_dir
 
+        from gevent import Greenlet
+        from gevent.pool import Pool
+        from gevent.subprocess import Popen, PIPE
+        from xclib.health import is_transport_error
+
+        hosts, skipped = self.prepare_hosts(hosts)
         results = {
             "error": [],
             "success": [],
@@ -693,21 +2099,24 @@ class Cli(cmd.Cmd):
             from progressbar import ProgressBar, Percentage, Bar, ETA, FileTransferSpeed
             progress = ProgressBar(
                 widgets=["Running: ", Percentage(), ' ', Bar(marker='.'), ' ', ETA(), ' ', FileTransferSpeed()],
-                maxval=len(hosts))
+                maxval=len(hosts) or 1)
 
         def worker(host):
-            p = Popen([
-                "scp",
-                "-B", # prevents asking for passwords
-                filename,
-                "%s@%s:%s" % (self.user, host, remote_dir)
-            ], stdout=PIPE, stderr=PIPE)
+            with timing.timer("distribute.spawn"):
+                p = Popen([
+                    "scp",
+                    "-B", # prevents asking for passwords
+                ] + self.ssh_options(host) + [
+                    filename,
+                    "%s@%s:%s" % (self.user, host, remote_dir)
+                ], stdout=PIPE, stderr=PIPE)
             o, e = p.communicate()
             if p.poll() == 0:
                 results["success"].append(host)
             else:
                 results["error"].append(host)
                 errors[e].append(host)
+            self.health.record(host, p.returncode == 0 or not is_transport_error(e), "distribute")
 
             results["total"] += 1
             if self.progressbar:
@@ -717,9 +2126,11 @@ class Cli(cmd.Cmd):
             progress.start()
 
         pool = Pool()
-        for host in hosts:
-            pool.start(Greenlet(worker, host))
-        pool.join()
+        with timing.timer("distribute.run"):
+            for host in hosts:
+                pool.start(Greenlet(worker, host))
+            pool.join()
+        timing.count("distribute.hosts", results["total"])
 
         if self.progressbar:
             progress.finish()
@@ -736,6 +2147,8 @@ class Cli(cmd.Cmd):
                 cprint(msg, "blue", attrs=["bold"])
                 cprint("=" * table_width, "blue", attrs=["bold"])
                 print(output)
+        self.print_skipped(skipped)
+        self.save_health()
 
     def complete_distribute(self, text, line, begidx, endidx):
         argnum = self.__completion_argnum(line, endidx)
@@ -746,7 +2159,124 @@ class Cli(cmd.Cmd):
         else:
             return []
 
+    def do_script(self, args):
+        """script:\n  upload a local script and run it with arguments in the current mode
+  script [-u] <conductor_expression> <local_filename> [arguments]
+  the script is stored under its content hash and uploaded only to hosts
+  which haven't got it yet, -u rechecks hosts recorded as having it"""
+        recheck = args.startswith("-u ")
+        if recheck:
+            args = args[3:]
+        args = args.split(None, 2)
+        if len(args) < 2:
+            error("Usage: script [-u] <conductor_expression> <local_filename> [arguments]")
+            return
+        expr, filename = args[:2]
+        arguments = args[2] if len(args) > 2 else ""
+        try:
+            hosts = self.conductor.resolve(expr)
+        except ParseError as e:
+            error("Invalid conductor expression: %s" % str(e))
+            return
+        if len(hosts) == 0:
+            error("Empty hostlist")
+            return
+        try:
+            with open(os.path.expanduser(filename), "rb") as f:
+                data = f.read()
+        except IOError as e:
+            error("Can't read script %s: %s" % (filename, str(e)))
+            return
+
+        from xclib.payload import Payload
+        from xclib.scripts import script_digest
+        digest = script_digest(data)
+        path = "%s/%s" % (self.script_dir, digest)
+        # the upload and the run go to the same sampled and reachable hosts
+        hosts, skipped = self.prepare_hosts(sorted(hosts) if self.mode == "rolling" else hosts)
+        if recheck:
+            self.scripts.forget(hosts, self.user, digest)
+        failed = self.upload_script(self.scripts.missing(hosts, self.user, digest), Payload(data, filename), path, digest)
+        try:
+            self.scripts.save()
+        except (IOError, OSError) as e:
+            warn("Can't save script cache: %s" % str(e))
+        if failed:
+            hosts = [h for h in hosts if h not in failed]
+            if not hosts:
+                self.print_skipped(skipped)
+                return
+
+        try:
+            payload = self.open_input()
+        except (IOError, OSError) as e:
+            error("Can't read input %s: %s" % (self.input, str(e)))
+            return
+        cmd = ("%s %s" % (path, arguments)).strip()
+        self.prepared = (hosts, skipped)
+        try:
+            getattr(self, "run_" + self.mode)(hosts, cmd, payload)
+        finally:
+            self.prepared = None
+            if payload is not None:
+                payload.close()
+
+    def upload_script(self, hosts, script, path, digest):
+        """
+        Stores the script at path on the hosts missing it, one ssh session
+        per host. Returns the set of hosts the upload failed on.
+        """
+        if not hosts:
+            return set()
+        from gevent import Greenlet
+        from gevent.pool import Pool
+        from gevent.subprocess import Popen, PIPE
+
+        export_print("Uploading %s (%d bytes) to %d host(s)" % (script.name, len(script), len(hosts)))
+        failed = set()
+        errors = defaultdict(list)
+        from xclib.scripts import upload_command
+        command = upload_command(path)
+
+        def worker(host):
+            with timing.timer("script.spawn"):
+                p = Popen(self.get_parallel_ssh_options(host, command), stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            feeder = self.feed_input(p, script)
+            o, e = p.communicate()
+            feeder.join()
+            if p.returncode == 0:
+                self.scripts.record(host, self.user, digest)
+            else:
+                failed.add(host)
+                errors[e].append(host)
+            self.health.record(host, p.returncode != 255, "script")
+
+        pool = Pool(self.ssh_threads)
+        with timing.timer("script.upload"):
+            for host in hosts:
+                pool.start(Greenlet(worker, host))
+            pool.join()
+        timing.count("script.uploads", len(hosts))
+
+        for output, hosts in errors.items():
+            cprint("Upload failed on %s:" % ",".join(sorted(hosts)), "red")
+            print(output)
+        self.save_health()
+        return failed
+
+    def complete_script(self, text, line, begidx, endidx):
+        argnum = self.__completion_argnum(line, endidx)
+        if line.split()[1:2] == ["-u"]:
+            argnum -= 1
+        if argnum == 0:
+            return self.complete_exec(text, line, begidx, endidx)
+        elif argnum == 1:
+            return self.__file_completion(text)
+        else:
+            return []
+
     def __os_cmd(self, cmd, args):
+        from gevent.subprocess import Popen, PIPE
         args = [cmd] + args.split()
         p = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True)
         p.wait()
@@ -0,0 +1,108 @@
+import re
+import zlib
+
+
+MASKS = (
+    ("UUID", r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"),
+    ("TIME", r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:[.,]\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?"
+             r"|\b\d{1,2}:\d{2}(?::\d{2}(?:[.,]\d+)?)?\b"),
+    ("IP", r"\b\d{1,3}(?:\.\d{1,3}){3}\b"),
+    ("HEX", r"\b0x[0-9a-fA-F]+\b|\b(?=[0-9a-f]*[a-f])(?=[0-9a-f]*\d)[0-9a-f]{12,}\b"),
+    ("N", r"\d+(?:\.\d+)?"),
+)
+
+MASK_RE = re.compile("|".join("(?P<%s>%s)" % (name, expr) for name, expr in MASKS))
+
+
+def mask_token(match):
+    return "<%s>" % match.lastgroup
+
+
+def mask_host(output, host):
+    output = output.replace(host, "<HOST>")
+    short = host.split(".")[0]
+    if short != host and len(short) > 2 and short in output:
+        # the short name only counts as a whole word
+        output = re.sub(r"\b%s\b" % re.escape(short), "<HOST>", output)
+    return output
+
+
+def normalize(output, host=None):
+    """
+    Masks the parts of an output which usually differ between hosts
+    running the same command: the host's own name, UUIDs, timestamps,
+    IP addresses, long hex ids and numbers. Runs in linear time.
+    """
+    if host:
+        output = mask_host(output, host)
+    return MASK_RE.sub(mask_token, output)
+
+
+class Cluster(object):
+
+    __slots__ = ("template", "hosts", "sample", "sample_host", "variants", "varying")
+
+    def __init__(self, template, host, output):
+        self.template = template
+        self.hosts = []
+        self.sample = output
+        self.sample_host = host
+        self.variants = set()
+        # numbers of the lines some output has differently from the sample
+        self.varying = set()
+
+    def add(self, host, output):
+        self.hosts.append(host)
+        variant = zlib.crc32(output)
+        if variant not in self.variants:
+            self.variants.add(variant)
+            self.compare(output)
+
+    def compare(self, output):
+        # outputs of a cluster share the template, so their lines match up
+        for num, (line, sample_line) in enumerate(zip(output.splitlines(), self.sample.splitlines())):
+            if line != sample_line:
+                self.varying.add(num)
+
+    def masked_diff(self):
+        """
+        Template lines where hosts of this cluster differ
+        """
+        lines = self.template.splitlines()
+        return [lines[num] for num in sorted(self.varying) if num < len(lines)]
+
+
+class Clusters(object):
+    """
+    Groups outputs by their normalized form, keeping one representative
+    output per group instead of every distinct raw output
+    """
+
+    def __init__(self):
+        self.clusters = {}
+
+    def add(self, host, output):
+        template = normalize(output, host)
+        cluster = self.clusters.get(template)
+        if cluster is None:
+            cluster = Cluster(template, host, output)
+            self.clusters[template] = cluster
+        cluster.add(host, output)
+        return cluster
+
+    def merge(self, other):
+        for template, cluster in other.clusters.items():
+            existing = self.clusters.get(template)
+            if existing is None:
+                self.clusters[template] = cluster
+            else:
+                existing.hosts.extend(cluster.hosts)
+                existing.variants.update(cluster.variants)
+                existing.varying.update(cluster.varying)
+                existing.compare(cluster.sample)
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def __iter__(self):
+        return iter(sorted(self.clusters.values(), key=lambda x: -len(x.hosts)))
@@ -1,15 +1,21 @@
 import json
 import os
+import re
 import time
-import requests
+import threading
 import cPickle as pickle
 from collections import defaultdict
 from xclib.conductor.models import Datacenter, Project, Group, Host
-from xclib.conductor.parser import ConductorExpression
+from xclib.atomic import atomic_pickle
+from xclib.conductor.planner import QueryPlan
+from xclib.filelock import FileLock
+from xclib.timing import timing, NULL_TIMER
 
 
 class CacheExpired(Exception):
-    pass
+    def __init__(self, projects=None):
+        Exception.__init__(self)
+        self.projects = projects or []
 
 
 class Autocompleter(object):
@@ -49,6 +55,44 @@ class Autocompleter(object):
             return set([x for x in self.data[prekey] if x.startswith(key)])
 
 
+class Autocompleters(object):
+    """
+    Completion indexes by category. Each one is loaded from its own cache
+    section or built from the inventory the first time it's needed, so
+    fetching and loading the inventory does no completion work at all.
+    """
+
+    CATEGORIES = (Host, Group, Project, Datacenter, "tags", "field_keys", "field_values")
+
+    def __init__(self, conductor):
+        self.__c = conductor
+        self.__data = {}
+        self.__lock = threading.Lock()
+
+    def get(self, category, timed=True):
+        with self.__lock:
+            if category not in self.__data:
+                self.__data[category] = self.__c.load_autocompleter(category, timed)
+            return self.__data[category]
+
+    def __getitem__(self, category):
+        return self.get(category)
+
+    def warm(self):
+        """
+        Prepares all categories in a background thread, completion
+        requests meanwhile wait for the category they need
+        """
+        def worker():
+            for category in self.CATEGORIES:
+                self.get(category, timed=False)
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
 class ConductorError(Exception):
     def __init__(self, status, body):
         Exception.__init__(self)
@@ -105,6 +149,12 @@ class Conductor(object):
     DEFAULT_PORT = 5000
     DEFAULT_CACHE_DIR = os.path.join(os.getenv("HOME"), ".xcute_cache")
     DEFAULT_CACHE_TTL = 3600
+    DEFAULT_FETCH_CONCURRENCY = 4
+    DEFAULT_FETCH_TIMEOUT = 30
+    DEFAULT_FETCH_RETRIES = 2
+    DEFAULT_LOCK_WAIT = 5
+    LOCK_FILENAME = "refresh.lock"
+    PERSISTENT_ID = "conductor"
 
     def __init__(self, projects,
                  cache_ttl=DEFAULT_CACHE_TTL,
@@ -112,36 +162,51 @@ class Conductor(object):
                  port=DEFAULT_PORT,
                  cache_dir=DEFAULT_CACHE_DIR,
                  drop_cache=False,
-                 print_func=None):
+                 print_func=None,
+                 fetch_concurrency=DEFAULT_FETCH_CONCURRENCY,
+                 fetch_timeout=DEFAULT_FETCH_TIMEOUT,
+                 fetch_retries=DEFAULT_FETCH_RETRIES,
+                 lock_wait=DEFAULT_LOCK_WAIT):
         self.print_func = print_func
+        self.fetch_concurrency = max(fetch_concurrency, 1)
+        self.fetch_timeout = fetch_timeout
+        self.fetch_retries = fetch_retries
+        self.lock_wait = lock_wait
         self.cache_ttl = cache_ttl
         self.cache_dir = cache_dir
         self.project_list = projects
+        self.conductor_host = host
+        self.conductor_port = port
         self.datacenters = DatacenterApi(self)
         self.projects = ProjectApi(self)
         self.groups = GroupApi(self)
         self.hosts = HostApi(self)
         self.cache = None
-        self.autocompleters = None
+        self.shards = {}
+        self.shard_mtimes = {}
+        self._host_indexes = {}
+        self._autocompleters = None
+        self._session = None
 
         if not os.path.isdir(self.cache_dir):
             os.makedirs(self.cache_dir)
 
-        project_list = ",".join(projects)
-        self.ex_url = "http://%s:%d/api/v1/open/executer_data?projects=%s&recursive=true" % (host, port, project_list)
-
         if drop_cache:
             self.fetch()
         else:
             try:
                 self.load()
+            except CacheExpired as e:
+                # fresh shards are kept, only the stale ones are refreshed
+                self.refresh(e.projects)
             except:
                 if self.print_func:
                     self.print_func("Reloading data from conductor...")
                 self.fetch()
 
-    def reset_cache(self):
-        self.cache = {
+    @staticmethod
+    def new_cache():
+        return {
             Datacenter: {
                 "_id": {},
                 Datacenter.KEY: {}
@@ -161,162 +226,413 @@ class Conductor(object):
                 Project.KEY: {}
             }
         }
-        self.autocompleters = {
-            Datacenter: Autocompleter(),
-            Group: Autocompleter(),
-            Host: Autocompleter(),
-            Project: Autocompleter(),
-            "tags": Autocompleter(),
-            "field_keys": Autocompleter(),
-            "field_values": Autocompleter()
-        }
+
+    def reset_cache(self):
+        self.cache = self.new_cache()
+        self.shards = {}
+        self._host_indexes = {}
+        self._autocompleters = None
 
     @property
-    def cache_filename(self):
-        filename = "cache_" + ".".join(self.project_list) + Host.STORE_VERSION + ".pickle"
-        return os.path.join(self.cache_dir, filename)
+    def autocompleters(self):
+        if self._autocompleters is None:
+            self._autocompleters = Autocompleters(self)
+        return self._autocompleters
 
     @property
-    def autocompleters_filename(self):
-        filename = "ac_" + ".".join(self.project_list) + Host.STORE_VERSION + ".pickle"
+    def session(self):
+        # one keep-alive connection pool shared by all fetch threads
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from requests.packages.urllib3.util.retry import Retry
+            retries = Retry(total=self.fetch_retries, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.fetch_concurrency, max_retries=retries)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["Accept-Encoding"] = "gzip"
+            self._session = session
+        return self._session
+
+    def project_url(self, project):
+        return "http://%s:%d/api/v1/open/executer_data?projects=%s&recursive=true" % \
+               (self.conductor_host, self.conductor_port, project)
+
+    def shard_filename(self, project):
+        filename = "shard_" + re.sub(r"[^\w.-]", "_", project) + "_" + Host.STORE_VERSION + ".pickle"
         return os.path.join(self.cache_dir, filename)
 
+    def autocompleter_filename(self, category):
+        section = category if isinstance(category, basestring) else category.__name__.lower()
+        filename = "ac_" + ".".join(self.project_list) + "_" + section + Host.STORE_VERSION + ".pickle"
+        return os.path.join(self.cache_dir, filename)
+
+    @property
+    def shards_signature(self):
+        return dict((project, shard["ts"]) for project, shard in self.shards.items())
+
+    def _persistent_id(self, obj):
+        # model objects keep a reference to the conductor, it's stored
+        # as a stub and bound to the loading conductor instead
+        if obj is self:
+            return self.PERSISTENT_ID
+        return None
+
+    def _persistent_load(self, pid):
+        if pid != self.PERSISTENT_ID:
+            raise pickle.UnpicklingError("unknown persistent id %s" % pid)
+        return self
+
+    def _dump(self, filename, data):
+        atomic_pickle(filename, data, ".xcute_cache.", self._persistent_id)
+
+    def load_shard(self, project):
+        with open(self.shard_filename(project), "rb") as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            unpickler = pickle.Unpickler(f)
+            unpickler.persistent_load = self._persistent_load
+            shard = unpickler.load()
+        if shard["project"] != project:
+            raise KeyError(project)
+        self.shard_mtimes[project] = mtime
+        return shard
+
+    def refresh(self, projects):
+        """
+        Fetches expired projects holding the cache lock, so when the cache
+        expires for several concurrent processes only one of them goes to
+        conductor. The others wait up to lock_wait seconds for the fresh
+        shards, or keep using the stale ones.
+        """
+        lock = FileLock(os.path.join(self.cache_dir, self.LOCK_FILENAME))
+        have_stale = all(p in self.shards for p in projects)
+        if not lock.acquire():
+            if self.print_func:
+                self.print_func("Waiting for another xcute process to refresh the cache...")
+            # with nothing to fall back to it's worth waiting for the whole fetch
+            wait = self.lock_wait if have_stale else self.fetch_timeout * (self.fetch_retries + 1)
+            if not lock.acquire(wait):
+                if have_stale:
+                    if self.print_func:
+                        self.print_func("Cache is still being refreshed, using stale data")
+                    return
+                self.fetch(projects)
+                return
+        try:
+            projects = self.reload_shards(projects)
+            if projects:
+                if self.print_func:
+                    self.print_func("Reloading data from conductor...")
+                self.fetch(projects)
+        finally:
+            lock.release()
+
+    def reload_shards(self, projects):
+        """
+        Re-reads shards rewritten by another process since they were
+        loaded, returns the projects which are still expired
+        """
+        stale = []
+        reloaded = False
+        now = time.time()
+        for project in projects:
+            try:
+                mtime = os.stat(self.shard_filename(project)).st_mtime
+                if mtime == self.shard_mtimes.get(project):
+                    stale.append(project)
+                    continue
+                shard = self.load_shard(project)
+            except (OSError, IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, KeyError):
+                stale.append(project)
+                continue
+            self.shards[project] = shard
+            reloaded = True
+            if now - shard["ts"] > self.cache_ttl:
+                stale.append(project)
+        if reloaded:
+            self.merge_shards()
+            self._autocompleters = None
+        return stale
+
+    def expired(self):
+        now = time.time()
+        return [p for p in self.project_list
+                if p not in self.shards or now - self.shards[p]["ts"] > self.cache_ttl]
+
+    def sync(self):
+        """
+        Keeps a long-lived instance up to date: re-reads shards rewritten
+        by other processes and refreshes the expired ones
+        """
+        changed = []
+        for project in self.project_list:
+            try:
+                if os.stat(self.shard_filename(project)).st_mtime != self.shard_mtimes.get(project):
+                    changed.append(project)
+            except OSError:
+                pass
+        if changed:
+            self.reload_shards(changed)
+        expired = self.expired()
+        if expired:
+            self.refresh(expired)
+
     def load(self, fallback=False):
-        with open(self.cache_filename) as cf:
-            data = pickle.load(cf)
-            if time.time() - data["ts"] > self.cache_ttl and not fallback:
-                raise CacheExpired()
-            else:
-                self.cache = data["data"]
-        with open(self.autocompleters_filename) as cf:
-            data = pickle.load(cf)
-            if time.time() - data["ts"] > self.cache_ttl and not fallback:
-                raise CacheExpired()
-            else:
-                self.autocompleters = data["data"]
+        stale = []
+        with timing.timer("conductor.load"):
+            now = time.time()
+            shards = {}
+            for project in self.project_list:
+                try:
+                    shard = self.load_shard(project)
+                except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, KeyError):
+                    stale.append(project)
+                    continue
+                shards[project] = shard
+                if now - shard["ts"] > self.cache_ttl and not fallback:
+                    # expired shards are still kept to fall back to
+                    stale.append(project)
+            self.shards = shards
+            self.merge_shards()
+        timing.count("conductor.load.shards", len(shards))
+        self._autocompleters = None
+        if stale:
+            raise CacheExpired(stale)
+
+    def merge_shards(self):
+        shards = [self.shards[p]["data"] for p in self.project_list if p in self.shards]
+        self._host_indexes = {}
+        if len(shards) == 1:
+            self.cache = shards[0]
+            return
+        cache = self.new_cache()
+        for shard in shards:
+            for cls, indexes in shard.items():
+                for key, index in indexes.items():
+                    if type(index) == defaultdict:
+                        for value, items in index.items():
+                            cache[cls][key][value].update(items)
+                    else:
+                        # datacenters come with every project, the last copy wins
+                        cache[cls][key].update(index)
+        self.cache = cache
+
+    def load_autocompleter(self, category, timed=True):
+        """
+        Loads a completion section built from the current shards or
+        builds (and saves) it
+        """
+        signature = self.shards_signature
+        filename = self.autocompleter_filename(category)
+        try:
+            with timing.timer("conductor.load.autocompleters") if timed else NULL_TIMER:
+                with open(filename, "rb") as cf:
+                    data = pickle.load(cf)
+            if data["shards"] == signature:
+                return data["data"]
+        except (IOError, EOFError, pickle.UnpicklingError, KeyError):
+            pass
+        with timing.timer("conductor.build.autocompleters") if timed else NULL_TIMER:
+            autocompleter = self.build_autocompleter(category)
+        try:
+            self._dump(filename, {"ts": time.time(), "shards": signature, "data": autocompleter})
+        except (IOError, OSError):
+            pass
+        return autocompleter
+
+    def build_autocompleter(self, category):
+        autocompleter = Autocompleter()
+        if self.cache is None:
+            return autocompleter
+        if category in (Datacenter, Group, Host, Project):
+            for name in self.cache[category][category.KEY]:
+                autocompleter.add(name)
+        elif category == "tags":
+            for host in self.cache[Host]["_id"].values():
+                for tag in getattr(host, "all_tags", None) or []:
+                    autocompleter.add(tag)
+        elif category in ("field_keys", "field_values"):
+            for host in self.cache[Host]["_id"].values():
+                for field in getattr(host, "all_custom_fields", None) or []:
+                    if category == "field_keys":
+                        autocompleter.add(field["key"] + "=")
+                    else:
+                        autocompleter.add(field["value"])
+        else:
+            raise KeyError(category)
+        return autocompleter
 
-    def save(self):
+    def save(self, projects=None):
         if self.print_func:
             self.print_func("Saving cache...")
         if not os.path.isdir(self.cache_dir):
             os.makedirs(self.cache_dir)
-        with open(self.cache_filename, "w") as cf:
-            pickle.dump({ "ts": time.time(), "data": self.cache }, cf)
-        with open(self.autocompleters_filename, "w") as cf:
-            pickle.dump({ "ts": time.time(), "data": self.autocompleters }, cf)
-
-    def fetch(self):
-        self.reset_cache()
-        try:
-            response = requests.get(self.ex_url)
-            if response.status_code != 200:
-                raise ConductorError(response.status_code, response.content)
-        except Exception as e:
-            if self.print_func:
-                self.print_func(e)
-                self.print_func("Error getting data from conductor, falling back to cache")
+        if projects is None:
+            projects = self.shards.keys()
+        with timing.timer("conductor.save"):
+            for project in projects:
+                self._dump(self.shard_filename(project), self.shards[project])
+
+    def fetch(self, projects=None):
+        if projects is None:
+            projects = self.project_list
+        fetched = {}
+        failed = []
+        for project, response, exc in self.download(projects):
+            if exc is not None:
+                if self.print_func:
+                    self.print_func(exc)
+                failed.append(project)
+                continue
+            timing.count("conductor.fetch.bytes", len(response.content))
+            timing.count("conductor.fetch.wire_bytes", int(response.headers.get("Content-Length") or 0))
+            # responses are indexed as they arrive while the rest are downloading
+            with timing.timer("conductor.fetch.json"):
+                data = json.loads(response.content)["data"]
+            with timing.timer("conductor.fetch.index"):
+                fetched[project] = {"ts": time.time(), "project": project, "data": self.build_indexes(data)}
+
+        if failed:
+            self.fallback(failed)
+        self.shards.update(fetched)
+        self.merge_shards()
+        self._autocompleters = None
+        if fetched:
+            self.save(fetched.keys())
+
+    def download(self, projects):
+        """
+        Requests projects concurrently over the shared session and yields
+        (project, response, exception) in order of arrival
+        """
+        from Queue import Queue, Empty
+
+        # created here, threads building it at once would each get their own pool
+        session = self.session
+        tasks = Queue()
+        for project in projects:
+            tasks.put(project)
+        results = Queue()
+
+        def worker():
+            while True:
+                try:
+                    project = tasks.get_nowait()
+                except Empty:
+                    return
+                try:
+                    response = session.get(self.project_url(project), timeout=self.fetch_timeout)
+                    if response.status_code != 200:
+                        raise ConductorError(response.status_code, response.content)
+                    results.put((project, response, None))
+                except Exception as e:
+                    results.put((project, None, e))
+
+        for _ in xrange(min(self.fetch_concurrency, len(projects))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        for _ in xrange(len(projects)):
+            with timing.timer("conductor.fetch.http"):
+                while True:
+                    # waiting with a timeout keeps the main thread interruptible
+                    try:
+                        result = results.get(True, 1)
+                        break
+                    except Empty:
+                        continue
+            yield result
+
+    def fallback(self, projects):
+        if self.print_func:
+            self.print_func("Error getting data from conductor, falling back to cache")
+        missing = []
+        for project in projects:
+            if project in self.shards:
+                continue
             try:
-                self.load(fallback=True)
-            except IOError:
-                # Here we don't have any cache and don't have a conductor connection
-                self.print_func("No conductor connection and no cache found, running xcute for the first time? Please configure xcute properly editing ~/.xcute.conf file. An example has been already there.")
-                return
+                self.shards[project] = self.load_shard(project)
+            except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, KeyError):
+                missing.append(project)
+        if not missing or not self.print_func:
             return
-        data = json.loads(response.content)["data"]
+        if len(missing) == len(self.project_list):
+            # Here we don't have any cache and don't have a conductor connection
+            self.print_func("No conductor connection and no cache found, running xcute for the first time? Please configure xcute properly editing ~/.xcute.conf file. An example has been already there.")
+        else:
+            self.print_func("No cached data for project(s) %s" % ", ".join(missing))
 
+    def build_indexes(self, data):
+        cache = self.new_cache()
         for dc_params in data["datacenters"]:
             datacenter = Datacenter(self, **dc_params)
-            self.cache[Datacenter]["_id"][datacenter._id] = datacenter
-            self.cache[Datacenter][Datacenter.KEY][dc_params[Datacenter.KEY]] = datacenter
-            self.autocompleters[Datacenter].add(dc_params[Datacenter.KEY])
+            cache[Datacenter]["_id"][datacenter._id] = datacenter
+            cache[Datacenter][Datacenter.KEY][dc_params[Datacenter.KEY]] = datacenter
 
         for p_params in data["projects"]:
             project = Project(self, **p_params)
-            self.cache[Project]["_id"][project._id] = project
-            self.cache[Project][Project.KEY][p_params[Project.KEY]] = project
-            self.autocompleters[Project].add(p_params[Project.KEY])
+            cache[Project]["_id"][project._id] = project
+            cache[Project][Project.KEY][p_params[Project.KEY]] = project
 
         for g_params in data["groups"]:
             group = Group(self, **g_params)
-            self.cache[Group]["_id"][group._id] = group
-            self.cache[Group][Group.KEY][g_params[Group.KEY]] = group
-            self.cache[Group]["project_id"][group.project_id].add(group)
-            self.autocompleters[Group].add(g_params[Group.KEY])
+            cache[Group]["_id"][group._id] = group
+            cache[Group][Group.KEY][g_params[Group.KEY]] = group
+            cache[Group]["project_id"][group.project_id].add(group)
 
         for h_params in data["hosts"]:
             host = Host(self, **h_params)
-            self.cache[Host]["_id"][host._id] = host
-            self.cache[Host][Host.KEY][h_params[Host.KEY]] = host
-            self.autocompleters[Host].add(h_params[Host.KEY])
-            if "all_tags" in h_params and len(h_params["all_tags"]) > 0:
-                for tag in h_params["all_tags"]:
-                    self.autocompleters["tags"].add(tag)
-            if "all_custom_fields" in h_params and len(h_params["all_custom_fields"]) > 0:
-                for field in h_params["all_custom_fields"]:
-                    self.autocompleters["field_keys"].add(field["key"]+"=")
-                    self.autocompleters["field_values"].add(field["value"])
-
+            cache[Host]["_id"][host._id] = host
+            cache[Host][Host.KEY][h_params[Host.KEY]] = host
             if host.group_id is not None:
-                self.cache[Host]["group_id"][host.group_id].add(host)
+                cache[Host]["group_id"][host.group_id].add(host)
+        timing.count("conductor.fetch.hosts", len(data["hosts"]))
+        return cache
+
+    def host_index(self, name):
+        """
+        Secondary host indexes used by the query planner, built on first use:
+        "tags" (tag -> hosts), "fields" ((key, value) -> hosts) and
+        "datacenter_id" (datacenter id -> hosts)
+        """
+        index = self._host_indexes.get(name)
+        if index is not None:
+            return index
+        with timing.timer("conductor.build.index"):
+            index = defaultdict(set)
+            hosts = self.cache[Host]["_id"].values()
+            if name == "tags":
+                for host in hosts:
+                    for tag in getattr(host, "all_tags", None) or []:
+                        index[tag].add(host)
+            elif name == "fields":
+                for host in hosts:
+                    for field in getattr(host, "all_custom_fields", None) or []:
+                        try:
+                            index[(field["key"], field["value"])].add(host)
+                        except TypeError:
+                            # unhashable values can't match an expression anyway
+                            pass
+            elif name == "datacenter_id":
+                for host in hosts:
+                    index[getattr(host, "datacenter_id", None)].add(host)
+            else:
+                raise KeyError(name)
+            index = dict(index)
+        self._host_indexes[name] = index
+        return index
 
-        self.save()
+    def plan(self, expr):
+        with timing.timer("conductor.resolve.plan"):
+            return QueryPlan(self, expr)
 
     def resolve(self, expr):
-        tokens = expr.split(",")
-        result_hosts = set()
-
-        for token in tokens:
-            parsed = ConductorExpression(token)
-            hosts = set()
-            rawhost = None
-
-            if parsed.token.type == "group":
-                group = self.groups.get(Group.KEY, parsed.token.data)
-                if group is not None:
-                    hosts = set(group.all_hosts)
-            elif parsed.token.type == "project":
-                project = self.projects.get(Project.KEY, parsed.token.data)
-                if project:
-                    for group in project.groups:
-                        hosts = hosts.union(group.all_hosts)
-            elif parsed.token.type == "entire":
-                projects = self.projects.all()
-                for project in projects:
-                    for group in project.groups:
-                        hosts = hosts.union(group.all_hosts)
-            else:
-                host = self.hosts.get(Host.KEY, parsed.token.data)
-                if host:
-                    hosts.add(host)
-                else:
-                    rawhost = parsed.token.data
-
-            if len(hosts) > 0:
-                if parsed.datacenter_filter:
-                    hosts = set([h for h in hosts if h.in_datacenter(parsed.datacenter_filter)])
-                if parsed.tags_filter:
-                    hosts = set([h for h in hosts
-                                 if set(h.all_tags).intersection(parsed.tags_filter) == set(parsed.tags_filter)])
-                if parsed.fields_filter:
-                    for key, value in parsed.fields_filter.items():
-                        field_data = { "key": key, "value": value }
-                        hosts = set([h for h in hosts if field_data in h.all_custom_fields])
-                if parsed.exclude:
-                    result_hosts = result_hosts.difference(set([x.fqdn for x in hosts]))
-                else:
-                    result_hosts = result_hosts.union(set([x.fqdn for x in hosts]))
-
-            if rawhost:
-                # raw hosts are always filtered out if any filters exist
-                if parsed.datacenter_filter is None and \
-                                parsed.fields_filter is None and \
-                                parsed.tags_filter is None:
-                    if parsed.exclude:
-                        try:
-                            result_hosts.remove(rawhost)
-                        except:
-                            pass
-                    else:
-                        result_hosts.add(rawhost)
+        with timing.timer("conductor.resolve"):
+            return self.plan(expr).execute()
 
-        return result_hosts
+    def explain(self, expr):
+        plan = self.plan(expr)
+        plan.execute()
+        return plan.explain()
@@ -1,7 +1,7 @@
 
 class ConductorObject(object):
 
-    STORE_VERSION = "1.0.5"
+    STORE_VERSION = "1.0.6"
 
     KEY = None
     FIELDS = []
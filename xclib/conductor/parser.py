@@ -1,8 +1,32 @@
-from pyparsing import Word, srange, ZeroOrMore, \
-    OneOrMore, Suppress, Optional, Literal, Group, stringEnd
+import re
 from collections import namedtuple
 
-class ConductorExpression(object):
+
+class ParseError(Exception):
+    pass
+
+
+COMMON_NAME = r"[a-zA-Z0-9_\-\.]+"
+SINGLE_DOMAIN_NAME = r"[0-9a-z_\-]+"
+FIELD_VALUE = r"[a-zA-Z0-9_\-\.:]+"
+
+# Regular equivalent of the pyparsing grammar below, pyparsing is only
+# imported to report errors in expressions this doesn't match. A leading
+# sign is always taken as the inclusion operator: pyparsing doesn't
+# backtrack into the host name, which may start with "-" too
+EXPRESSION_RE = re.compile(
+    r"^(?:(?P<inclusion>[-+])|(?![-+]))"
+    r"(?:%(?P<group>{cn})|\*(?P<project>{cn})|(?P<host>{sdn}(?:\.{sdn})+)|(?P<entire>\*))"
+    r"(?:@(?P<datacenter>{cn}))?"
+    r"(?P<filters>(?:#{cn}|\[{cn}={fv}\])*)$".format(cn=COMMON_NAME, sdn=SINGLE_DOMAIN_NAME, fv=FIELD_VALUE)
+)
+HOST_RE = re.compile(r"^{sdn}(?:\.{sdn})+$".format(sdn=SINGLE_DOMAIN_NAME))
+FILTER_RE = re.compile(r"#(?P<tag>{cn})|\[(?P<key>{cn})=(?P<value>{fv})\]".format(cn=COMMON_NAME, fv=FIELD_VALUE))
+
+
+def build_grammar():
+    from pyparsing import Word, srange, ZeroOrMore, \
+        OneOrMore, Suppress, Optional, Literal, Group, stringEnd
 
     CommonName = Word(srange("[a-zA-Z0-9_\-\.]"))
     SingleDomainName = Word(srange("[0-9a-z_\-]"))
@@ -36,6 +60,12 @@ class ConductorExpression(object):
                            Filters + stringEnd)("expression")
 
     Expression.setWhitespaceChars("")
+    return Expression
+
+
+class ConductorExpression(object):
+
+    Expression = None
 
     __slots__ = (
         "token",
@@ -52,7 +82,44 @@ class ConductorExpression(object):
         self.datacenter_filter = None
         self.tags_filter = None
         self.fields_filter = None
-        result = self.Expression.parseString(token)
+        self.result = None
+
+        match = EXPRESSION_RE.match(token)
+        if match is None:
+            self.parse_slow(token)
+            return
+
+        if match.group("host") is not None:
+            self.token = ConductorExpression.ListToken("host", match.group("host"))
+        elif match.group("group") is not None:
+            self.token = ConductorExpression.ListToken("group", match.group("group"))
+        elif match.group("project") is not None:
+            self.token = ConductorExpression.ListToken("project", match.group("project"))
+        else:
+            self.token = ConductorExpression.ListToken("entire", "")
+
+        self.exclude = match.group("inclusion") == "-"
+        self.datacenter_filter = match.group("datacenter")
+
+        if match.group("filters"):
+            for f in FILTER_RE.finditer(match.group("filters")):
+                if f.group("tag") is not None:
+                    if self.tags_filter is None:
+                        self.tags_filter = []
+                    self.tags_filter.append(f.group("tag"))
+                else:
+                    if self.fields_filter is None:
+                        self.fields_filter = {}
+                    self.fields_filter[f.group("key")] = f.group("value")
+
+    def parse_slow(self, token):
+        from pyparsing import ParseException
+        if ConductorExpression.Expression is None:
+            ConductorExpression.Expression = build_grammar()
+        try:
+            result = self.Expression.parseString(token)
+        except ParseException as e:
+            raise ParseError(str(e))
         self.result = result
 
         if result.token.host != "":
@@ -0,0 +1,313 @@
+import os
+import sys
+from xclib.conductor.models import Project, Group, Host
+from xclib.conductor.parser import ConductorExpression, ParseError, HOST_RE
+
+
+class Constraint(object):
+    """
+    One condition of an expression token: the group/project closure it
+    starts from or one of its @dc, #tag and [key=value] filters. A
+    constraint either provides an index set of matching hosts or checks
+    hosts one by one, whatever is cheaper for its kind.
+    """
+
+    __slots__ = ("description", "estimate", "hosts", "predicate")
+
+    def __init__(self, description, estimate, hosts=None, predicate=None):
+        self.description = description
+        self.estimate = estimate
+        self.hosts = hosts
+        self.predicate = predicate
+
+    def materialize(self):
+        if self.hosts is None:
+            return set()
+        if callable(self.hosts):
+            return self.hosts()
+        return set(self.hosts)
+
+    def apply(self, candidates):
+        if self.predicate is not None:
+            return set([h for h in candidates if self.predicate(h)])
+        hosts = self.hosts() if callable(self.hosts) else self.hosts
+        return candidates.intersection(hosts)
+
+
+class TokenPlan(object):
+
+    def __init__(self, conductor, token):
+        self.conductor = conductor
+        self.text = token
+        self.parsed = ConductorExpression(token)
+        self.exclude = self.parsed.exclude
+        self.rawhost = None
+        self.constraints = []
+        self.steps = []
+        self.plan()
+
+    @property
+    def has_filters(self):
+        parsed = self.parsed
+        return parsed.datacenter_filter is not None or \
+            parsed.tags_filter is not None or \
+            parsed.fields_filter is not None
+
+    def plan(self):
+        source = self.source()
+        if source is None:
+            return
+        self.constraints.append(source)
+        parsed = self.parsed
+        if parsed.datacenter_filter is not None:
+            self.constraints.append(self.datacenter_constraint(parsed.datacenter_filter))
+        for tag in parsed.tags_filter or []:
+            hosts = self.conductor.host_index("tags").get(tag, ())
+            self.constraints.append(Constraint("#%s" % tag, len(hosts), hosts))
+        for key, value in (parsed.fields_filter or {}).items():
+            hosts = self.conductor.host_index("fields").get((key, value), ())
+            self.constraints.append(Constraint("[%s=%s]" % (key, value), len(hosts), hosts))
+        # the most selective constraint provides candidates, others narrow them down
+        self.constraints.sort(key=lambda x: x.estimate)
+
+    def source(self):
+        c = self.conductor
+        token = self.parsed.token
+        if token.type == "host":
+            host = c.hosts.get(Host.KEY, token.data)
+            if host is None:
+                self.rawhost = token.data
+                return None
+            return Constraint("host %s" % host.fqdn, 1, set([host]))
+
+        if token.type == "group":
+            group = c.groups.get(Group.KEY, token.data)
+            roots = [group] if group is not None else []
+            description = "%%%s closure" % token.data
+        elif token.type == "project":
+            project = c.projects.get(Project.KEY, token.data)
+            roots = list(project.groups) if project else []
+            description = "*%s closure" % token.data
+        else:
+            roots = []
+            for project in c.projects.all():
+                roots.extend(project.groups)
+            description = "* closure"
+
+        group_ids = self.group_closure(roots)
+        by_group = c.hosts.get_cache("group_id")
+        estimate = sum(len(by_group[gid]) for gid in group_ids if gid in by_group)
+
+        def hosts():
+            result = set()
+            for gid in group_ids:
+                if gid in by_group:
+                    result.update(by_group[gid])
+            return result
+
+        return Constraint("%s (%d groups)" % (description, len(group_ids)), estimate, hosts,
+                          lambda h: h.group_id in group_ids)
+
+    def group_closure(self, roots):
+        groups = self.conductor.groups
+        ids = set()
+        queue = [g._id for g in roots]
+        while queue:
+            gid = queue.pop()
+            if gid in ids:
+                continue
+            ids.add(gid)
+            group = groups.get("_id", gid)
+            if group is not None:
+                queue.extend(group.child_ids)
+        return ids
+
+    def datacenter_constraint(self, name):
+        c = self.conductor
+        # a host is in a datacenter if the datacenter is its own one or an ancestor
+        dc_ids = set()
+        for dc in c.datacenters.get_cache("_id").values():
+            current = dc
+            while current is not None:
+                if current.name == name:
+                    dc_ids.add(dc._id)
+                    break
+                current = current.parent
+        by_dc = c.host_index("datacenter_id")
+        estimate = sum(len(by_dc.get(dc_id, ())) for dc_id in dc_ids)
+
+        def hosts():
+            result = set()
+            for dc_id in dc_ids:
+                result.update(by_dc.get(dc_id, ()))
+            return result
+
+        return Constraint("@%s (%d datacenters)" % (name, len(dc_ids)), estimate, hosts,
+                          lambda h: h.datacenter_id in dc_ids)
+
+    def execute(self):
+        """
+        Returns the set of matching hosts recording the candidate count
+        after every step
+        """
+        self.steps = []
+        if not self.constraints:
+            return set()
+        first = self.constraints[0]
+        hosts = first.materialize()
+        self.steps.append((first, len(hosts)))
+        for constraint in self.constraints[1:]:
+            if not hosts:
+                break
+            hosts = constraint.apply(hosts)
+            self.steps.append((constraint, len(hosts)))
+        return hosts
+
+    def resolve(self):
+        fqdns = set([h.fqdn for h in self.execute()])
+        if self.rawhost and not self.has_filters:
+            # raw hosts are always filtered out if any filters exist
+            fqdns.add(self.rawhost)
+        return fqdns
+
+    def explain_lines(self, indent="  "):
+        lines = []
+        if self.rawhost:
+            lines.append("%shost %s is not in the inventory, used as is%s" %
+                         (indent, self.rawhost, " (dropped: has filters)" if self.has_filters else ""))
+        for step, (constraint, count) in enumerate(self.steps):
+            lines.append("%s%d. %-40s est %8d -> %8d" % (indent, step + 1, constraint.description,
+                                                        constraint.estimate, count))
+        for constraint in self.constraints[len(self.steps):]:
+            lines.append("%s-. %-40s est %8d    skipped" % (indent, constraint.description, constraint.estimate))
+        return lines
+
+
+class HostListPlan(object):
+    """
+    @file token (@- reads stdin): a host list with one fqdn or expression
+    per line. Runs of plain fqdns are resolved in one pass against the
+    host index, other lines are planned as regular tokens, in order.
+    """
+
+    def __init__(self, conductor, token):
+        self.conductor = conductor
+        self.text = token
+        self.exclude = token.startswith("-")
+        self.source = token.lstrip("+-")[1:]
+        self.parts = []
+        self.results = []
+
+        fqdns = None
+        for item in self.read():
+            if item[0] not in "+-" and HOST_RE.match(item):
+                if fqdns is None:
+                    fqdns = []
+                    self.parts.append(fqdns)
+                fqdns.append(item)
+                continue
+            fqdns = None
+            if item.lstrip("+-").startswith("@"):
+                raise ParseError("host list %s can't include another host list" % self.source)
+            self.parts.append(TokenPlan(conductor, item))
+
+    def read(self):
+        if not self.source:
+            raise ParseError("host list file name expected after @")
+        try:
+            if self.source == "-":
+                if sys.stdin.isatty():
+                    raise ParseError("@- reads a host list from stdin, which is a terminal")
+                data = read_stdin()
+            else:
+                with open(os.path.expanduser(self.source)) as f:
+                    data = f.read()
+        except (IOError, OSError) as e:
+            raise ParseError("can't read host list %s: %s" % (self.source, e))
+        items = []
+        for line in data.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            items.extend([x.strip() for x in line.split(",") if x.strip()])
+        return items
+
+    def resolve(self):
+        fqdns = set()
+        self.results = []
+        for part in self.parts:
+            if isinstance(part, list):
+                fqdns.update(part)
+            elif part.exclude:
+                fqdns.difference_update(part.resolve())
+            else:
+                fqdns.update(part.resolve())
+            self.results.append(len(fqdns))
+        return fqdns
+
+    def explain_lines(self, indent="  "):
+        by_fqdn = self.conductor.hosts.get_cache(Host.KEY)
+        lines = []
+        for num, part in enumerate(self.parts):
+            if isinstance(part, list):
+                known = len([x for x in part if x in by_fqdn])
+                lines.append("%sbulk: %d fqdn(s), %d in the inventory, %d used as is" %
+                             (indent, len(part), known, len(part) - known))
+            else:
+                lines.append("%s%s %s" % (indent, "exclude" if part.exclude else "include", part.text))
+                lines.extend(part.explain_lines(indent + "  "))
+            if num < len(self.results):
+                lines.append("%s= %d host(s)" % (indent, self.results[num]))
+        return lines
+
+
+STDIN_DATA = None
+
+
+def read_stdin():
+    # stdin can be read only once, the same list may be needed again
+    global STDIN_DATA
+    if STDIN_DATA is None:
+        STDIN_DATA = sys.stdin.read()
+    return STDIN_DATA
+
+
+def token_plan(conductor, token):
+    if token.lstrip("+-").startswith("@"):
+        return HostListPlan(conductor, token)
+    return TokenPlan(conductor, token)
+
+
+class QueryPlan(object):
+    """
+    Plans and evaluates a conductor expression. Tokens are still applied
+    left to right (an exclusion only removes what's been included before
+    it), but within a token evaluation starts from the most selective
+    index instead of the full group/project host list.
+    """
+
+    def __init__(self, conductor, expr):
+        self.expr = expr
+        self.tokens = [token_plan(conductor, token) for token in expr.split(",")]
+        self.totals = []
+
+    def execute(self):
+        result_hosts = set()
+        self.totals = []
+        for token in self.tokens:
+            fqdns = token.resolve()
+            if token.exclude:
+                result_hosts.difference_update(fqdns)
+            else:
+                result_hosts.update(fqdns)
+            self.totals.append(len(result_hosts))
+        return result_hosts
+
+    def explain(self):
+        lines = []
+        for num, token in enumerate(self.tokens):
+            lines.append("%s %s" % ("exclude" if token.exclude else "include", token.text))
+            lines.extend(token.explain_lines())
+            if num < len(self.totals):
+                lines.append("  = %d host(s) in total" % self.totals[num])
+        return lines
@@ -0,0 +1,99 @@
+"""
+xcute daemon: a long-running Cli serving one-shot commands over a Unix
+socket, so `x <command>` doesn't pay for startup and cache loading and
+reuses resolve caches and ssh master connections.
+
+This module is imported by the thin client before anything else, keep
+its imports light: the server lives in xclib.daemonserver, socket and
+json are only loaded when a daemon may be listening.
+"""
+import os
+import sys
+import errno
+
+# commands the thin client hands over to a running daemon, everything
+# else (interactive shell, serial mode, stdin input) runs in-process
+COMMANDS = ("hostlist", "explain", "exec", "p_exec", "c_exec", "r_exec", "cap_exec",
+            "pipeline", "ping", "distribute", "script")
+
+# the first line of every reply: the request is run or the client has to
+# run it in-process
+ACCEPTED = "ok\n"
+BUSY = "busy\n"
+
+
+def served_by_daemon(line):
+    parts = line.split(None, 1)
+    # @- reads a host list from stdin of the client, which the daemon hasn't got
+    return bool(parts) and parts[0] in COMMANDS and "@-" not in line
+
+
+class DaemonClient(object):
+
+    BUFFER_SIZE = 65536
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        """
+        Returns a connected socket or None if no daemon is listening
+        """
+        if not os.path.exists(self.path):
+            return None
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error as e:
+            sock.close()
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.ENOTSOCK, errno.EACCES):
+                return None
+            raise
+        return sock
+
+    def run(self, line, overrides):
+        """
+        Runs the command in the daemon streaming its output to stdout.
+        Returns False if there is no daemon to run it or it is busy with
+        another request. Closing the connection cancels the command.
+        """
+        sock = self.connect()
+        if sock is None:
+            return False
+        import json
+        import socket
+        request = {"cmd": line, "cwd": os.getcwd(), "options": overrides}
+        try:
+            try:
+                sock.sendall(json.dumps(request) + "\n")
+                reply = ""
+                while "\n" not in reply:
+                    data = sock.recv(self.BUFFER_SIZE)
+                    if not data:
+                        return False
+                    reply += data
+            except socket.error as e:
+                # turned away before the request was read
+                if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                    raise
+                return False
+            status, data = reply.split("\n", 1)
+            if status + "\n" != ACCEPTED:
+                return False
+            out = sys.stdout.fileno()
+            while True:
+                if data:
+                    os.write(out, data)
+                data = sock.recv(self.BUFFER_SIZE)
+                if not data:
+                    break
+        except OSError as e:
+            # stdout closed, e.g. piped to head
+            if e.errno != errno.EPIPE:
+                raise
+        except KeyboardInterrupt:
+            pass
+        finally:
+            sock.close()
+        return True
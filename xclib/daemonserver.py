@@ -0,0 +1,211 @@
+"""
+The xcute daemon server, see xclib.daemon. Only `x --daemon` imports it.
+"""
+import os
+import sys
+import json
+import errno
+import select
+import socket
+import threading
+import traceback
+from xclib.daemon import ACCEPTED, BUSY, DaemonClient
+
+
+class RequestWatcher(threading.Thread):
+    """
+    Watches the sockets while a request runs: turns away other clients
+    as busy and cancels the request, killing its ssh children, when its
+    client hangs up.
+    """
+
+    def __init__(self, shell, conn, listener):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.shell = shell
+        self.conn = conn
+        self.listener = listener
+        self.rfd, self.wfd = os.pipe()
+
+    def run(self):
+        watched = [self.conn, self.listener, self.rfd]
+        while True:
+            try:
+                ready, _, _ = select.select(watched, [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.rfd in ready:
+                return
+            if self.listener in ready:
+                self.turn_away()
+            if self.conn in ready:
+                try:
+                    data = self.conn.recv(4096)
+                except socket.error:
+                    data = ""
+                if not data:
+                    self.shell.cancel()
+                    watched.remove(self.conn)
+
+    def turn_away(self):
+        try:
+            conn, _ = self.listener.accept()
+        except socket.error:
+            return
+        try:
+            conn.sendall(BUSY)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def finish(self):
+        os.write(self.wfd, "x")
+        self.join()
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+
+class DaemonServer(object):
+    """
+    Serves requests one at a time: the command's output, including the
+    output of ssh children, goes straight to the client socket which is
+    put in place of stdout and stderr for the time of the request. Clients
+    coming meanwhile are told to run their commands in-process.
+    """
+
+    # Cli attributes a request may override, restored afterwards
+    OVERRIDES = ("mode", "progressbar", "user", "unreachable_policy", "input", "sample", "first", "first_match")
+
+    def __init__(self, shell, path):
+        self.shell = shell
+        self.path = path
+        self.listener = None
+
+    def listen(self):
+        if DaemonClient(self.path).connect() is not None:
+            raise RuntimeError("another daemon is listening on %s" % self.path)
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(64)
+        self.listener = listener
+
+    def serve_forever(self):
+        self.listen()
+        try:
+            while True:
+                try:
+                    conn, _ = self.listener.accept()
+                except socket.error as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    self.handle(conn)
+                finally:
+                    conn.close()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.listener is None:
+            return
+        self.listener.close()
+        self.listener = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def read_request(self, conn):
+        f = conn.makefile("rb")
+        try:
+            request = json.loads(f.readline())
+        except ValueError:
+            return None
+        finally:
+            f.close()
+        # the cli works with byte strings
+        for key in ("cmd", "cwd"):
+            request[key] = request[key].encode("utf-8")
+        options = request.get("options") or {}
+        for key, value in options.items():
+            if isinstance(value, unicode):
+                options[key] = value.encode("utf-8")
+        request["options"] = options
+        return request
+
+    def handle(self, conn):
+        from xclib.timing import timing
+        from xclib.conductor import planner
+        request = self.read_request(conn)
+        if not request:
+            return
+        try:
+            conn.sendall(ACCEPTED)
+        except socket.error:
+            return
+        shell = self.shell
+        watcher = RequestWatcher(shell, conn, self.listener)
+        watcher.start()
+        options = request["options"]
+        saved = dict((key, getattr(shell, key)) for key in self.OVERRIDES)
+        saved_timing = timing.enabled
+        cwd = os.getcwd()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        stdout, stderr = os.dup(1), os.dup(2)
+        os.dup2(conn.fileno(), 1)
+        os.dup2(conn.fileno(), 2)
+        try:
+            os.chdir(request.get("cwd") or cwd)
+            for key in self.OVERRIDES:
+                if key in options:
+                    setattr(shell, key, options[key])
+            timing.enabled = bool(options.get("timing"))
+            shell.timing_started = None
+            # pick up shards refreshed by others, refresh expired ones
+            shell.conductor.sync()
+            shell.onecmd(request["cmd"])
+        except (IOError, OSError) as e:
+            # the client went away
+            if e.errno != errno.EPIPE:
+                traceback.print_exc()
+        except KeyboardInterrupt:
+            # cancelled
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            watcher.finish()
+            shell.running_backend = None
+            shell.cancelled = False
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            except IOError:
+                pass
+            os.dup2(stdout, 1)
+            os.dup2(stderr, 2)
+            os.close(stdout)
+            os.close(stderr)
+            for key, value in saved.items():
+                setattr(shell, key, value)
+            timing.enabled = saved_timing
+            timing.reset()
+            # stdin read by one request isn't another's
+            planner.STDIN_DATA = None
+            shell.finished = False
+            os.chdir(cwd)
@@ -0,0 +1,92 @@
+import os
+import time
+import cPickle as pickle
+from xclib.atomic import atomic_pickle
+
+
+class AddressCache(object):
+    """
+    Resolves a whole host set concurrently before fan-out, so ssh/scp/ping
+    children get an address instead of doing a DNS lookup each. Addresses
+    are kept for `ttl` seconds next to the inventory cache.
+    """
+
+    FILENAME = "addresses.pickle"
+    DEFAULT_TTL = 300
+    DEFAULT_CONCURRENCY = 100
+
+    def __init__(self, cache_dir, ttl=DEFAULT_TTL, concurrency=DEFAULT_CONCURRENCY):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.__data = None
+        self.__dirty = False
+
+    @property
+    def filename(self):
+        return os.path.join(self.cache_dir, self.FILENAME)
+
+    @property
+    def data(self):
+        if self.__data is None:
+            try:
+                with open(self.filename, "rb") as f:
+                    self.__data = pickle.load(f)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                self.__data = {}
+        return self.__data
+
+    def get(self, host):
+        item = self.data.get(host)
+        if item is None or time.time() - item[0] > self.ttl:
+            return None
+        return item[1]
+
+    def resolve_all(self, hosts):
+        """
+        Returns a dict of host -> address and a dict of host -> error
+        for the hosts which could not be resolved
+        """
+        from gevent import socket
+        from gevent.pool import Pool
+
+        addresses = {}
+        failures = {}
+        missing = []
+        for host in hosts:
+            address = self.get(host)
+            if address is None:
+                missing.append(host)
+            else:
+                addresses[host] = address
+
+        def worker(host):
+            try:
+                info = socket.getaddrinfo(host, 22, 0, socket.SOCK_STREAM)
+            except (socket.gaierror, socket.herror, socket.error) as e:
+                failures[host] = e.args[-1] if e.args else str(e)
+                return
+            if not info:
+                failures[host] = "no address"
+                return
+            address = info[0][4][0]
+            addresses[host] = address
+            self.data[host] = (time.time(), address)
+            self.__dirty = True
+
+        pool = Pool(self.concurrency)
+        for host in missing:
+            pool.spawn(worker, host)
+        pool.join()
+        return addresses, failures
+
+    def save(self):
+        if not self.__dirty:
+            return
+        now = time.time()
+        data = dict((h, item) for h, item in self.data.items() if now - item[0] <= self.ttl)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        atomic_pickle(self.filename, data, ".addresses.")
+        self.__data = data
+        self.__dirty = False
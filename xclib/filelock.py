@@ -0,0 +1,55 @@
+import os
+import time
+import errno
+import fcntl
+
+
+class FileLock(object):
+    """
+    Exclusive advisory (flock) lock shared between xcute processes.
+    The lock is released by the kernel if the holder dies.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+
+    @property
+    def locked(self):
+        return self.fd is not None
+
+    def acquire(self, timeout=0, interval=0.1):
+        """
+        Tries to take the lock for up to `timeout` seconds, returns
+        True on success
+        """
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.fd = fd
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+            if time.time() >= deadline:
+                os.close(fd)
+                return False
+            time.sleep(interval)
+
+    def release(self):
+        if self.fd is None:
+            return
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire(timeout=float("inf"))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+        return False
@@ -0,0 +1,110 @@
+import os
+import time
+import cPickle as pickle
+from xclib.atomic import atomic_pickle
+
+
+# stderr fragments of ssh/scp meaning the host was never reached
+TRANSPORT_ERRORS = (
+    "ssh: connect to host",
+    "Connection timed out",
+    "Connection refused",
+    "No route to host",
+    "Could not resolve hostname",
+    "Name or service not known",
+    "lost connection",
+    "Connection closed by",
+    "Connection reset by peer",
+)
+
+
+def is_transport_error(output):
+    if not output:
+        return False
+    for fragment in TRANSPORT_ERRORS:
+        if fragment in output:
+            return True
+    return False
+
+
+class HealthCache(object):
+    """
+    Per-host reachability history stored next to the inventory cache.
+    Hosts which failed to connect within the last `ttl` seconds are
+    considered known-dead and can be skipped or deprioritized.
+    """
+
+    FILENAME = "health.pickle"
+    DEFAULT_TTL = 600
+
+    def __init__(self, cache_dir, ttl=DEFAULT_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.__data = None
+        self.__changes = {}
+
+    @property
+    def filename(self):
+        return os.path.join(self.cache_dir, self.FILENAME)
+
+    @property
+    def data(self):
+        if self.__data is None:
+            self.__data = self.read()
+        return self.__data
+
+    def read(self):
+        try:
+            with open(self.filename, "rb") as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return {}
+
+    def record(self, host, ok, reason=None):
+        item = {"ts": time.time(), "ok": ok, "reason": reason}
+        self.data[host] = item
+        self.__changes[host] = item
+
+    def failed_at(self, host):
+        item = self.data.get(host)
+        if item is None or item["ok"]:
+            return None
+        if time.time() - item["ts"] > self.ttl:
+            return None
+        return item["ts"]
+
+    def known_dead(self, hosts):
+        result = {}
+        for host in hosts:
+            ts = self.failed_at(host)
+            if ts is not None:
+                result[host] = ts
+        return result
+
+    def clear(self, hosts=None):
+        if hosts is None:
+            hosts = list(self.data.keys())
+        for host in hosts:
+            if host in self.data:
+                del(self.data[host])
+            self.__changes[host] = None
+
+    def save(self):
+        if not self.__changes:
+            return
+        # merge with what concurrent sessions may have written meanwhile
+        data = self.read()
+        now = time.time()
+        for host, item in self.__changes.items():
+            if item is None:
+                data.pop(host, None)
+            elif host not in data or data[host]["ts"] <= item["ts"]:
+                data[host] = item
+        for host in [h for h, item in data.items() if now - item["ts"] > self.ttl]:
+            del(data[host])
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        atomic_pickle(self.filename, data, ".health.")
+        self.__data = data
+        self.__changes = {}
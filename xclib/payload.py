@@ -0,0 +1,71 @@
+import os
+import sys
+import mmap
+import stat
+import errno
+
+
+class Payload(object):
+    """
+    Local input fed to the stdin of every remote command of a run. The
+    data is read (or mapped) once and every host gets read-only views of
+    it, so memory stays O(payload) whatever the number of hosts.
+    """
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, data, name):
+        self.data = data
+        self.name = name
+
+    @classmethod
+    def from_fileobj(cls, f, name):
+        st = os.fstat(f.fileno())
+        if stat.S_ISREG(st.st_mode):
+            if st.st_size == 0:
+                return cls("", name)
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), name)
+        # pipes and terminals can't be mapped
+        return cls(f.read(), name)
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(os.path.expanduser(filename), "rb") as f:
+            return cls.from_fileobj(f, filename)
+
+    @classmethod
+    def from_stdin(cls):
+        return cls.from_fileobj(sys.stdin, "stdin")
+
+    def __len__(self):
+        return len(self.data)
+
+    def chunk(self, offset):
+        return buffer(self.data, offset, self.CHUNK_SIZE)
+
+    def chunks(self):
+        for offset in xrange(0, len(self.data), self.CHUNK_SIZE):
+            yield self.chunk(offset)
+
+    def feed(self, stream):
+        """
+        Writes the payload to stream and closes it. A write blocks (or
+        yields to other greenlets for gevent pipes) while the remote side
+        isn't reading, a command exiting before reading everything is fine.
+        """
+        try:
+            for chunk in self.chunks():
+                stream.write(chunk)
+            stream.flush()
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EPIPE, errno.EINVAL):
+                raise
+        finally:
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
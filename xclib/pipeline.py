@@ -0,0 +1,158 @@
+import os
+from collections import defaultdict
+from pipes import quote
+from xclib.backends import LineSplitter
+
+SEPARATOR = ":::"
+# a step prefixed with it may fail without stopping the pipeline, as in make
+IGNORE_PREFIX = "-"
+
+
+def parse_steps(line):
+    """
+    "step ::: -step ::: step" -> [(cmd, ignore_failure)]
+    """
+    steps = []
+    for cmd in line.split(SEPARATOR):
+        cmd = cmd.strip()
+        ignore = cmd.startswith(IGNORE_PREFIX)
+        if ignore:
+            cmd = cmd[len(IGNORE_PREFIX):].strip()
+        if not cmd:
+            raise ValueError("empty step")
+        steps.append((cmd, ignore))
+    return steps
+
+
+class Pipeline(object):
+    """
+    Steps run in order over a single ssh session per host. The remote
+    script prints a marker line (unique to the run) to both stdout and
+    stderr around every step, so outputs and exit codes are told apart
+    per step, and stops at the first failing step. Steps run in separate
+    subshells: an exit in a step ends the step, not the session.
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.marker = "xcute-step-%s" % os.urandom(8).encode("hex")
+
+    def command(self):
+        mark = "m() { echo \"%s $*\"; echo \"%s $*\" >&2; }" % (self.marker, self.marker)
+        lines = [mark]
+        for num, (cmd, ignore) in enumerate(self.steps, 1):
+            lines.append("m start %d; (eval %s); r=$?; m end %d $r" % (num, quote(cmd), num))
+            if not ignore:
+                # exit code 255 is left to ssh itself
+                lines.append("[ $r -eq 0 ] || exit $(( r == 255 ? 1 : r ))")
+        # whatever the login shell of the remote user is
+        return "sh -c %s" % quote("\n".join(lines))
+
+    def results(self, clusters=None, empty=""):
+        return PipelineResults(self, clusters, empty)
+
+
+class PipelineResults(object):
+    """
+    Per-step collapsed outputs and exit codes of a pipeline run, fed
+    from the callbacks of a backend. Output printed before the first step
+    (ssh errors, banners) is kept per host as the session output and is
+    reported only for hosts where no step has started.
+
+    clusters, if given, makes a Clusters object per step (normalized
+    collapse) instead of a dict of exact outputs. empty is the output
+    recorded for a step which printed nothing.
+    """
+
+    def __init__(self, pipeline, clusters=None, empty=""):
+        self.marker = pipeline.marker
+        self.count = len(pipeline.steps)
+        self.clusters = clusters
+        self.empty = empty
+        self.outputs = [self.new_outputs() for _ in xrange(self.count + 1)]
+        self.codes = [defaultdict(list) for _ in xrange(self.count + 1)]
+        self.lines = LineSplitter()
+        self.current = {}
+        # host -> step -> output lines, step 0 is the session
+        self.buffers = defaultdict(lambda: defaultdict(list))
+        self.step_codes = defaultdict(dict)
+
+    def new_outputs(self):
+        return self.clusters() if self.clusters is not None else defaultdict(list)
+
+    def parse(self, host, stream, line):
+        key = (host, stream)
+        pos = line.find(self.marker)
+        if pos < 0:
+            self.buffers[host][self.current.get(key, 0)].append(line)
+            return
+        if pos > 0:
+            # the step's output doesn't end with a newline
+            self.buffers[host][self.current.get(key, 0)].append(line[:pos] + "\n")
+        fields = line[pos:].split()
+        try:
+            num = int(fields[2])
+            if fields[1] == "start":
+                self.current[key] = num
+                self.buffers[host][num]
+            elif fields[1] == "end":
+                self.step_codes[host][num] = int(fields[3])
+                self.current[key] = 0
+        except (IndexError, ValueError):
+            pass
+
+    def output(self, host, stream, data):
+        for line in self.lines.feed((host, stream), data):
+            self.parse(host, stream, line)
+
+    def retry(self, host):
+        for stream in ("out", "err"):
+            self.lines.flush((host, stream))
+            self.current.pop((host, stream), None)
+        self.buffers.pop(host, None)
+        self.step_codes.pop(host, None)
+
+    def exit(self, host, code):
+        for stream in ("out", "err"):
+            for line in self.lines.flush((host, stream)):
+                self.parse(host, stream, line + "\n")
+            self.current.pop((host, stream), None)
+        buffers = self.buffers.pop(host, {})
+        codes = self.step_codes.pop(host, {})
+        # the session output is reported only if no step has started
+        steps = sorted(num for num in buffers if num > 0) or [0]
+        for num in steps:
+            # a step without an end marker was cut off with the session
+            self.add(num, host, "".join(buffers.get(num, ())), codes.get(num, code))
+
+    def add(self, num, host, output, code):
+        if output == "":
+            output = self.empty
+        self.codes[num][code].append(host)
+        if self.clusters is not None:
+            self.outputs[num].add(host, output)
+        else:
+            self.outputs[num][output].append(host)
+
+    def skipped(self, num, hosts):
+        """
+        Hosts of the run which didn't get to the step
+        """
+        ran = set()
+        for step_hosts in self.codes[num].values():
+            ran.update(step_hosts)
+        return [h for h in hosts if h not in ran]
+
+    def collect(self):
+        return self.outputs, self.codes
+
+    def merge(self, result):
+        outputs, codes = result
+        for num in xrange(self.count + 1):
+            for code, hosts in codes[num].items():
+                self.codes[num][code].extend(hosts)
+            if self.clusters is not None:
+                self.outputs[num].merge(outputs[num])
+            else:
+                for output, hosts in outputs[num].items():
+                    self.outputs[num][output].extend(hosts)
@@ -0,0 +1,328 @@
+import errno
+import itertools
+import os
+import socket
+import resource
+import struct
+import time
+import gevent
+from gevent import socket as gsocket
+from gevent import Timeout
+from gevent.event import Event
+from gevent.pool import Pool
+
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+# descriptors left for everything else the process has open
+RESERVED_FDS = 64
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += "\0"
+    total = sum(struct.unpack("!%dH" % (len(data) / 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def socket_limit():
+    """
+    How many probe sockets may be open at once within RLIMIT_NOFILE,
+    None if unlimited
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return max(soft - RESERVED_FDS, soft // 2, 1)
+
+
+def echo_request(ident, seq, payload="xcute-probe"):
+    header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    csum = checksum(header + payload)
+    return struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, csum, ident, seq) + payload
+
+
+def parse_reply(data):
+    """
+    (ident, seq) of an ICMP echo reply, None for anything else
+    """
+    if len(data) < 8:
+        return None
+    r_type, _, _, r_ident, r_seq = struct.unpack("!BBHHH", data[:8])
+    if r_type != ICMP_ECHO_REPLY:
+        return None
+    return r_ident, r_seq
+
+
+class EchoListener(object):
+    """
+    One raw ICMP socket shared by all probes of a run. The kernel hands
+    every echo reply to every raw socket, so replies are read once here
+    and dispatched to the waiting probe by (address, ident, seq).
+    """
+
+    def __init__(self):
+        self.sock = gsocket.socket(gsocket.AF_INET, gsocket.SOCK_RAW, gsocket.IPPROTO_ICMP)
+        self.waiters = {}
+        self.reader = gevent.spawn(self.read)
+
+    def send(self, address, ident, seq):
+        key = (address, ident, seq)
+        event = Event()
+        self.waiters[key] = event
+        try:
+            self.sock.sendto(echo_request(ident, seq), (address, 0))
+        except gsocket.error:
+            del self.waiters[key]
+            raise
+        return key, event
+
+    def wait(self, key, event, timeout):
+        try:
+            return event.wait(timeout)
+        finally:
+            self.waiters.pop(key, None)
+
+    def read(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except gsocket.error:
+                return
+            # raw sockets get the IP header as well
+            reply = parse_reply(data[(ord(data[0]) & 0x0f) * 4:])
+            if reply is None:
+                continue
+            event = self.waiters.get((addr[0],) + reply)
+            if event is not None:
+                event.set()
+
+    def close(self):
+        self.reader.kill()
+        self.sock.close()
+
+
+class ProbeResult(object):
+
+    __slots__ = ("host", "address", "sent", "received", "rtts", "error", "refused")
+
+    def __init__(self, host):
+        self.host = host
+        self.address = None
+        self.sent = 0
+        self.received = 0
+        self.rtts = []
+        self.error = None
+        self.refused = False
+
+    @property
+    def alive(self):
+        return self.received > 0
+
+    @property
+    def loss(self):
+        if self.sent == 0:
+            return 100.0
+        return (self.sent - self.received) * 100.0 / self.sent
+
+    @property
+    def rtt_min(self):
+        return min(self.rtts) if self.rtts else None
+
+    @property
+    def rtt_avg(self):
+        return sum(self.rtts) / len(self.rtts) if self.rtts else None
+
+    @property
+    def rtt_max(self):
+        return max(self.rtts) if self.rtts else None
+
+
+class Prober(object):
+    """
+    In-process reachability checks: ICMP echo where the process is allowed
+    to open ICMP sockets (root, or unprivileged ping sockets enabled by
+    net.ipv4.ping_group_range), TCP connect otherwise. A refused TCP
+    connection still means the host is up.
+    """
+
+    METHODS = ("auto", "icmp", "tcp")
+
+    def __init__(self, method="auto", port=22, count=3, timeout=1.0, interval=0.2, concurrency=1000):
+        if method not in self.METHODS:
+            raise ValueError("invalid probe method %s" % method)
+        self.port = port
+        self.count = count
+        self.timeout = timeout
+        self.interval = interval
+        limit = socket_limit()
+        self.concurrency = min(concurrency, limit) if limit is not None else concurrency
+        self.icmp_type = None
+        self.idents = None
+        self.listener = None
+        self.listener_error = None
+        if method in ("auto", "icmp"):
+            self.icmp_type = self.detect_icmp()
+            if self.icmp_type is None and method == "icmp":
+                raise ValueError("ICMP sockets are not permitted for this user")
+        self.method = "icmp" if self.icmp_type is not None else "tcp"
+
+    @staticmethod
+    def detect_icmp():
+        for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                s = socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+            except socket.error:
+                continue
+            s.close()
+            return sock_type
+        return None
+
+    def resolve(self, result):
+        try:
+            result.address = gsocket.gethostbyname(result.host)
+        except (gsocket.error, gsocket.herror, gsocket.gaierror) as e:
+            result.error = "resolve: %s" % (e.args[-1] if e.args else e)
+            return False
+        return True
+
+    def probe_tcp(self, result):
+        for seq in xrange(self.count):
+            if seq > 0 and self.interval > 0:
+                gevent.sleep(self.interval)
+            try:
+                s = gsocket.socket(gsocket.AF_INET, gsocket.SOCK_STREAM)
+            except gsocket.error as e:
+                # e.g. out of descriptors, the host is left unprobed
+                result.error = e.args[-1] if e.args else str(e)
+                continue
+            s.settimeout(self.timeout)
+            result.sent += 1
+            started = time.time()
+            try:
+                s.connect((result.address, self.port))
+                result.received += 1
+                result.rtts.append((time.time() - started) * 1000)
+            except gsocket.timeout:
+                result.error = "timeout"
+            except gsocket.error as e:
+                if e.args and e.args[0] == errno.ECONNREFUSED:
+                    result.received += 1
+                    result.refused = True
+                    result.rtts.append((time.time() - started) * 1000)
+                else:
+                    result.error = e.args[-1] if e.args else str(e)
+            finally:
+                s.close()
+
+    def probe_icmp(self, result):
+        if self.icmp_type == socket.SOCK_RAW:
+            self.probe_icmp_raw(result)
+            return
+        try:
+            s = gsocket.socket(gsocket.AF_INET, self.icmp_type, gsocket.IPPROTO_ICMP)
+        except gsocket.error as e:
+            result.error = e.args[-1] if e.args else str(e)
+            return
+        try:
+            # ping sockets get only their own replies, with the ident
+            # rewritten by the kernel
+            ident = next(self.idents) & 0xffff
+            for seq in xrange(1, self.count + 1):
+                if seq > 1 and self.interval > 0:
+                    gevent.sleep(self.interval)
+                result.sent += 1
+                started = time.time()
+                try:
+                    s.sendto(echo_request(ident, seq), (result.address, 0))
+                except gsocket.error as e:
+                    result.error = e.args[-1] if e.args else str(e)
+                    continue
+                if self.wait_reply(s, result.address, seq, started):
+                    result.received += 1
+                    result.rtts.append((time.time() - started) * 1000)
+                else:
+                    result.error = "timeout"
+        finally:
+            s.close()
+
+    def probe_icmp_raw(self, result):
+        if self.listener is None:
+            result.error = self.listener_error
+            return
+        ident = next(self.idents) & 0xffff
+        for seq in xrange(1, self.count + 1):
+            if seq > 1 and self.interval > 0:
+                gevent.sleep(self.interval)
+            result.sent += 1
+            started = time.time()
+            try:
+                key, event = self.listener.send(result.address, ident, seq)
+            except gsocket.error as e:
+                result.error = e.args[-1] if e.args else str(e)
+                continue
+            if self.listener.wait(key, event, self.timeout):
+                result.received += 1
+                result.rtts.append((time.time() - started) * 1000)
+            else:
+                result.error = "timeout"
+
+    def wait_reply(self, s, address, seq, started):
+        deadline = started + self.timeout
+        while True:
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            try:
+                with Timeout(left):
+                    data, addr = s.recvfrom(2048)
+            except Timeout:
+                return False
+            if addr[0] != address:
+                continue
+            reply = parse_reply(data)
+            if reply is not None and reply[1] == seq:
+                return True
+
+    def probe_host(self, host):
+        result = ProbeResult(host)
+        if not self.resolve(result):
+            return result
+        if self.method == "icmp":
+            self.probe_icmp(result)
+        else:
+            self.probe_tcp(result)
+        if result.alive:
+            result.error = None
+        return result
+
+    def probe(self, hosts, callback=None):
+        results = {}
+
+        def worker(host):
+            result = self.probe_host(host)
+            results[host] = result
+            if callback:
+                callback(result)
+
+        # idents are unique within a run, offset by pid to keep clear of
+        # other probing processes
+        self.idents = itertools.count(os.getpid())
+        if self.method == "icmp" and self.icmp_type == socket.SOCK_RAW:
+            try:
+                self.listener = EchoListener()
+            except gsocket.error as e:
+                self.listener_error = e.args[-1] if e.args else str(e)
+        try:
+            pool = Pool(self.concurrency)
+            for host in hosts:
+                pool.spawn(worker, host)
+            pool.join()
+        finally:
+            if self.listener is not None:
+                self.listener.close()
+                self.listener = None
+        return results
+
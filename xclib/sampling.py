@@ -0,0 +1,79 @@
+import re
+import random
+from xclib.backends import LineSplitter
+
+
+def sample_strata(strata, size, rnd=random):
+    """
+    Picks size(len(stratum)) random hosts of every stratum (a list of
+    hosts), the result keeps the order of the hosts
+    """
+    result = []
+    for hosts in strata:
+        count = min(size(len(hosts)), len(hosts))
+        picked = sorted(rnd.sample(xrange(len(hosts)), count))
+        result.extend(hosts[i] for i in picked)
+    return result
+
+
+class EarlyExit(object):
+    """
+    Stops a run once `count` hosts have succeeded: exited with 0 or, with
+    a pattern, printed a stdout line matching it whatever the exit code.
+    A match counts as soon as the line arrives, so the matching host may
+    be stopped with the others before it exits. Fed from the
+    on_output/on_retry/on_exit callbacks of a backend, calls its stop()
+    when done.
+    """
+
+    def __init__(self, count, pattern=None):
+        self.count = count
+        self.pattern = re.compile(pattern) if pattern else None
+        self.lines = LineSplitter()
+        self.matched = set()
+        self.exited = set()
+        self.hosts = []
+        self.backend = None
+
+    @property
+    def reached(self):
+        return len(self.hosts) >= self.count
+
+    @property
+    def stopped(self):
+        """
+        Succeeded hosts which hadn't exited when the run was stopped
+        """
+        return [h for h in self.hosts if h not in self.exited]
+
+    def match(self, host, lines):
+        for line in lines:
+            if self.pattern.search(line):
+                self.matched.add(host)
+                self.succeeded(host)
+                return
+
+    def succeeded(self, host):
+        if self.reached:
+            return
+        self.hosts.append(host)
+        if self.reached and self.backend is not None:
+            self.backend.stop()
+
+    def output(self, host, stream, data):
+        if self.pattern is None or stream != "out" or host in self.matched:
+            return
+        self.match(host, self.lines.feed(host, data))
+
+    def retry(self, host):
+        # a host which has matched stays counted
+        self.lines.flush(host)
+
+    def exit(self, host, code):
+        self.exited.add(host)
+        if self.pattern is not None:
+            tail = self.lines.flush(host)
+            if host not in self.matched:
+                self.match(host, tail)
+        elif code == 0:
+            self.succeeded(host)
@@ -0,0 +1,89 @@
+import os
+import time
+import hashlib
+import cPickle as pickle
+from xclib.atomic import atomic_pickle
+
+
+def script_digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def upload_command(path):
+    """
+    Remote shell command storing stdin as an executable at path unless
+    it's already there. Content-addressed paths never change contents,
+    so an existing file is always up to date.
+    """
+    dirname = os.path.dirname(path)
+    return ("test -x {path} && exit 0; mkdir -p {dir} && cat > {path}.$$ && "
+            "chmod 755 {path}.$$ && mv -f {path}.$$ {path}").format(path=path, dir=dirname)
+
+
+class ScriptCache(object):
+    """
+    Script digests known to be uploaded to each host, per remote user
+    as scripts live in the user's home directory. Hosts with a fresh
+    record are not asked again, so a repeated script run costs a single
+    ssh session per host. Records older than `ttl` seconds are rechecked
+    in case the remote directory has been cleaned up.
+    """
+
+    FILENAME = "scripts.pickle"
+    DEFAULT_TTL = 86400
+
+    def __init__(self, cache_dir, ttl=DEFAULT_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.__data = None
+        self.__changes = {}
+
+    @property
+    def filename(self):
+        return os.path.join(self.cache_dir, self.FILENAME)
+
+    @property
+    def data(self):
+        if self.__data is None:
+            self.__data = self.read()
+        return self.__data
+
+    def read(self):
+        try:
+            with open(self.filename, "rb") as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return {}
+
+    def missing(self, hosts, user, digest):
+        now = time.time()
+        return [h for h in hosts if now - self.data.get((user, h, digest), 0) > self.ttl]
+
+    def record(self, host, user, digest):
+        key = (user, host, digest)
+        self.data[key] = self.__changes[key] = time.time()
+
+    def forget(self, hosts, user, digest):
+        for host in hosts:
+            key = (user, host, digest)
+            self.data.pop(key, None)
+            self.__changes[key] = None
+
+    def save(self):
+        if not self.__changes:
+            return
+        data = self.read()
+        now = time.time()
+        for key, ts in self.__changes.items():
+            if ts is None:
+                data.pop(key, None)
+            elif data.get(key, 0) < ts:
+                data[key] = ts
+        for key in [k for k, ts in data.items() if now - ts > self.ttl]:
+            del(data[key])
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        atomic_pickle(self.filename, data, ".scripts.")
+        self.__data = data
+        self.__changes = {}
@@ -0,0 +1,90 @@
+import os
+import time
+from collections import defaultdict
+
+
+class NullTimer(object):
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+
+    __slots__ = ("registry", "name", "started")
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.registry.add_time(self.name, time.time() - self.started)
+        return False
+
+
+class Timing(object):
+    """
+    Named timers and counters for the hot paths (conductor load/fetch/resolve,
+    process spawning, terminal output). When disabled every call returns
+    immediately so instrumentation can stay in place permanently.
+    """
+
+    ENV_VAR = "XCUTE_TIMING"
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.timers = None
+        self.calls = None
+        self.counters = None
+        self.reset()
+
+    def reset(self):
+        self.timers = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def timer(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def add_time(self, name, value):
+        self.timers[name] += value
+        self.calls[name] += 1
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    @property
+    def empty(self):
+        return len(self.timers) == 0 and len(self.counters) == 0
+
+    def report(self, total=None):
+        lines = []
+        if total is not None:
+            lines.append("%-32s %10.3fs" % ("total", total))
+        for name in sorted(self.timers, key=lambda x: -self.timers[x]):
+            line = "%-32s %10.3fs %8d call(s)" % (name, self.timers[name], self.calls[name])
+            if total:
+                line += " %6.1f%%" % (self.timers[name] * 100.0 / total)
+            lines.append(line)
+        for name in sorted(self.counters):
+            lines.append("%-32s %10d" % (name, self.counters[name]))
+        return lines
+
+
+timing = Timing(enabled=os.environ.get(Timing.ENV_VAR, "").lower() in ("1", "on", "yes", "true"))
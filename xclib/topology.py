@@ -0,0 +1,97 @@
+from itertools import izip_longest
+from collections import defaultdict, OrderedDict
+
+NOWHERE = (None, None)
+
+
+def datacenter_name(host):
+    """
+    Name of the host's top-level datacenter, child datacenters (racks,
+    rooms) count as parts of it
+    """
+    if getattr(host, "datacenter_id", None) is None:
+        return None
+    dc = host.datacenter
+    if dc is None:
+        return None
+    if getattr(dc, "root_id", None) is not None:
+        dc = dc.root or dc
+    return dc.name
+
+
+def group_name(host):
+    if getattr(host, "group_id", None) is None:
+        return None
+    group = host.group
+    return group.name if group is not None else None
+
+
+class Topology(object):
+    """
+    Datacenter and group of each host of a run, used to spread the run's
+    load: hosts are interleaved across datacenters and buckets of hosts
+    (a datacenter, a group) can be capped to a number of hosts running
+    at once. Hosts unknown to the inventory belong to no bucket.
+    """
+
+    def __init__(self, placement):
+        self.placement = placement
+
+    @classmethod
+    def from_conductor(cls, conductor, hosts):
+        index = conductor.hosts.get_cache("fqdn")
+        placement = {}
+        # hosts share a handful of (datacenter, group) pairs, look them up once
+        names = {}
+        for fqdn in hosts:
+            host = index.get(fqdn)
+            if host is None:
+                continue
+            ids = (getattr(host, "datacenter_id", None), getattr(host, "group_id", None))
+            pair = names.get(ids)
+            if pair is None:
+                pair = names[ids] = (datacenter_name(host), group_name(host))
+            placement[fqdn] = pair
+        return cls(placement)
+
+    def interleave(self, hosts):
+        """
+        Round-robin over datacenters keeping the order of hosts within
+        each, so consecutive hosts are in different datacenters
+        """
+        queues = OrderedDict()
+        placement = self.placement
+        for host in hosts:
+            queues.setdefault(placement.get(host, NOWHERE)[0], []).append(host)
+        if len(queues) < 2:
+            return list(hosts)
+        return [host for row in izip_longest(*queues.values()) for host in row if host is not None]
+
+    def strata(self, hosts, by):
+        """
+        Hosts split by "dc" or "group", keeping their order
+        """
+        index = 0 if by == "dc" else 1
+        strata = OrderedDict()
+        placement = self.placement
+        for host in hosts:
+            strata.setdefault(placement.get(host, NOWHERE)[index], []).append(host)
+        return strata
+
+    def buckets(self, hosts):
+        """
+        Returns host -> bucket keys and bucket key -> number of the hosts
+        """
+        buckets = {}
+        counts = defaultdict(int)
+        keys = {}
+        for host in hosts:
+            pair = self.placement.get(host, NOWHERE)
+            host_keys = keys.get(pair)
+            if host_keys is None:
+                dc, group = pair
+                host_keys = keys[pair] = tuple(k for k in (("dc", dc), ("group", group)) if k[1] is not None)
+            buckets[host] = host_keys
+            for key in host_keys:
+                counts[key] += 1
+        return buckets, counts